@@ -1 +1,3 @@
 from .mixin import DatabaseQueryLoggerMixin
+from .shortcuts import query_logging
+from .budget import QueryBudget, QueryBudgetExceeded, QueryBudgetTestMixin, capture_queries
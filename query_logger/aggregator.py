@@ -0,0 +1,293 @@
+# project
+from .histogram import LatencyHistogram
+
+
+class FingerprintStats(object):
+    """
+    Compact running record for every execution of one fingerprint in a session
+    """
+    __slots__ = ('sql', 'count', 'total_time', 'max_time', 'tb', 'slow_times', 'aliases', 'histogram', 'sites',
+                 'plan', 'rows', 'bytes', 'max_rows', 'max_bytes', 'large_count', 'batches', 'batch_rows', 'max_batch',
+                 'max_run', 'multi_row')
+
+    def __init__(self, sql, tb=None):
+        self.sql = sql
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.tb = tb
+        self.slow_times = None
+        self.aliases = {}
+        self.histogram = LatencyHistogram()
+        self.sites = None
+        self.plan = None
+        # Result sizes, only counted when fetches are
+        self.rows = 0
+        self.bytes = 0
+        self.max_rows = 0
+        self.max_bytes = 0
+        self.large_count = 0
+        # executemany calls and the parameter sets sent with them
+        self.batches = 0
+        self.batch_rows = 0
+        self.max_batch = 0
+        # The most executions of a write in a row, and how many of its executions wrote several rows at once, only
+        # tracked when write runs are
+        self.max_run = 0
+        self.multi_row = 0
+
+
+class AliasStats(object):
+    """
+    Running totals for one database connection in a session
+    """
+    __slots__ = ('count', 'total_time', 'events')
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        # Connection event (connect, commit, savepoint...) to [count, seconds]
+        self.events = {}
+
+    def add_event(self, event, duration, count=1):
+        totals = self.events.get(event)
+        if totals is None:
+            totals = self.events[event] = [0, 0.0]
+        totals[0] += count
+        totals[1] += duration
+
+
+class QueryAggregator(object):
+    """
+    Folds queries into per fingerprint stats as they arrive. Every update is O(1) and nothing is kept per query, so
+    memory and the work done at the end of a session grow with the number of distinct statements, not the number of
+    queries run.
+    """
+
+    def __init__(self, long_running_time=None, large_result_rows=None, large_result_bytes=None,
+                 track_write_runs=False):
+        """
+        :param long_running_time: the slow query limit in ms, 0 or None to not track slow queries
+        :param large_result_rows: executions fetching at least this many rows count as large results
+        :param large_result_bytes: as do executions fetching at least this many bytes
+        :param track_write_runs: track how many times in a row each INSERT and UPDATE runs
+        """
+        self.slow_limit = long_running_time / 1000.0 if long_running_time and long_running_time > 0 else None
+        self.large_rows = large_result_rows or None
+        self.large_bytes = large_result_bytes or None
+        self.stats = {}
+        self.alias_stats = {}
+        self.histogram = LatencyHistogram()
+        self.num_queries = 0
+        self.sql_time = 0.0
+        self.num_rows = 0
+        self.num_bytes = 0
+        self.track_write_runs = track_write_runs
+        # Per connection, the write currently repeating and how many times in a row it has run
+        self._runs = {}
+
+    def __contains__(self, sql):
+        return sql in self.stats
+
+    def add(self, sql, duration, tb=None, alias='default', site=None, batch=None, rows=None):
+        """
+        Records one execution of an already fingerprinted statement.
+
+        :param sql: the fingerprint
+        :param duration: seconds
+        :param tb: the traceback, only kept for the first execution of each fingerprint
+        :param alias: the connection it ran on
+        :param site: the call site it was issued from, when call sites are being tracked
+        :param batch: the number of parameter sets, for executemany
+        :param rows: the number of rows an INSERT listed before it was fingerprinted
+        :return: the fingerprint's stats
+        """
+        entry = self.stats.get(sql)
+        if entry is None:
+            entry = self.stats[sql] = FingerprintStats(sql, tb)
+        entry.count += 1
+        entry.aliases[alias] = entry.aliases.get(alias, 0) + 1
+        entry.total_time += duration
+        if duration > entry.max_time:
+            entry.max_time = duration
+        entry.histogram.record(duration)
+        if site is not None:
+            if entry.sites is None:
+                entry.sites = {}
+            entry.sites[site] = entry.sites.get(site, 0) + 1
+        if self.slow_limit is not None and duration > self.slow_limit:
+            if entry.slow_times is None:
+                entry.slow_times = []
+            entry.slow_times.append(duration)
+        if batch is not None:
+            entry.batches += 1
+            entry.batch_rows += batch
+            if batch > entry.max_batch:
+                entry.max_batch = batch
+        if self.track_write_runs:
+            self._track_run(entry, alias, rows)
+        alias_entry = self.alias_stats.get(alias)
+        if alias_entry is None:
+            alias_entry = self.alias_stats[alias] = AliasStats()
+        alias_entry.count += 1
+        alias_entry.total_time += duration
+        self.histogram.record(duration)
+        self.num_queries += 1
+        self.sql_time += duration
+        return entry
+
+    def _track_run(self, entry, alias, rows):
+        # Reads in between don't break a run, any other write on the same connection does, and so does a multi row one
+        if entry.sql[:6].upper() not in ('INSERT', 'UPDATE'):
+            return
+        if rows is not None and rows > 1:
+            entry.multi_row += 1
+            self._runs[alias] = (None, 0)
+            return
+        last, run = self._runs.get(alias, (None, 0))
+        run = run + 1 if last is entry else 1
+        self._runs[alias] = (entry, run)
+        if run > entry.max_run:
+            entry.max_run = run
+
+    def add_event(self, alias, event, duration):
+        """
+        Records a connection event: connecting, creating a cursor, or beginning, committing or rolling back a
+        transaction or savepoint.
+
+        :param alias: the connection
+        :param event: one of the event names in capture
+        :param duration: seconds
+        :return:
+        """
+        alias_entry = self.alias_stats.get(alias)
+        if alias_entry is None:
+            alias_entry = self.alias_stats[alias] = AliasStats()
+        alias_entry.add_event(event, duration)
+
+    def add_rows(self, sql, rows, size, statement_rows, statement_size):
+        """
+        Records rows fetched for an execution of an already fingerprinted statement. An execution counts as a large
+        result once, when the rows fetched for it so far first reach either limit.
+
+        :param sql: the fingerprint
+        :param rows: rows in this fetch
+        :param size: their approximate size in bytes
+        :param statement_rows: rows fetched for the execution so far, including these
+        :param statement_size: bytes fetched for the execution so far, including these
+        :return:
+        """
+        entry = self.stats.get(sql)
+        if entry is None:  # Executed before a checkpoint, or before the session started
+            return
+        entry.rows += rows
+        entry.bytes += size
+        if statement_rows > entry.max_rows:
+            entry.max_rows = statement_rows
+        if statement_size > entry.max_bytes:
+            entry.max_bytes = statement_size
+        if self._is_large(statement_rows, statement_size) and not self._is_large(statement_rows - rows,
+                                                                                 statement_size - size):
+            entry.large_count += 1
+        self.num_rows += rows
+        self.num_bytes += size
+
+    def _is_large(self, rows, size):
+        return bool(self.large_rows and rows >= self.large_rows or self.large_bytes and size >= self.large_bytes)
+
+    @property
+    def num_duplicates(self):
+        """
+        Every execution past the first of each fingerprint
+        """
+        return self.num_queries - len(self.stats)
+
+    def count(self, sql):
+        """
+        How many times a fingerprint ran.
+
+        :param sql: the fingerprint
+        :return:
+        """
+        entry = self.stats.get(sql)
+        return entry.count if entry is not None else 0
+
+    def duplicates(self):
+        """
+        The stats for every fingerprint run more than once, least repeated first.
+
+        :return:
+        """
+        return sorted((entry for entry in self.stats.values() if entry.count > 1), key=lambda entry: entry.count)
+
+    def large_results(self):
+        """
+        The stats for every fingerprint with at least one execution fetching a large result.
+
+        :return:
+        """
+        return [entry for entry in self.stats.values() if entry.large_count]
+
+    def slow_queries(self):
+        """
+        The stats for every fingerprint with at least one execution over the slow query limit.
+
+        :return:
+        """
+        return [entry for entry in self.stats.values() if entry.slow_times]
+
+
+class QueryTotals(object):
+    """
+    Session wide totals of the windows a checkpointing session has already flushed. Has the same totals as a
+    QueryAggregator but no per fingerprint stats, so it stays the same size however long the session runs. Duplicates
+    are counted within each window. Execution counts are only kept for the fingerprints it is asked to track.
+    """
+
+    def __init__(self, tracked=()):
+        """
+        :param tracked: fingerprints to count executions of across every window, such as those a budget limits
+        """
+        self.counts = dict((sql, 0) for sql in tracked)
+        self.alias_stats = {}
+        self.histogram = LatencyHistogram()
+        self.num_queries = 0
+        self.num_duplicates = 0
+        self.num_windows = 0
+        self.sql_time = 0.0
+        self.num_rows = 0
+        self.num_bytes = 0
+
+    def add(self, aggregator):
+        """
+        Folds one window's aggregator into the totals.
+
+        :param aggregator:
+        :return:
+        """
+        for alias, alias_entry in aggregator.alias_stats.items():
+            total = self.alias_stats.get(alias)
+            if total is None:
+                total = self.alias_stats[alias] = AliasStats()
+            total.count += alias_entry.count
+            total.total_time += alias_entry.total_time
+            for event, (count, duration) in alias_entry.events.items():
+                total.add_event(event, duration, count)
+        self.histogram.merge(aggregator.histogram)
+        self.num_queries += aggregator.num_queries
+        self.num_duplicates += aggregator.num_duplicates
+        self.num_windows += 1
+        self.sql_time += aggregator.sql_time
+        self.num_rows += aggregator.num_rows
+        self.num_bytes += aggregator.num_bytes
+        for sql in self.counts:
+            self.counts[sql] += aggregator.count(sql)
+
+    def count(self, sql):
+        """
+        How many times a tracked fingerprint ran across every window.
+
+        :param sql: the fingerprint
+        :return:
+        """
+        return self.counts.get(sql, 0)
@@ -0,0 +1,163 @@
+# std lib
+import json
+import os
+import re
+import tempfile
+
+# django
+from django.conf import settings
+
+# Most fingerprints kept per baseline, the ones that cost the least go first
+MAX_BASELINE_FINGERPRINTS = 200
+# Fingerprints whose smoothed count per session drops below this are forgotten
+MIN_BASELINE_COUNT = 0.01
+
+
+class FileBaselineStore(object):
+    """
+    Keeps each baseline in its own JSON file in a directory. Files are replaced atomically, so a reader never sees a
+    half written one, but concurrent updates from several processes can overwrite one another; with smoothed values
+    that only costs a session's worth of updates.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _filename(self, name):
+        return os.path.join(self.path, re.sub(r'[^\w.-]', '_', name) + '.json')
+
+    def load(self, name):
+        try:
+            with open(self._filename(name)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def save(self, name, data):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp, self._filename(name))
+
+
+class CacheBaselineStore(object):
+    """
+    Keeps each baseline in one of the configured Django caches, shared by every process using it.
+    """
+
+    def __init__(self, alias='default', timeout=30 * 24 * 3600):
+        try:
+            from django.core.cache import caches
+            self.cache = caches[alias]
+        except ImportError:  # Django < 1.7
+            from django.core.cache import get_cache
+            self.cache = get_cache(alias)
+        self.timeout = timeout
+
+    def load(self, name):
+        return self.cache.get('query_logger:baseline:%s' % name)
+
+    def save(self, name, data):
+        self.cache.set('query_logger:baseline:%s' % name, data, self.timeout)
+
+
+_store = None
+
+
+def get_baseline_store():
+    """
+    The baseline store: files in settings.LOG_QUERY_BASELINE_PATH if it is set, otherwise the
+    settings.LOG_QUERY_BASELINE_CACHE cache.
+
+    :return:
+    """
+    global _store
+    if _store is None:
+        path = getattr(settings, 'LOG_QUERY_BASELINE_PATH', None)
+        if path:
+            _store = FileBaselineStore(path)
+        else:
+            _store = CacheBaselineStore(getattr(settings, 'LOG_QUERY_BASELINE_CACHE', 'default'),
+                                        getattr(settings, 'LOG_QUERY_BASELINE_CACHE_TIMEOUT', 30 * 24 * 3600))
+    return _store
+
+
+class Regression(object):
+    """
+    How one session differed from its baseline: the fingerprints it ran that the baseline has never seen, and the
+    ones it ran noticeably more often or more slowly than usual.
+    """
+
+    def __init__(self, sessions):
+        self.sessions = sessions
+        self.new = []
+        # (sql, count this session, baseline count)
+        self.count = []
+        # (sql, median seconds this session, baseline median seconds)
+        self.time = []
+
+    def __bool__(self):
+        return bool(self.new or self.count or self.time)
+    __nonzero__ = __bool__
+
+
+def compare(baseline, aggregator, tolerance, min_time):
+    """
+    Compares a session against a baseline. A fingerprint regressed when it ran more than (1 + tolerance) times its
+    usual count, or its median time went over (1 + tolerance) times the usual one by at least min_time seconds.
+
+    :param baseline: baseline data, as returned by update
+    :param aggregator: the session's aggregator
+    :param tolerance:
+    :param min_time: seconds
+    :return: a Regression, which is falsy when nothing regressed
+    """
+    regression = Regression(baseline['sessions'])
+    queries = baseline['queries']
+    for entry in aggregator.stats.values():
+        known = queries.get(entry.sql)
+        if known is None:
+            regression.new.append(entry.sql)
+            continue
+        if entry.count > known['count'] * (1 + tolerance) and entry.count - known['count'] >= 1:
+            regression.count.append((entry.sql, entry.count, known['count']))
+        median = entry.histogram.percentile(50)
+        if median > known['time'] * (1 + tolerance) and median - known['time'] >= min_time:
+            regression.time.append((entry.sql, median, known['time']))
+    return regression
+
+
+def update(baseline, aggregator, alpha):
+    """
+    Folds a session into a baseline with exponential smoothing: every fingerprint's count per session and median time
+    move `alpha` of the way towards this session's, and fingerprints it didn't run fade out. New fingerprints start
+    out at this session's values, so they are only ever reported as new once.
+
+    :param baseline: baseline data, or None to start one
+    :param aggregator: the session's aggregator
+    :param alpha: 0 - 1, how much weight the latest session gets
+    :return: the updated baseline data, plain JSON
+    """
+    if baseline is None:
+        baseline = {'sessions': 0, 'queries': {}}
+    queries = baseline['queries']
+    for sql, known in list(queries.items()):
+        if sql not in aggregator.stats:
+            known['count'] *= 1 - alpha
+            if known['count'] < MIN_BASELINE_COUNT:
+                del queries[sql]
+    for entry in aggregator.stats.values():
+        median = entry.histogram.percentile(50)
+        known = queries.get(entry.sql)
+        if known is None:
+            queries[entry.sql] = {'count': entry.count, 'time': median}
+        else:
+            known['count'] += alpha * (entry.count - known['count'])
+            known['time'] += alpha * (median - known['time'])
+    if len(queries) > MAX_BASELINE_FINGERPRINTS:
+        ranked = sorted(queries.items(), key=lambda item: item[1]['count'] * item[1]['time'], reverse=True)
+        baseline['queries'] = queries = dict(ranked[:MAX_BASELINE_FINGERPRINTS])
+    baseline['sessions'] += 1
+    return baseline
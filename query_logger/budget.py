@@ -0,0 +1,211 @@
+# std lib
+from functools import wraps
+from logging import WARNING, getLogger
+
+# django
+from django.conf import settings
+
+# project
+from . import tracebacks
+from .config import DatabaseQueryLoggerMixinConfig
+from .fingerprint import fingerprint
+from .local import ContextStack
+from .mixin import DatabaseQueryLoggerMixin
+from .session import QueryLoggingSession
+
+logger = getLogger(__name__)
+
+RAISE = 'raise'
+LOG = 'log'
+
+# (QueryBudget, capture_queries) for every budget block entered in the current context, innermost last
+_entered = ContextStack('query_logger_budgets')
+
+
+class QueryBudgetExceeded(AssertionError):
+    """
+    Raised when a block runs over its query budget. An AssertionError, so test runners report it as a failure.
+    """
+
+
+class capture_queries(object):
+    """
+    Collects the queries run inside a block without logging anything, for code that wants the numbers rather than the
+    log records:
+
+        with capture_queries() as captured:
+            ...
+        captured.num_queries, captured.num_duplicates, captured.sql_time, captured.aggregator.stats
+
+    Takes the same options as start_query_logging.
+    """
+    QueryInfo = DatabaseQueryLoggerMixin.QueryInfo
+
+    def __init__(self, **config_opts):
+        config_opts.update(checkpoint_queries=None, checkpoint_seconds=None)
+        self.cfg = DatabaseQueryLoggerMixinConfig(**config_opts)
+        self.session = None
+        self.total_time = None
+
+    def __enter__(self):
+        self.session = QueryLoggingSession(self, self.cfg)
+        self.session.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.total_time = self.session.stop_capture()
+        self.session.close()
+        return False
+
+    @property
+    def aggregator(self):
+        return self.session.aggregator
+
+    @property
+    def num_queries(self):
+        return self.aggregator.num_queries
+
+    @property
+    def num_duplicates(self):
+        return self.aggregator.num_duplicates
+
+    @property
+    def sql_time(self):
+        return self.aggregator.sql_time
+
+
+class QueryBudget(object):
+    """
+    Limits on what a block of code may run: the number of queries, of duplicate executions, the SQL time in ms, and
+    per fingerprint execution counts (keyed by SQL, which is fingerprinted, so literal values don't matter).
+
+    Use it as a context manager or decorator around any block, or pass it as the `budget` option of
+    start_query_logging / query_logging. A block over budget raises QueryBudgetExceeded, or logs a querylog__budget
+    record, depending on `action` (settings.LOG_QUERY_BUDGET_ACTION, 'log' by default):
+
+        with QueryBudget(max_queries=5, max_duplicates=0, fingerprints={'SELECT ... FROM "shop_order" ...': 1}):
+            ...
+    """
+
+    def __init__(self, max_queries=None, max_duplicates=None, max_sql_time=None, fingerprints=None, action=None,
+                 name=None, **config_opts):
+        self.max_queries = max_queries
+        self.max_duplicates = max_duplicates
+        self.max_sql_time = max_sql_time
+        self.fingerprints = dict((fingerprint(sql), limit) for sql, limit in (fingerprints or {}).items())
+        self.action = action or getattr(settings, 'LOG_QUERY_BUDGET_ACTION', LOG)
+        self.name = name
+        self.config_opts = config_opts
+
+    def violations(self, aggregator, totals=None):
+        """
+        Everything over budget, as (what, actual, limit) tuples.
+
+        :param aggregator: the per fingerprint stats to check
+        :param totals: session wide totals, when they cover more than the aggregator does. They must track the
+                       fingerprints the budget limits.
+        :return:
+        """
+        totals = totals or aggregator
+        found = []
+        if self.max_queries is not None and totals.num_queries > self.max_queries:
+            found.append(('queries', totals.num_queries, self.max_queries))
+        if self.max_duplicates is not None and totals.num_duplicates > self.max_duplicates:
+            found.append(('duplicates', totals.num_duplicates, self.max_duplicates))
+        if self.max_sql_time is not None and totals.sql_time * 1000 > self.max_sql_time:
+            found.append(('SQL ms', round(totals.sql_time * 1000, 1), self.max_sql_time))
+        for sql, limit in sorted(self.fingerprints.items()):
+            count = totals.count(sql)
+            if count > limit:
+                found.append((sql, count, limit))
+        return found
+
+    def report(self, aggregator, violations):
+        """
+        A readable account of what went over budget and of every statement run, most executed first. Statements over
+        their own limit, or repeated when duplicates are over budget, are marked with a '!', along with where they
+        were first run from if tracebacks were captured.
+
+        :param aggregator:
+        :param violations:
+        :return:
+        """
+        lines = ['Query budget%s exceeded:' % (' for %s' % self.name if self.name else '')]
+        for what, actual, limit in violations:
+            lines.append('  %s: %s (limit %s)' % (what, actual, limit))
+        flagged = set(what for what, actual, limit in violations)
+        lines.append('Queries run:')
+        for entry in sorted(aggregator.stats.values(), key=lambda e: (-e.count, e.sql)):
+            mark = '!' if entry.sql in flagged or ('duplicates' in flagged and entry.count > 1) else ' '
+            lines.append('  %s %4dx  %7.1f ms  %s' % (mark, entry.count, entry.total_time * 1000, entry.sql))
+            if entry.tb and mark == '!':
+                lines.append('                        at %s' % tracebacks.format_site(entry.tb))
+        return '\n'.join(lines)
+
+    def enforce(self, aggregator, totals=None, log=None):
+        """
+        Raises or logs if the aggregator went over budget.
+
+        :param aggregator:
+        :param totals: session wide totals, when they cover more than the aggregator does
+        :param log: callable taking (level, msg, extra), the query_logger logger by default
+        :return: the violations
+        """
+        violations = self.violations(aggregator, totals)
+        if not violations:
+            return violations
+        report = self.report(aggregator, violations)
+        if self.action == RAISE:
+            raise QueryBudgetExceeded(report)
+        extra = {
+            'budget': self.name,
+            'violations': [{'what': what, 'actual': actual, 'limit': limit} for what, actual, limit in violations],
+            'logtype': 'querylog__budget'
+        }
+        if log is None:
+            logger.log(WARNING, '[SQL] ' + report, extra=extra)
+        else:
+            log(WARNING, '[SQL] ' + report, extra)
+        return violations
+
+    def __enter__(self):
+        captured = capture_queries(**self.config_opts)
+        _entered.push((self, captured))
+        captured.__enter__()
+        return captured
+
+    def __exit__(self, exc_type, exc_value, tb):
+        for entry in reversed(_entered.get()):
+            if entry[0] is self:
+                _entered.remove(entry)
+                captured = entry[1]
+                captured.__exit__(exc_type, exc_value, tb)
+                if exc_type is None:
+                    self.enforce(captured.aggregator)
+                break
+        return False
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+        return wrapper
+
+
+class QueryBudgetTestMixin(object):
+    """
+    TestCase mixin for asserting what a block of code runs:
+
+        class CheckoutTest(QueryBudgetTestMixin, TestCase):
+            def test_checkout(self):
+                with self.assertQueryBudget(max_queries=5, max_duplicates=0):
+                    self.client.post('/checkout/')
+
+    A block over budget fails the test with the report of every statement it ran.
+    """
+
+    def assertQueryBudget(self, max_queries=None, max_duplicates=None, max_sql_time=None, fingerprints=None,
+                          **config_opts):
+        config_opts.setdefault('log_tracebacks', True)
+        return QueryBudget(max_queries, max_duplicates, max_sql_time, fingerprints, action=RAISE, **config_opts)
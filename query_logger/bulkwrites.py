@@ -0,0 +1,134 @@
+# std lib
+import re
+
+# project
+from .nplusone import model_for_table
+
+# Enough of a fingerprinted write to tell which table it goes to, and for UPDATEs which columns it sets and what it
+# filters on
+INSERT_PATTERN = re.compile(r'^INSERT INTO [`"]?(\w+)[`"]? .*\bVALUES \(', re.IGNORECASE)
+UPDATE_PATTERN = re.compile(r'^UPDATE [`"]?(\w+)[`"]? SET (.*) WHERE (.*)$', re.IGNORECASE)
+SET_COLUMN_PATTERN = re.compile(r'(?:^|, )[`"]?(\w+)[`"]? = ')
+# A WHERE clause picking out a single row: one column compared to one value
+SINGLE_ROW_PATTERN = re.compile(r'^\(?(?:[`"]?\w+[`"]?\.)?[`"]?(\w+)[`"]? = \?\)?$')
+# Where the rows of a raw INSERT start
+VALUES_PATTERN = re.compile(r'\bVALUES\s*\(', re.IGNORECASE)
+
+
+def inserted_rows(sql):
+    """
+    The number of rows a raw, not yet fingerprinted, INSERT lists after VALUES. Fingerprinting folds them into one, so
+    this is the only point where a bulk_create batch can be told apart from a single row INSERT.
+
+    :param sql:
+    :return: the number of rows, or None if the statement is not an INSERT ... VALUES
+    """
+    if sql.lstrip()[:6].upper() != 'INSERT':
+        return None
+    match = VALUES_PATTERN.search(sql)
+    if not match:
+        return None
+    rows = 0
+    depth = 0
+    quote = None
+    for char in sql[match.end() - 1:]:
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in '\'"`':
+            quote = char
+        elif char == '(':
+            if not depth:
+                rows += 1
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif not depth and char not in ', \t\r\n':
+            # RETURNING, ON CONFLICT and the like
+            break
+    return rows
+
+
+def _field_names(model, columns):
+    names = dict((field.column, field.name) for field in model._meta.fields)
+    return [names.get(column, column) for column in columns]
+
+
+class BulkWrite(object):
+    """
+    One single row INSERT or UPDATE run over and over, that one bulk_create or bulk_update call could replace
+    """
+    __slots__ = ('sql', 'kind', 'count', 'rows', 'total_time', 'max_run', 'model', 'suggestion')
+
+    def __init__(self, entry, kind, model, suggestion):
+        self.sql = entry.sql
+        self.kind = kind
+        self.count = entry.count
+        # Every statement writes one row, fingerprints that ever wrote more are never reported
+        self.rows = entry.count
+        self.total_time = entry.total_time
+        self.max_run = entry.max_run
+        self.model = model
+        self.suggestion = suggestion
+
+
+def bulk_write(entry):
+    """
+    Works out whether a fingerprint is a single row write, and what would batch it.
+
+    :param entry: the fingerprint's stats
+    :return: a BulkWrite, or None
+    """
+    match = INSERT_PATTERN.match(entry.sql)
+    if match:
+        model = model_for_table(match.group(1))
+        if model is None:
+            return BulkWrite(entry, 'insert', None, 'one multi row INSERT')
+        return BulkWrite(entry, 'insert', model.__name__, '%s.objects.bulk_create(objs)' % model.__name__)
+
+    match = UPDATE_PATTERN.match(entry.sql)
+    if not match:
+        return None
+    lookup = SINGLE_ROW_PATTERN.match(match.group(3))
+    if not lookup:
+        return None
+    model = model_for_table(match.group(1))
+    if model is None:
+        return BulkWrite(entry, 'update', None, 'one UPDATE ... CASE')
+    if lookup.group(1) != model._meta.pk.column:
+        return None
+    fields = _field_names(model, SET_COLUMN_PATTERN.findall(match.group(2)))
+    return BulkWrite(entry, 'update', model.__name__, '%s.objects.bulk_update(objs, [%s])' % (
+        model.__name__, ', '.join("'%s'" % name for name in fields)))
+
+
+def find_bulk_writes(aggregator, threshold):
+    """
+    Finds every single row INSERT and UPDATE fingerprint run at least `threshold` times in a row, one statement at a
+    time. It takes a run rather than just as many executions in total, as only a loop can be turned into one bulk
+    call. Statements already sent through executemany are batched, and are left to find_batches. So are INSERTs that
+    ever listed more than one row, bulk_create already wrote those.
+
+    :param aggregator:
+    :param threshold:
+    :return: a list of BulkWrite, most expensive first
+    """
+    found = []
+    for entry in aggregator.stats.values():
+        if entry.max_run < threshold or entry.batches or entry.multi_row:
+            continue
+        candidate = bulk_write(entry)
+        if candidate is not None:
+            found.append(candidate)
+    return sorted(found, key=lambda b: b.total_time, reverse=True)
+
+
+def find_batches(aggregator):
+    """
+    Every fingerprint run through executemany.
+
+    :param aggregator:
+    :return: a list of fingerprint stats, most rows first
+    """
+    return sorted((entry for entry in aggregator.stats.values() if entry.batches),
+                  key=lambda e: e.batch_rows, reverse=True)
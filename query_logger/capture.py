@@ -0,0 +1,490 @@
+# std lib
+import time
+from logging import getLogger
+
+# django
+from django.db import connections
+
+# project
+from .local import ContextStack
+from .memo import MemoizedResult, is_read, memo_key
+
+# Monotonic high resolution clock where the platform has one, falling back on wall clock time for older Pythons
+timer = getattr(time, 'perf_counter', time.time)
+
+logger = getLogger(__name__)
+
+# The connection methods that hand out cursors. Anything else that talks to the database on the ORM's behalf goes
+# through one of these.
+CURSOR_FACTORIES = ('cursor', 'chunked_cursor')
+
+# What happens on a connection besides running statements
+CONNECT = 'connect'
+BEGIN = 'begin'
+COMMIT = 'commit'
+ROLLBACK = 'rollback'
+SAVEPOINT = 'savepoint'
+SAVEPOINT_COMMIT = 'savepoint_commit'
+SAVEPOINT_ROLLBACK = 'savepoint_rollback'
+CURSOR = 'cursor'
+
+# The connection methods timed as one of those, where the backend has them. Django < 1.6 has no connect(), it
+# connects on the first cursor instead.
+CONNECTION_METHODS = (
+    ('connect', CONNECT),
+    ('_start_transaction_under_autocommit', BEGIN),
+    ('_commit', COMMIT),
+    ('_rollback', ROLLBACK),
+    ('_savepoint', SAVEPOINT),
+    ('_savepoint_commit', SAVEPOINT_COMMIT),
+    ('_savepoint_rollback', SAVEPOINT_ROLLBACK),
+)
+# The ones that end a transaction without going through a cursor
+TRANSACTION_ENDS = (COMMIT, ROLLBACK)
+# Rows fetched at a time when buffering a SELECT's result to memoize it
+MEMO_FETCH_SIZE = 100
+
+
+class Replay(object):
+    """
+    A result being handed out from memory: all of a memoized one, or the first part of one that was buffered to be
+    memoized, in which case the rest (when there is `more`) still comes from the real cursor.
+    """
+    __slots__ = ('rows', 'pos', 'description', 'rowcount', 'more')
+
+    def __init__(self, rows, description, rowcount, more=False):
+        self.rows = rows
+        self.pos = 0
+        self.description = description
+        self.rowcount = rowcount
+        self.more = more
+
+
+class QueryCaptureCursorWrapper(object):
+    """
+    A thin proxy around whatever cursor Django would normally hand out (plain or debug). It times each execution and
+    streams the facts about it straight to the listeners registered on the connection, so nothing has to pile up in
+    connection.queries while a logging session is running.
+    """
+
+    def __init__(self, cursor, db):
+        self.cursor = cursor
+        self.db = db
+        # The statement the rows being fetched belong to, and how much of its result has been fetched so far
+        self.last_sql = None
+        self.fetched_rows = 0
+        self.fetched_bytes = 0
+        # Set while a result is being handed out from memory rather than from the cursor
+        self.replay = None
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    @property
+    def description(self):
+        if self.replay is not None:
+            return self.replay.description
+        return self.cursor.description
+
+    @property
+    def rowcount(self):
+        if self.replay is not None:
+            return self.replay.rowcount
+        return self.cursor.rowcount
+
+    def __iter__(self):
+        if self.replay is None and not _row_listeners.get():
+            return iter(self.cursor)
+        return self._iter_rows()
+
+    def _iter_rows(self):
+        replay = self.replay
+        if replay is not None:
+            while replay.pos < len(replay.rows):
+                row = replay.rows[replay.pos]
+                replay.pos += 1
+                if _row_listeners.get():
+                    notify_rows(self, (row,))
+                yield row
+            if not replay.more:
+                return
+        for row in self.cursor:
+            if _row_listeners.get():
+                notify_rows(self, (row,))
+            yield row
+
+    def _fetchone(self):
+        replay = self.replay
+        if replay is None:
+            return self.cursor.fetchone()
+        if replay.pos < len(replay.rows):
+            replay.pos += 1
+            return replay.rows[replay.pos - 1]
+        return self.cursor.fetchone() if replay.more else None
+
+    def _fetchmany(self, *args, **kwargs):
+        replay = self.replay
+        if replay is None:
+            return self.cursor.fetchmany(*args, **kwargs)
+        size = args[0] if args else kwargs.get('size', self.cursor.arraysize)
+        rows = replay.rows[replay.pos:replay.pos + size]
+        replay.pos += len(rows)
+        if len(rows) < size and replay.more:
+            rows.extend(self.cursor.fetchmany(size - len(rows)))
+        return rows
+
+    def _fetchall(self):
+        replay = self.replay
+        if replay is None:
+            return self.cursor.fetchall()
+        rows = replay.rows[replay.pos:]
+        replay.pos = len(replay.rows)
+        if replay.more:
+            rows.extend(self.cursor.fetchall())
+        return rows
+
+    def fetchone(self):
+        row = self._fetchone()
+        if row is not None and _row_listeners.get():
+            notify_rows(self, (row,))
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self._fetchmany(*args, **kwargs)
+        if rows and _row_listeners.get():
+            notify_rows(self, rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._fetchall()
+        if rows and _row_listeners.get():
+            notify_rows(self, rows)
+        return rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        exit_fn = getattr(self.cursor, '__exit__', None)
+        if exit_fn is not None:
+            return exit_fn(exc_type, exc_value, tb)
+        self.cursor.close()
+
+    def execute(self, sql, *args, **kwargs):
+        self.last_sql = sql
+        self.fetched_rows = self.fetched_bytes = 0
+        self.replay = None
+        params = args[0] if args else kwargs.get('params')
+        memo = current_memo(self.db) if _memos.get() else None
+        key = None
+        if memo is not None:
+            if not is_read(sql):
+                invalidate(self.db)
+            else:
+                key = memo_key(sql, params)
+                result = memo.get(key) if key is not None else None
+                if result is not None:
+                    self.replay = Replay(result.rows, result.description, result.rowcount)
+                    return self
+        start = timer()
+        try:
+            returned = self.cursor.execute(sql, *args, **kwargs)
+        finally:
+            duration = timer() - start
+            notify(self.db, sql, duration, params)
+        if key is not None:
+            self.replay = self._buffer(memo, key, duration)
+        return returned
+
+    def _buffer(self, memo, key, duration):
+        """
+        Reads a SELECT's result into memory to memoize it. A result too big for the memo is left with what was read
+        so far, and the rest of it is fetched from the cursor as usual.
+        """
+        description = self.cursor.description
+        rowcount = self.cursor.rowcount
+        rows = []
+        size = 0
+        while True:
+            chunk = self.cursor.fetchmany(MEMO_FETCH_SIZE)
+            if not chunk:
+                break
+            rows.extend(chunk)
+            for row in chunk:
+                size += row_size(row)
+            if not memo.fits(len(rows), size):
+                return Replay(rows, description, rowcount, more=True)
+        memo.put(key, MemoizedResult(rows, description, rowcount, duration, size))
+        return Replay(rows, description, rowcount)
+
+    def executemany(self, sql, param_list, *args, **kwargs):
+        self.last_sql = sql
+        self.fetched_rows = self.fetched_bytes = 0
+        self.replay = None
+        if _memos.get():
+            invalidate(self.db)
+        batch = len(param_list) if hasattr(param_list, '__len__') else None
+        if batch is None:
+            param_list = CountingIterator(param_list)
+        start = timer()
+        try:
+            return self.cursor.executemany(sql, param_list, *args, **kwargs)
+        finally:
+            # The parameters of a batch are not the parameters of any one statement
+            notify(self.db, sql, timer() - start, None, param_list.count if batch is None else batch)
+
+
+class CountingIterator(object):
+    """
+    Counts the parameter sets handed to executemany as a generator, without holding on to them.
+    """
+
+    def __init__(self, iterable):
+        self.iterator = iter(iterable)
+        self.count = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = next(self.iterator)
+        self.count += 1
+        return item
+    next = __next__
+
+
+# The (alias, listener) pairs registered in the current context. Keeping these per context rather than on the
+# connection means a session only ever hears about the queries run by its own thread or asyncio task.
+_listeners = ContextStack('query_logger_listeners')
+# The same for the listeners that want to hear about the rows fetched too
+_row_listeners = ContextStack('query_logger_row_listeners')
+# And the (alias, QueryMemo) pairs of the sessions memoizing SELECTs
+_memos = ContextStack('query_logger_memos')
+# And the listeners that want to hear about connection events
+_event_listeners = ContextStack('query_logger_event_listeners')
+
+# Values whose size is their length, everything else is counted as a fixed size
+_SIZED_TYPES = (bytes, bytearray, type(u''), str, memoryview)
+FIXED_VALUE_SIZE = 8
+
+
+def row_size(row):
+    """
+    A rough estimate of the bytes a row takes on the wire: the length of every string or binary value and a fixed
+    size for everything else.
+
+    :param row:
+    :return:
+    """
+    size = 0
+    for value in row:
+        if isinstance(value, _SIZED_TYPES):
+            size += len(value)
+        elif value is not None:
+            size += FIXED_VALUE_SIZE
+    return size
+
+
+def notify(db, sql, duration, params=None, batch=None):
+    """
+    Hands a finished execution over to every listener registered on the connection in the current context. Listeners
+    run inside the application's own database calls, so whatever goes wrong in one is logged rather than raised: a
+    checkpoint that fails to write its profile must not fail the query that triggered it.
+
+    :param db:
+    :param sql:
+    :param duration: seconds
+    :param params: the parameters it ran with, None for executemany
+    :param batch: the number of parameter sets executemany ran with, None for execute
+    :return:
+    """
+    for alias, listener in _listeners.get():
+        if alias == db.alias:
+            try:
+                listener(alias, sql, duration, params, batch)
+            except Exception:
+                logger.exception('[SQL] query listener failed')
+
+
+def notify_rows(cursor, rows):
+    """
+    Hands the rows just fetched from a cursor over to every row listener registered on its connection in the current
+    context, along with the running totals for the statement they belong to. Listener errors are logged, as in notify.
+
+    :param cursor: the capturing cursor
+    :param rows:
+    :return:
+    """
+    if cursor.last_sql is None:
+        return
+    num_rows = len(rows)
+    num_bytes = 0
+    for row in rows:
+        num_bytes += row_size(row)
+    cursor.fetched_rows += num_rows
+    cursor.fetched_bytes += num_bytes
+    db_alias = cursor.db.alias
+    for alias, listener in _row_listeners.get():
+        if alias == db_alias:
+            try:
+                listener(alias, cursor.last_sql, num_rows, num_bytes, cursor.fetched_rows, cursor.fetched_bytes)
+            except Exception:
+                logger.exception('[SQL] row listener failed')
+
+
+def current_memo(db):
+    """
+    The memo of the innermost session memoizing the connection's SELECTs in the current context.
+
+    :param db:
+    :return:
+    """
+    for alias, memo in reversed(_memos.get()):
+        if alias == db.alias:
+            return memo
+
+
+def invalidate(db):
+    """
+    Empties every memo of the connection in the current context, after it wrote or ended a transaction.
+
+    :param db:
+    :return:
+    """
+    for alias, memo in _memos.get():
+        if alias == db.alias:
+            memo.invalidate()
+
+
+def notify_event(db, event, duration):
+    """
+    Hands a connection event (connecting, a commit, a savepoint...) over to every event listener registered on the
+    connection in the current context. Listener errors are logged, as in notify.
+
+    :param db:
+    :param event: one of CONNECT, BEGIN, COMMIT, ROLLBACK, SAVEPOINT, SAVEPOINT_COMMIT, SAVEPOINT_ROLLBACK or CURSOR
+    :param duration: seconds
+    :return:
+    """
+    for alias, listener in _event_listeners.get():
+        if alias == db.alias:
+            try:
+                listener(alias, event, duration)
+            except Exception:
+                logger.exception('[SQL] connection event listener failed')
+
+
+def _wrap_factory(db, name):
+    real_factory = getattr(type(db), name)
+    connects = hasattr(type(db), 'connect')
+
+    def factory(*args, **kwargs):
+        connected = db.connection is not None
+        start = timer()
+        cursor = real_factory(db, *args, **kwargs)
+        if isinstance(cursor, QueryCaptureCursorWrapper):
+            # Django's own chunked_cursor() is just self.cursor(), already captured
+            return cursor
+        if connected:
+            notify_event(db, CURSOR, timer() - start)
+        elif not connects:
+            notify_event(db, CONNECT, timer() - start)
+        return QueryCaptureCursorWrapper(cursor, db)
+
+    return factory
+
+
+def _wrap_connection_method(db, name, event):
+    real_method = getattr(type(db), name)
+
+    def method(*args, **kwargs):
+        start = timer()
+        try:
+            return real_method(db, *args, **kwargs)
+        finally:
+            notify_event(db, event, timer() - start)
+            if event in TRANSACTION_ENDS and _memos.get():
+                invalidate(db)
+
+    return method
+
+
+def _wrap_set_autocommit(db):
+    # PostgreSQL and MySQL begin a transaction by turning autocommit off, no BEGIN goes through a cursor. Turning it
+    # off is timed as a BEGIN, turning it back on is left alone.
+    real_method = type(db)._set_autocommit
+
+    def method(autocommit, *args, **kwargs):
+        start = timer()
+        try:
+            return real_method(db, autocommit, *args, **kwargs)
+        finally:
+            if not autocommit:
+                notify_event(db, BEGIN, timer() - start)
+                if _memos.get():
+                    invalidate(db)
+
+    return method
+
+
+def install(con_name, listener, row_listener=None, memo=None, event_listener=None):
+    """
+    Registers a listener on a connection for the current context. The connection's cursor factories are swapped (on
+    the connection object only, never the class) for ones that return capturing cursors when the first listener for
+    it arrives, and are reference counted from there, so connections nobody is logging pay nothing at all. Its
+    connect, transaction and savepoint methods are swapped for timed ones the same way.
+
+    :param con_name:
+    :param listener: callable taking (alias, sql, duration, params, batch), or None to only memoize
+    :param row_listener: optional callable taking (alias, sql, rows, bytes, statement rows, statement bytes), called
+                         as rows are fetched. Fetches are only counted while there is a row listener in the context.
+    :param memo: optional QueryMemo to serve repeated SELECTs from
+    :param event_listener: optional callable taking (alias, event, duration), called when the connection connects,
+                           creates a cursor, or begins, commits or rolls back a transaction or savepoint
+    :return: a handle to pass to uninstall
+    """
+    db = connections[con_name]
+    refcount = db.__dict__.get('_query_logger_refcount', 0)
+    if not refcount:
+        for name in CURSOR_FACTORIES:
+            if hasattr(type(db), name):
+                setattr(db, name, _wrap_factory(db, name))
+        for name, event in CONNECTION_METHODS:
+            if hasattr(type(db), name):
+                setattr(db, name, _wrap_connection_method(db, name, event))
+        if hasattr(type(db), '_set_autocommit'):
+            db._set_autocommit = _wrap_set_autocommit(db)
+    db._query_logger_refcount = refcount + 1
+
+    entries = []
+    for stack, value in ((_listeners, listener), (_row_listeners, row_listener), (_memos, memo),
+                         (_event_listeners, event_listener)):
+        if value is not None:
+            entry = (db.alias, value)
+            stack.push(entry)
+            entries.append((stack, entry))
+    return db, entries
+
+
+def uninstall(handle):
+    """
+    Removes a listener registered by install, restoring the connection's own cursor factories and methods when nobody
+    is left listening to it.
+
+    :param handle: the value install returned
+    :return:
+    """
+    db, entries = handle
+    for stack, entry in entries:
+        stack.remove(entry)
+
+    refcount = db.__dict__.get('_query_logger_refcount', 0) - 1
+    if refcount > 0:
+        db._query_logger_refcount = refcount
+        return
+    db.__dict__.pop('_query_logger_refcount', None)
+    for name in CURSOR_FACTORIES:
+        db.__dict__.pop(name, None)
+    for name, event in CONNECTION_METHODS:
+        db.__dict__.pop(name, None)
+    db.__dict__.pop('_set_autocommit', None)
@@ -1,8 +1,21 @@
 from django.conf import settings
+from django.db import connections
 from logging import getLogger
 
 logger = getLogger(__name__)
 
+# Pass this as the connection name to log every configured database connection in one session
+ALL_CONNECTIONS = '__all__'
+
+
+def logging_enabled():
+    """
+    The global switch, settings.LOG_QUERY_ENABLED. Every entry point checks it before doing anything else.
+
+    :return:
+    """
+    return getattr(settings, 'LOG_QUERY_ENABLED', True)
+
 
 class DatabaseQueryLoggerMixinConfig(object):
     """
@@ -16,11 +29,124 @@ class DatabaseQueryLoggerMixinConfig(object):
                                                 getattr(settings, 'LOG_QUERY_DUPLICATE_QUERIES', True))
         self.log_tracebacks = kwargs.get('log_tracebacks',
                                          getattr(settings, 'LOG_QUERY_TRACEBACKS', False))
+        self.log_traceback_depth = kwargs.get('log_traceback_depth',
+                                              getattr(settings, 'LOG_QUERY_TRACEBACK_DEPTH', 10))
         self.log_long_running_time = kwargs.get('log_long_running_time',
                                                 getattr(settings, 'LOG_QUERY_TIME_ABSOLUTE_LIMIT', 1000))
 
+        # Run EXPLAIN on the first slow execution of each SELECT and include the plan in the long running query record
+        self.explain_slow_queries = kwargs.get('explain_slow_queries',
+                                               getattr(settings, 'LOG_QUERY_EXPLAIN', False))
+
+        # Count the rows every query fetches and estimate their size. Executions fetching at least large_result_rows
+        # rows or large_result_bytes bytes are reported as large results.
+        self.count_rows = kwargs.get('count_rows',
+                                     getattr(settings, 'LOG_QUERY_COUNT_ROWS', False))
+        self.large_result_rows = kwargs.get('large_result_rows',
+                                            getattr(settings, 'LOG_QUERY_LARGE_RESULT_ROWS', 10000))
+        self.large_result_bytes = kwargs.get('large_result_bytes',
+                                             getattr(settings, 'LOG_QUERY_LARGE_RESULT_BYTES', 10 * 1024 * 1024))
+
+        # N+1 detection: a SELECT issued this many times from the same line of code is reported as an N+1 query
+        self.detect_nplusone = kwargs.get('detect_nplusone',
+                                          getattr(settings, 'LOG_QUERY_DETECT_NPLUSONE', False))
+        self.nplusone_threshold = kwargs.get('nplusone_threshold',
+                                             getattr(settings, 'LOG_QUERY_NPLUSONE_THRESHOLD', 3))
+
+        # Report loops of single row INSERTs and UPDATEs to one table as bulk_create / bulk_update candidates, along
+        # with the batch sizes executemany was called with
+        self.detect_bulk_writes = kwargs.get('detect_bulk_writes',
+                                             getattr(settings, 'LOG_QUERY_DETECT_BULK_WRITES', False))
+        self.bulk_write_threshold = kwargs.get('bulk_write_threshold',
+                                               getattr(settings, 'LOG_QUERY_BULK_WRITE_THRESHOLD', 10))
+
+        # Checkpoints: report on and release what has been captured so far every this many queries and / or seconds,
+        # keeping only running totals for the final summary
+        self.checkpoint_queries = kwargs.get('checkpoint_queries',
+                                             getattr(settings, 'LOG_QUERY_CHECKPOINT_QUERIES', None))
+        self.checkpoint_seconds = kwargs.get('checkpoint_seconds',
+                                             getattr(settings, 'LOG_QUERY_CHECKPOINT_SECONDS', None))
+
+        # Sampling. Sessions that are not sampled only watch for long running queries, and only when
+        # log_unsampled_long_running is on.
+        self.sample_rate = kwargs.get('sample_rate',
+                                      getattr(settings, 'LOG_QUERY_SAMPLE_RATE', 1.0))
+        self.sample_rate_limit = kwargs.get('sample_rate_limit',
+                                            getattr(settings, 'LOG_QUERY_SAMPLE_RATE_LIMIT', None))
+        self.class_sample_rates = kwargs.get('class_sample_rates',
+                                             getattr(settings, 'LOG_QUERY_CLASS_SAMPLE_RATES', {}))
+        self.log_unsampled_long_running = kwargs.get('log_unsampled_long_running',
+                                                     getattr(settings, 'LOG_QUERY_UNSAMPLED_LONG_RUNNING', True))
+
+        # Merge every sampled session into the process wide rolling stats store
+        self.rolling_stats = kwargs.get('rolling_stats',
+                                        getattr(settings, 'LOG_QUERY_ROLLING_STATS', False))
+
+        # Append a profile of every sampled session (or checkpoint window) to this file, in 'jsonl' or 'binary' format,
+        # for the query_profile_report command to analyze later
+        self.profile_path = kwargs.get('profile_path',
+                                       getattr(settings, 'LOG_QUERY_PROFILE_PATH', None))
+        self.profile_format = kwargs.get('profile_format',
+                                         getattr(settings, 'LOG_QUERY_PROFILE_FORMAT', 'jsonl'))
+
+        # Add every sampled session (or checkpoint window) to this process' counters in settings.LOG_QUERY_METRICS_DIR,
+        # which the query_metrics view and command merge across processes
+        self.metrics = kwargs.get('metrics',
+                                  getattr(settings, 'LOG_QUERY_METRICS', False))
+
+        # Hand the session's log records to a background thread instead of logging them on the calling thread
+        self.async_logging = kwargs.get('async_logging',
+                                        getattr(settings, 'LOG_QUERY_ASYNC', False))
+
+        # Compare every session against a smoothed baseline of earlier sessions by the same class, and report
+        # regressions in one record instead of logging the duplicate and N+1 queries
+        self.baseline = kwargs.get('baseline',
+                                   getattr(settings, 'LOG_QUERY_BASELINE', False))
+        self.baseline_alpha = kwargs.get('baseline_alpha',
+                                         getattr(settings, 'LOG_QUERY_BASELINE_ALPHA', 0.1))
+        self.baseline_tolerance = kwargs.get('baseline_tolerance',
+                                             getattr(settings, 'LOG_QUERY_BASELINE_TOLERANCE', 1.0))
+        self.baseline_min_sessions = kwargs.get('baseline_min_sessions',
+                                                getattr(settings, 'LOG_QUERY_BASELINE_MIN_SESSIONS', 5))
+        self.baseline_min_time = kwargs.get('baseline_min_time',
+                                            getattr(settings, 'LOG_QUERY_BASELINE_MIN_TIME', 1))
+
+        # Serve exact repeats of a SELECT (same SQL, same params) from a cache kept for the session, up to
+        # memo_max_rows rows and memo_max_bytes bytes. Any write, commit or rollback on the connection empties it.
+        self.memoize_selects = kwargs.get('memoize_selects',
+                                          getattr(settings, 'LOG_QUERY_MEMOIZE_SELECTS', False))
+        self.memo_max_rows = kwargs.get('memo_max_rows',
+                                        getattr(settings, 'LOG_QUERY_MEMO_MAX_ROWS', 10000))
+        self.memo_max_bytes = kwargs.get('memo_max_bytes',
+                                         getattr(settings, 'LOG_QUERY_MEMO_MAX_BYTES', 10 * 1024 * 1024))
+
+        # Record when every query ran and put the Python time between queries down to call sites, for the summary
+        # and, when timeline_path is set, a Chrome trace file per session in that directory
+        self.timeline = kwargs.get('timeline',
+                                   getattr(settings, 'LOG_QUERY_TIMELINE', False))
+        self.timeline_path = kwargs.get('timeline_path',
+                                        getattr(settings, 'LOG_QUERY_TIMELINE_PATH', None))
+        self.timeline_max_events = kwargs.get('timeline_max_events',
+                                              getattr(settings, 'LOG_QUERY_TIMELINE_MAX_EVENTS', 10000))
+
+        # A QueryBudget the session is checked against when it stops
+        self.budget = kwargs.get('budget', None)
+
         self.logging_extras = kwargs.get('logging_extra_dict', {})
 
         # This is for internal testing only. If you add unit tests yourself for the query debbuging mixin, then you can
         # define a settings.TESTING variable that is True when unit tests are running.
         self.testing = getattr(settings, 'TESTING', False)
+
+    @property
+    def connection_names(self):
+        """
+        The configured connection aliases that actually exist. connection_name can be a single alias, a list of
+        aliases or ALL_CONNECTIONS.
+        """
+        names = self.connection_name
+        if names == ALL_CONNECTIONS:
+            return list(connections)
+        if isinstance(names, str) or not hasattr(names, '__iter__'):
+            names = [names]
+        return [name for name in names if name in connections]
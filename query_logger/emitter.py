@@ -0,0 +1,140 @@
+# std lib
+import atexit
+import os
+import sys
+import threading
+from logging import getLogger
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+# django
+from django.conf import settings
+
+logger = getLogger(__name__)
+
+
+class QueuedEmitter(object):
+    """
+    Hands log records over to a background thread so the request only pays for an enqueue. Records are built on the
+    request thread by `defer` and only handed to their logger's handlers by the worker, the way
+    logging.handlers.QueueHandler does, so their time and thread are the request's. Each session's records are
+    queued as one batch; when the bounded queue is full the batch is dropped and counted rather than blocking the
+    request, and whatever is still queued is flushed at process exit.
+    """
+
+    def __init__(self, maxsize=1000, flush_timeout=5):
+        self.maxsize = maxsize
+        self.flush_timeout = flush_timeout
+        self.dropped = 0
+        self._reported_dropped = 0
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_worker(self):
+        # The worker thread does not survive a fork, so a pre-forking server's workers each start their own
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(self.maxsize)
+                self._thread = threading.Thread(target=self._run, name='query-logger-emitter')
+                self._thread.daemon = True
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def submit(self, records):
+        """
+        Queues a batch of (logger, LogRecord) pairs built by `defer`.
+
+        :param records:
+        :return: False if the batch was dropped
+        """
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait(records)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def _run(self):
+        q = self._queue
+        while True:
+            records = q.get()
+            try:
+                if records is None:
+                    return
+                self._emit(records)
+            finally:
+                q.task_done()
+
+    def _emit(self, records):
+        dropped = self.dropped - self._reported_dropped
+        if dropped:
+            logger.warning('[SQL] dropped %d query log batches, the queue was full' % dropped,
+                           extra={'num': dropped, 'logtype': 'querylog__dropped'})
+            self._reported_dropped += dropped
+        for record_logger, record in records:
+            try:
+                record_logger.handle(record)
+            except Exception:
+                logger.exception('[SQL] failed to emit a query log record')
+
+    def flush(self):
+        """
+        Stops the worker once everything queued so far has been logged, waiting at most flush_timeout seconds.
+
+        :return:
+        """
+        if self._pid != os.getpid() or not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(None, timeout=self.flush_timeout)
+        except queue.Full:
+            return
+        self._thread.join(self.flush_timeout)
+        self._pid = None
+
+
+def defer(records, record_logger, level, msg, extra):
+    """
+    Builds a log record right away and appends it to records for the emitter to hand to the logger's handlers later.
+    The record's caller is the function calling defer, as it would be for record_logger.log.
+
+    :param records: the batch to append to
+    :param record_logger:
+    :param level:
+    :param msg:
+    :param extra:
+    :return:
+    """
+    if not record_logger.isEnabledFor(level):
+        return
+    caller = sys._getframe(1)
+    records.append((record_logger, record_logger.makeRecord(
+        record_logger.name, level, caller.f_code.co_filename, caller.f_lineno, msg, (), None, caller.f_code.co_name,
+        extra)))
+
+
+_emitter = None
+_emitter_lock = threading.Lock()
+
+
+def get_emitter():
+    """
+    The process wide emitter, sized by settings.LOG_QUERY_ASYNC_QUEUE_SIZE and flushed at exit.
+
+    :return:
+    """
+    global _emitter
+    if _emitter is None:
+        with _emitter_lock:
+            if _emitter is None:
+                _emitter = QueuedEmitter(getattr(settings, 'LOG_QUERY_ASYNC_QUEUE_SIZE', 1000))
+                atexit.register(_emitter.flush)
+    return _emitter
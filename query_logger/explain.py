@@ -0,0 +1,165 @@
+# std lib
+import sys
+import threading
+import time
+from collections import OrderedDict
+from logging import getLogger
+
+# django
+from django.conf import settings
+from django.db import connections
+
+logger = getLogger(__name__)
+
+# How each backend is asked for a plan. Backends not listed here are never explained.
+EXPLAIN_PREFIXES = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'postgresql': 'EXPLAIN ',
+    'mysql': 'EXPLAIN ',
+}
+
+
+class QueryPlan(object):
+    """
+    The plan of one statement, as text, along with whether it reads a whole table or sorts into a temporary structure
+    """
+    __slots__ = ('text', 'full_scan', 'temp_sort')
+
+    def __init__(self, text, full_scan=False, temp_sort=False):
+        self.text = text
+        self.full_scan = full_scan
+        self.temp_sort = temp_sort
+
+    @property
+    def flags(self):
+        return [flag for flag, on in (('full scan', self.full_scan), ('temp sort', self.temp_sort)) if on]
+
+
+def _sqlite_plan(cursor):
+    # (id, parent, notused, detail) rows, e.g. "SCAN TABLE testapp_author" or "USE TEMP B-TREE FOR ORDER BY"
+    lines = [str(row[-1]) for row in cursor.fetchall()]
+    return QueryPlan('\n'.join(lines),
+                     full_scan=any(line.startswith('SCAN ') and ' USING ' not in line for line in lines),
+                     temp_sort=any(line.startswith('USE TEMP B-TREE') for line in lines))
+
+
+def _postgresql_plan(cursor):
+    lines = [row[0] for row in cursor.fetchall()]
+    return QueryPlan('\n'.join(lines),
+                     full_scan=any('Seq Scan' in line for line in lines),
+                     temp_sort=any(line.lstrip(' ->').startswith(('Sort', 'Incremental Sort')) for line in lines))
+
+
+def _mysql_plan(cursor):
+    columns = [col[0] for col in cursor.description]
+    rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+    return QueryPlan('\n'.join(', '.join('%s=%s' % (col, row[col]) for col in columns) for row in rows),
+                     full_scan=any(row.get('type') == 'ALL' for row in rows),
+                     temp_sort=any('Using temporary' in (row.get('Extra') or '') or
+                                   'Using filesort' in (row.get('Extra') or '') for row in rows))
+
+
+PLAN_READERS = {
+    'sqlite': _sqlite_plan,
+    'postgresql': _postgresql_plan,
+    'mysql': _mysql_plan,
+}
+
+
+class PlanCache(object):
+    """
+    A bounded least recently used cache of fingerprint to plan, where plans also expire after `ttl` seconds so a
+    statement is explained again once in a while as the data and indexes change.
+    """
+
+    def __init__(self, maxsize=256, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, key, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            item = self._cache.pop(key, None)
+            if item is None or (self.ttl and now - item[0] > self.ttl):
+                return None
+            self._cache[key] = item
+            return item[1]
+
+    def set(self, key, plan, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            self._cache.pop(key, None)
+            while len(self._cache) >= self.maxsize:
+                self._cache.popitem(last=False)
+            self._cache[key] = (now, plan)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+_plan_cache = None
+
+
+def get_plan_cache():
+    """
+    The process wide plan cache, sized by settings.LOG_QUERY_EXPLAIN_CACHE_SIZE and expiring plans after
+    settings.LOG_QUERY_EXPLAIN_CACHE_TTL seconds.
+
+    :return:
+    """
+    global _plan_cache
+    if _plan_cache is None:
+        _plan_cache = PlanCache(getattr(settings, 'LOG_QUERY_EXPLAIN_CACHE_SIZE', 256),
+                                getattr(settings, 'LOG_QUERY_EXPLAIN_CACHE_TTL', 3600))
+    return _plan_cache
+
+
+def explain(alias, fp, sql, params):
+    """
+    The plan for a statement, from the cache if this fingerprint was explained recently, otherwise by running the
+    backend's EXPLAIN on the original SQL and params. Only SELECTs are explained: plain EXPLAIN never runs the
+    statement, but there is no point in risking it for anything that writes.
+
+    The EXPLAIN goes through a bare backend cursor, so it is neither captured by the logger nor added to
+    connection.queries, and a statement that cannot be explained is simply left without a plan.
+
+    :param alias: the connection the statement ran on
+    :param fp: its fingerprint
+    :param sql: the SQL as it was run
+    :param params:
+    :return: a QueryPlan, or None
+    """
+    db = connections[alias]
+    reader = PLAN_READERS.get(db.vendor)
+    if reader is None or not fp.upper().startswith(('SELECT', 'WITH')):
+        return None
+    if db.vendor == 'sqlite' and sys.version_info < (3, 6):
+        # Before 3.6 the sqlite3 module commits the open transaction ahead of any statement it doesn't recognize
+        return None
+    cache = get_plan_cache()
+    key = (alias, fp)
+    plan = cache.get(key)
+    if plan is not None:
+        return plan
+
+    try:
+        cursor = db._cursor()
+        try:
+            if params is None:
+                cursor.execute(EXPLAIN_PREFIXES[db.vendor] + sql)
+            else:
+                cursor.execute(EXPLAIN_PREFIXES[db.vendor] + sql, params)
+            plan = reader(cursor)
+        finally:
+            cursor.close()
+    except Exception:
+        logger.debug('[SQL] could not explain %s' % fp, exc_info=True)
+        plan = QueryPlan(None)
+    cache.set(key, plan)
+    return plan
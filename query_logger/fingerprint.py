@@ -0,0 +1,113 @@
+# std lib
+import re
+from collections import OrderedDict
+
+# django
+from django.conf import settings
+
+# Scanner for the parts of a statement that matter when fingerprinting. Order matters: comments and quoted
+# identifiers are matched before literals so that digits inside "table_2" or a comment never get rewritten, and words
+# are matched before numbers so identifiers like t1 stay intact.
+TOKEN_PATTERN = re.compile(r"""
+    (?P<comment>/\*.*?\*/|--[^\n]*)
+  | (?P<ident>"(?:[^"]|"")*"|`(?:[^`]|``)*`)
+  | (?P<string>[nNeEbBxX]?'(?:[^'\\]|''|\\.)*')
+  | (?P<uuid>\b[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\b)
+  | (?P<param>%\([^)]+\)s|%s|\$\d+|\?|(?<![:\w]):[A-Za-z_]\w*)
+  | (?P<word>[A-Za-z_][\w$]*)
+  | (?P<number>0[xX][0-9a-fA-F]+|(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+  | (?P<space>\s+)
+""", re.VERBOSE | re.DOTALL)
+
+LITERAL_GROUPS = frozenset(('string', 'uuid', 'param', 'number'))
+
+# Once literals are gone, these collapse the things whose length varies from one call to the next: signed literals,
+# IN (?, ?, ...) lists and multi-row VALUES (...), (...) lists.
+SIGNED_LITERAL_PATTERN = re.compile(r'([=<>(,]|\bAND|\bOR|\bBETWEEN|\bTHEN|\bELSE) ?- ?\?', re.IGNORECASE)
+LIST_PATTERN = re.compile(r'\( ?\?(?: ?, ?\?)* ?\)')
+ROWS_PATTERN = re.compile(r'\(\.\.\.\)(?: ?, ?\(\.\.\.\))+')
+SPACE_PATTERN = re.compile(r' {2,}')
+# Savepoint names are generated and never repeat on a connection (Django uses "s<thread id>_x<n>"), so they count as
+# literals too
+SAVEPOINT_PATTERN = re.compile(r'^(SAVEPOINT|RELEASE(?: SAVEPOINT)?|ROLLBACK TO(?: SAVEPOINT)?) '
+                               r'(?:"(?:[^"]|"")*"|`(?:[^`]|``)*`|\w+)', re.IGNORECASE)
+
+
+def _replace_token(match):
+    kind = match.lastgroup
+    if kind in LITERAL_GROUPS:
+        return '?'
+    if kind == 'space' or kind == 'comment':
+        return ' '
+    return match.group()
+
+
+def normalize(sql):
+    """
+    Reduces a SQL statement to its fingerprint. Every literal and placeholder becomes ?, variable length lists become
+    (...), savepoint names become ?, comments are dropped and whitespace is collapsed, so every execution of the same
+    ORM call maps onto the same fingerprint whatever values it ran with.
+
+    :param sql:
+    :return:
+    """
+    fp = SPACE_PATTERN.sub(' ', TOKEN_PATTERN.sub(_replace_token, sql)).strip()
+    fp = SAVEPOINT_PATTERN.sub(r'\1 ?', fp)
+    fp = SIGNED_LITERAL_PATTERN.sub(r'\1 ?', fp)
+    fp = LIST_PATTERN.sub('(...)', fp)
+    return ROWS_PATTERN.sub('(...)', fp)
+
+
+class FingerprintCache(object):
+    """
+    A bounded least recently used cache of raw SQL to fingerprint. Most applications run the same few hundred
+    statements over and over again, so once it is warm a fingerprint costs a single dict lookup.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __call__(self, sql):
+        cache = self._cache
+        try:
+            fp = cache.pop(sql)
+        except KeyError:
+            self.misses += 1
+            fp = normalize(sql)
+            if len(cache) >= self.maxsize:
+                try:
+                    cache.popitem(last=False)
+                except KeyError:    # Another thread emptied it first
+                    pass
+        else:
+            self.hits += 1
+        cache[sql] = fp
+        return fp
+
+    def clear(self):
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+_default_cache = None
+
+
+def fingerprint(sql):
+    """
+    Returns the fingerprint of a SQL statement through the process wide cache, sized by
+    settings.LOG_QUERY_FINGERPRINT_CACHE_SIZE.
+
+    :param sql:
+    :return:
+    """
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = FingerprintCache(getattr(settings, 'LOG_QUERY_FINGERPRINT_CACHE_SIZE', 1024))
+    return _default_cache(sql)
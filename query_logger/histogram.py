@@ -0,0 +1,100 @@
+# std lib
+import math
+from array import array
+
+# Sub-buckets per power of two. Eight keeps every bucket within ~6% of the values recorded in it.
+SUB_BUCKETS = 8
+
+
+def bucket_index(seconds):
+    """
+    The bucket a duration falls into. Durations are bucketed in microseconds on a log scale, power of two ranges split
+    into SUB_BUCKETS linear sub-buckets, which is what HDR histograms do too.
+
+    :param seconds:
+    :return:
+    """
+    us = seconds * 1000000
+    if us < 1:
+        return 0
+    mantissa, exponent = math.frexp(us)
+    return exponent * SUB_BUCKETS + int((mantissa - 0.5) * 2 * SUB_BUCKETS)
+
+
+def bucket_upper_bound(index):
+    """
+    The largest duration, in seconds, that lands in a bucket.
+
+    :param index:
+    :return:
+    """
+    if index < SUB_BUCKETS:
+        return 0.000001
+    exponent, sub = divmod(index, SUB_BUCKETS)
+    return math.ldexp(0.5 + (sub + 1) / (2.0 * SUB_BUCKETS), exponent) / 1000000
+
+
+class LatencyHistogram(object):
+    """
+    Compact log bucketed latency histogram. Counts live in an array that only grows as far as the slowest bucket
+    used, so a fingerprint that always runs in well under a second costs a couple of hundred ints at most. Histograms
+    merge by adding counts, so they can be combined across sessions.
+    """
+    __slots__ = ('counts', 'count', 'max')
+
+    def __init__(self):
+        self.counts = array('l')
+        self.count = 0
+        self.max = 0.0
+
+    def record(self, seconds):
+        index = bucket_index(seconds)
+        counts = self.counts
+        if index >= len(counts):
+            counts.extend([0] * (index + 1 - len(counts)))
+        counts[index] += 1
+        self.count += 1
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        counts = self.counts
+        if len(other.counts) > len(counts):
+            counts.extend([0] * (len(other.counts) - len(counts)))
+        for index, n in enumerate(other.counts):
+            if n:
+                counts[index] += n
+        self.count += other.count
+        if other.max > self.max:
+            self.max = other.max
+
+    def percentile(self, p):
+        """
+        The duration, in seconds, that p percent of recorded durations were at or under. Accurate to the bucket
+        width, and never more than the largest duration actually recorded.
+
+        :param p: 0 - 100
+        :return:
+        """
+        if not self.count:
+            return 0.0
+        rank = max(1, int(math.ceil(p / 100.0 * self.count)))
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bucket_upper_bound(index), self.max)
+        return self.max
+
+    def percentiles(self):
+        """
+        The p50 / p95 / p99 and max in ms, ready to go into a log record's extra dict.
+
+        :return:
+        """
+        return {
+            'p50_ms': self.percentile(50) * 1000,
+            'p95_ms': self.percentile(95) * 1000,
+            'p99_ms': self.percentile(99) * 1000,
+            'max_ms': self.max * 1000,
+        }
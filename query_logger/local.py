@@ -0,0 +1,48 @@
+# std lib
+import threading
+
+try:
+    from contextvars import ContextVar
+except ImportError:  # Python < 3.7, fall back on plain thread locals
+    ContextVar = None
+
+
+class ContextStack(object):
+    """
+    An immutable stack of values local to the current execution context. On Python 3.7+ that is the current asyncio
+    task or thread (via contextvars), otherwise the current thread. Because the stack is a tuple that is replaced
+    rather than changed, tasks spawned while a value is pushed see it, but nothing they push leaks back out.
+    """
+
+    def __init__(self, name):
+        if ContextVar is not None:
+            self._var = ContextVar(name, default=())
+        else:
+            self._local = threading.local()
+
+    def get(self):
+        if ContextVar is not None:
+            return self._var.get()
+        return getattr(self._local, 'stack', ())
+
+    def _set(self, stack):
+        if ContextVar is not None:
+            self._var.set(stack)
+        else:
+            self._local.stack = stack
+
+    def push(self, value):
+        self._set(self.get() + (value,))
+
+    def remove(self, value):
+        """
+        Removes the innermost occurrence of value, if there is one.
+
+        :param value:
+        :return:
+        """
+        stack = self.get()
+        for i in range(len(stack) - 1, -1, -1):
+            if stack[i] is value:
+                self._set(stack[:i] + stack[i + 1:])
+                return
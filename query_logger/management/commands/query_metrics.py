@@ -0,0 +1,24 @@
+# std lib
+from optparse import make_option
+
+# django
+from django.core.management.base import BaseCommand
+
+# project
+from query_logger.metrics import render
+
+
+class Command(BaseCommand):
+    help = ('Prints the query metrics of every process writing to LOG_QUERY_METRICS_DIR, merged, in the OpenMetrics '
+            'text format.')
+
+    if not hasattr(BaseCommand, 'add_arguments'):  # Django < 1.8
+        option_list = BaseCommand.option_list + (
+            make_option('--dir', default=None, help='The metrics directory, LOG_QUERY_METRICS_DIR by default'),
+        )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', default=None, help='The metrics directory, LOG_QUERY_METRICS_DIR by default')
+
+    def handle(self, *args, **options):
+        self.stdout.write(render(options['dir']))
@@ -0,0 +1,98 @@
+# std lib
+import json
+from optparse import make_option
+
+# django
+from django.core.management.base import BaseCommand, CommandError
+
+# project
+from query_logger.profile import ProfileReport
+
+
+class Command(BaseCommand):
+    help = ('Merges query profile files (as written with LOG_QUERY_PROFILE_PATH) into reports of the most expensive '
+            'fingerprints, the worst classes and, against --baseline files, the fingerprints that regressed.')
+    args = '<profile file> [<profile file> ...]'
+
+    if not hasattr(BaseCommand, 'add_arguments'):  # Django < 1.8
+        option_list = BaseCommand.option_list + (
+            make_option('--baseline', action='append', default=[],
+                        help='An earlier profile file to look for regressions against, can be repeated'),
+            make_option('--top', type='int', default=20, help='How many entries to show per report'),
+            make_option('--json', action='store_true', default=False, help='Print the reports as JSON'),
+        )
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='+', metavar='profile file')
+        parser.add_argument('--baseline', action='append', default=[],
+                            help='An earlier profile file to look for regressions against, can be repeated')
+        parser.add_argument('--top', type=int, default=20, help='How many entries to show per report')
+        parser.add_argument('--json', action='store_true', default=False, help='Print the reports as JSON')
+
+    def handle(self, *args, **options):
+        files = options.get('files') or args
+        if not files:
+            raise CommandError('Give at least one profile file')
+        top = options['top']
+
+        report = ProfileReport().add_files(files)
+        baseline = ProfileReport().add_files(options['baseline']) if options['baseline'] else None
+
+        data = {
+            'profiles': report.profiles,
+            'fingerprints': [{
+                'sql': r.sql,
+                'num': r.count,
+                'sqltime': r.total_time * 1000,
+                'p95_ms': r.histogram.percentile(95) * 1000,
+                'max_ms': r.max_time * 1000,
+                'classes': r.classes,
+                'sites': r.sites,
+            } for r in report.top_fingerprints(top)],
+            'classes': [{
+                'class_name': r.class_name,
+                'profiles': r.profiles,
+                'num': r.num,
+                'duplicates': r.duplicates,
+                'sqltime': r.sqltime * 1000,
+                'totaltime': r.totaltime * 1000,
+            } for r in report.worst_classes(top)],
+        }
+        if baseline is not None:
+            data['regressions'] = [{
+                'sql': r.sql,
+                'added_ms': added * 1000,
+                'num': float(r.count) / report.profiles,
+                'baseline_num': float(before.count) / baseline.profiles if before else 0.0,
+                'avg_ms': r.total_time / r.count * 1000,
+                'baseline_avg_ms': before.total_time / before.count * 1000 if before else None,
+            } for r, before, added in report.regressions(baseline, top)]
+
+        if options['json']:
+            self.stdout.write(json.dumps(data, indent=2, sort_keys=True))
+            return
+        self.write_report(data)
+
+    def write_report(self, data):
+        out = self.stdout
+        out.write('%d profiles\n' % data['profiles'])
+
+        out.write('\nTop fingerprints by total SQL time\n')
+        for i, r in enumerate(data['fingerprints'], 1):
+            out.write('%3d. %10.1f ms  %8dx  p95 %8.1f ms  max %8.1f ms  %s\n' % (
+                i, r['sqltime'], r['num'], r['p95_ms'], r['max_ms'], r['sql']))
+
+        out.write('\nWorst classes by total SQL time\n')
+        for i, r in enumerate(data['classes'], 1):
+            out.write('%3d. %10.1f ms  %8d queries  %8d duplicates  %6d profiles  %s\n' % (
+                i, r['sqltime'], r['num'], r['duplicates'], r['profiles'], r['class_name']))
+
+        if 'regressions' in data:
+            out.write('\nRegressions against the baseline, by SQL time added per profile\n')
+            for i, r in enumerate(data['regressions'], 1):
+                if r['baseline_avg_ms'] is None:
+                    change = 'new'
+                else:
+                    change = '%.1fx -> %.1fx, %.2f ms -> %.2f ms' % (
+                        r['baseline_num'], r['num'], r['baseline_avg_ms'], r['avg_ms'])
+                out.write('%3d. %+10.2f ms  (%s)  %s\n' % (i, r['added_ms'], change, r['sql']))
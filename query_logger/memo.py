@@ -0,0 +1,107 @@
+# std lib
+import re
+from collections import OrderedDict
+
+# Only plain SELECTs are served from the memo. WITH is left out as PostgreSQL lets a CTE write.
+MEMOIZABLE_PATTERN = re.compile(r'^\s*SELECT\b', re.IGNORECASE)
+# SELECTs that lock rows, or whose result changes every time they run
+VOLATILE_PATTERN = re.compile(r'\bFOR (?:NO KEY )?(?:UPDATE|SHARE|KEY SHARE)\b|\b(?:nextval|setval|currval|lastval|'
+                              r'random|rand|uuid|gen_random_uuid|now|sysdate|clock_timestamp|last_insert_id)\s*\(',
+                              re.IGNORECASE)
+
+
+def is_read(sql):
+    return bool(MEMOIZABLE_PATTERN.match(sql))
+
+
+def memo_key(sql, params):
+    """
+    The key a statement's result is memoized under: the exact SQL and its parameters, along with their types so that 1,
+    1.0 and True don't share a result.
+
+    :param sql:
+    :param params:
+    :return: the key, or None if the statement must always run
+    """
+    if not is_read(sql) or VOLATILE_PATTERN.search(sql):
+        return None
+    if params is None:
+        frozen = None
+    elif isinstance(params, dict):
+        frozen = tuple(sorted((name, type(value), value) for name, value in params.items()))
+    else:
+        frozen = tuple((type(value), value) for value in params)
+    try:
+        hash(frozen)
+    except TypeError:
+        return None
+    return sql, frozen
+
+
+class MemoizedResult(object):
+    """
+    Everything needed to replay a SELECT without running it
+    """
+    __slots__ = ('rows', 'description', 'rowcount', 'duration', 'size')
+
+    def __init__(self, rows, description, rowcount, duration, size):
+        self.rows = rows
+        self.description = description
+        self.rowcount = rowcount
+        # How long it took to run, which is what every replay saves
+        self.duration = duration
+        self.size = size
+
+
+class QueryMemo(object):
+    """
+    A session's cache of SELECT results, least recently used first out once it holds more than max_rows rows or
+    max_bytes bytes in total. Results never outlive the session, and any write, commit or rollback on the connection
+    empties the memo.
+    """
+
+    def __init__(self, max_rows=10000, max_bytes=10 * 1024 * 1024):
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.rows = 0
+        self.bytes = 0
+        self.hits = 0
+        self.saved_time = 0.0
+        self.invalidations = 0
+        self._results = OrderedDict()
+
+    def __len__(self):
+        return len(self._results)
+
+    def fits(self, rows, size):
+        return rows <= self.max_rows and size <= self.max_bytes
+
+    def get(self, key):
+        result = self._results.pop(key, None)
+        if result is None:
+            return None
+        self._results[key] = result
+        self.hits += 1
+        self.saved_time += result.duration
+        return result
+
+    def put(self, key, result):
+        if not self.fits(len(result.rows), result.size):
+            return
+        old = self._results.pop(key, None)
+        if old is not None:
+            self.rows -= len(old.rows)
+            self.bytes -= old.size
+        while self._results and not self.fits(self.rows + len(result.rows), self.bytes + result.size):
+            evicted = self._results.popitem(last=False)[1]
+            self.rows -= len(evicted.rows)
+            self.bytes -= evicted.size
+        self._results[key] = result
+        self.rows += len(result.rows)
+        self.bytes += result.size
+
+    def invalidate(self):
+        if self._results:
+            self._results.clear()
+            self.invalidations += 1
+        self.rows = self.bytes = 0
@@ -0,0 +1,242 @@
+# std lib
+import glob
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+# django
+from django.conf import settings
+
+# project
+from .histogram import bucket_upper_bound
+
+# The latency histogram buckets exposed, in seconds, Prometheus style
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+# Every entry holds this many doubles. Fingerprints use them all: count, sum of seconds, then one count per bucket.
+# Classes use the first three: sessions, queries and sum of SQL seconds.
+NUM_VALUES = 2 + len(BUCKETS)
+VALUES = struct.Struct('<%dd' % NUM_VALUES)
+DOUBLE = struct.Struct('<d')
+# Files start with the number of bytes in use, entries follow: a key length, the key, padding to 8 bytes, the values
+USED = struct.Struct('<Q')
+KEY_LENGTH = struct.Struct('<I')
+INITIAL_SIZE = 1024 * 1024
+
+FINGERPRINT = 'fingerprint'
+CLASS = 'class'
+
+_bucket_for_index = {}
+
+
+def _bucket(index):
+    """
+    The exposed bucket a LatencyHistogram bucket falls into: the first one whose bound is at least the histogram
+    bucket's upper bound.
+    """
+    bucket = _bucket_for_index.get(index)
+    if bucket is None:
+        bound = bucket_upper_bound(index)
+        bucket = _bucket_for_index[index] = next(i for i, le in enumerate(BUCKETS) if bound <= le)
+    return bucket
+
+
+def _entries(mm, used):
+    """
+    Every (key, offset of its values) in a mapped file, up to `used` bytes.
+    """
+    pos = USED.size
+    while pos < used:
+        length = KEY_LENGTH.unpack_from(mm, pos)[0]
+        key = mm[pos + KEY_LENGTH.size:pos + KEY_LENGTH.size + length].decode('utf-8')
+        pos += KEY_LENGTH.size + length
+        pos += -pos % 8
+        yield key, pos
+        pos += VALUES.size
+
+
+class MetricsFile(object):
+    """
+    One process' counters, in a memory mapped file only that process writes to. Entries are only ever appended, and
+    the number of bytes in use is updated after an entry is complete, so readers in other processes never need a lock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._offsets = {}
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(USED.pack(USED.size))
+                f.truncate(INITIAL_SIZE)
+        self._f = open(path, 'r+b')
+        self._mm = mmap.mmap(self._f.fileno(), 0)
+        self._used = USED.unpack_from(self._mm, 0)[0]
+        for key, offset in _entries(self._mm, self._used):
+            self._offsets[key] = offset
+
+    def _offset(self, key):
+        offset = self._offsets.get(key)
+        if offset is not None:
+            return offset
+        encoded = key.encode('utf-8')
+        start = self._used
+        offset = start + KEY_LENGTH.size + len(encoded)
+        offset += -offset % 8
+        end = offset + VALUES.size
+        if end > len(self._mm):
+            size = len(self._mm)
+            while size < end:
+                size *= 2
+            self._mm.close()
+            self._f.truncate(size)
+            self._mm = mmap.mmap(self._f.fileno(), 0)
+        self._mm[start:start + KEY_LENGTH.size] = KEY_LENGTH.pack(len(encoded))
+        self._mm[start + KEY_LENGTH.size:start + KEY_LENGTH.size + len(encoded)] = encoded
+        VALUES.pack_into(self._mm, offset, *([0.0] * NUM_VALUES))
+        # Only now is the entry visible to readers
+        self._used = end
+        USED.pack_into(self._mm, 0, end)
+        self._offsets[key] = offset
+        return offset
+
+    def _add(self, offset, index, amount):
+        pos = offset + index * DOUBLE.size
+        DOUBLE.pack_into(self._mm, pos, DOUBLE.unpack_from(self._mm, pos)[0] + amount)
+
+    def record(self, aggregator, class_name):
+        """
+        Adds a session's (or checkpoint window's) counts to the file.
+
+        :param aggregator:
+        :param class_name:
+        :return:
+        """
+        with self._lock:
+            for entry in aggregator.stats.values():
+                offset = self._offset(json.dumps([FINGERPRINT, entry.sql]))
+                self._add(offset, 0, entry.count)
+                self._add(offset, 1, entry.total_time)
+                for index, n in enumerate(entry.histogram.counts):
+                    if n:
+                        self._add(offset, 2 + _bucket(index), n)
+            offset = self._offset(json.dumps([CLASS, class_name]))
+            self._add(offset, 0, 1)
+            self._add(offset, 1, aggregator.num_queries)
+            self._add(offset, 2, aggregator.sql_time)
+
+    def close(self):
+        self._mm.close()
+        self._f.close()
+
+
+def get_metrics_dir():
+    return getattr(settings, 'LOG_QUERY_METRICS_DIR', None) or os.path.join(tempfile.gettempdir(), 'query_logger')
+
+
+_file = None
+_file_key = None
+_file_lock = threading.Lock()
+
+
+def get_metrics_file():
+    """
+    This process' metrics file in settings.LOG_QUERY_METRICS_DIR. A forked worker gets a file of its own.
+
+    :return:
+    """
+    global _file, _file_key
+    key = (os.getpid(), get_metrics_dir())
+    if _file_key != key:
+        with _file_lock:
+            if _file_key != key:
+                pid, directory = key
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                if _file is not None:
+                    _file.close()
+                _file = MetricsFile(os.path.join(directory, 'querylog_%d.db' % pid))
+                _file_key = key
+    return _file
+
+
+def collect(directory=None):
+    """
+    Sums up the counters in every process' file, without locking anything.
+
+    :param directory: settings.LOG_QUERY_METRICS_DIR by default
+    :return: {(kind, label): [values]}
+    """
+    totals = {}
+    for path in glob.glob(os.path.join(directory or get_metrics_dir(), 'querylog_*.db')):
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                used = USED.unpack_from(mm, 0)[0]
+                for key, offset in _entries(mm, used):
+                    kind, label = json.loads(key)
+                    values = totals.setdefault((kind, label), [0.0] * NUM_VALUES)
+                    for i, value in enumerate(VALUES.unpack_from(mm, offset)):
+                        values[i] += value
+            finally:
+                mm.close()
+    return totals
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def render(directory=None, sql_length=200):
+    """
+    Renders every process' counters in the OpenMetrics text format, which Prometheus scrapes too. Fingerprints are
+    labelled with a short hash and their SQL, cut down to `sql_length` characters.
+
+    :param directory: settings.LOG_QUERY_METRICS_DIR by default
+    :param sql_length:
+    :return:
+    """
+    totals = collect(directory)
+    fingerprints = sorted((label, values) for (kind, label), values in totals.items() if kind == FINGERPRINT)
+    classes = sorted((label, values) for (kind, label), values in totals.items() if kind == CLASS)
+    lines = [
+        '# TYPE querylog_queries counter',
+        '# HELP querylog_queries Queries run, by fingerprint.',
+    ]
+    labels = {}
+    for sql, values in fingerprints:
+        labels[sql] = 'fingerprint="%s",sql="%s"' % (hashlib.sha1(sql.encode('utf-8')).hexdigest()[:12],
+                                                     _escape(sql[:sql_length]))
+        lines.append('querylog_queries_total{%s} %s' % (labels[sql], _number(values[0])))
+    lines.extend([
+        '# TYPE querylog_query_duration_seconds histogram',
+        '# UNIT querylog_query_duration_seconds seconds',
+        '# HELP querylog_query_duration_seconds Query execution time, by fingerprint.',
+    ])
+    for sql, values in fingerprints:
+        cumulative = 0
+        for le, n in zip(BUCKETS, values[2:]):
+            cumulative += n
+            lines.append('querylog_query_duration_seconds_bucket{%s,le="%s"} %s' % (labels[sql], _number(le),
+                                                                                     _number(cumulative)))
+        lines.append('querylog_query_duration_seconds_count{%s} %s' % (labels[sql], _number(values[0])))
+        lines.append('querylog_query_duration_seconds_sum{%s} %s' % (labels[sql], _number(values[1])))
+    for name, index, kind, help_text in (('querylog_sessions', 0, 'counter', 'Logging sessions, by class.'),
+                                         ('querylog_session_queries', 1, 'counter', 'Queries run, by class.'),
+                                         ('querylog_session_sql_seconds', 2, 'counter', 'SQL time, by class.')):
+        lines.append('# TYPE %s %s' % (name, kind))
+        lines.append('# HELP %s %s' % (name, help_text))
+        for class_name, values in classes:
+            lines.append('%s_total{class_name="%s"} %s' % (name, _escape(class_name), _number(values[index])))
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,132 @@
+# std lib
+import re
+
+# django
+from django.conf import settings
+
+try:
+    from django.urls import Resolver404, resolve
+except ImportError:  # Django < 1.10
+    from django.core.urlresolvers import Resolver404, resolve
+
+# project
+from .config import logging_enabled
+from .shortcuts import QueryLogger, stop_logging
+
+
+def _authenticated_user(request):
+    user = getattr(request, 'user', None)
+    if user is None:
+        return None
+    # is_authenticated is a method before Django 1.10
+    authenticated = user.is_authenticated() if callable(user.is_authenticated) else user.is_authenticated
+    return user if authenticated else None
+
+
+def _view_name(view_func):
+    return '%s.%s' % (view_func.__module__, getattr(view_func, '__name__', view_func.__class__.__name__))
+
+
+USER_RULES = {
+    'authenticated': lambda request: _authenticated_user(request) is not None,
+    'staff': lambda request: getattr(_authenticated_user(request), 'is_staff', False),
+    'superuser': lambda request: getattr(_authenticated_user(request), 'is_superuser', False),
+}
+
+
+class QueryLoggingMiddleware(object):
+    """
+    Logs the queries of every request the rules let through, one session per request, under the name of the view
+    that handled it. Works in both MIDDLEWARE and MIDDLEWARE_CLASSES, and has to go after the authentication
+    middleware for the user rules to work.
+
+    The rules come from settings and are compiled once:
+
+        LOG_QUERY_MIDDLEWARE_URLS: regexes, only matching paths are logged (all of them when empty)
+        LOG_QUERY_MIDDLEWARE_EXCLUDE_URLS: regexes, matching paths are never logged
+        LOG_QUERY_MIDDLEWARE_USERS: None for everyone, 'authenticated', 'staff', 'superuser' or a callable taking the
+            request
+        LOG_QUERY_MIDDLEWARE_CONFIG: the config_opts each session is started with
+
+    Requests the rules turn down cost a few regex searches: no config is built and no connection is touched. The ones
+    let through are resolved to their view right away, as sessions are sampled by name when they start. Requests that
+    resolve to no view are logged under the middleware's name.
+    """
+
+    def __init__(self, get_response=None):
+        self.get_response = get_response
+        self.urls = [re.compile(url) for url in getattr(settings, 'LOG_QUERY_MIDDLEWARE_URLS', [])]
+        self.exclude_urls = [re.compile(url) for url in getattr(settings, 'LOG_QUERY_MIDDLEWARE_EXCLUDE_URLS', [])]
+        users = getattr(settings, 'LOG_QUERY_MIDDLEWARE_USERS', None)
+        self.users = USER_RULES[users] if users in USER_RULES else users
+        self.config_opts = getattr(settings, 'LOG_QUERY_MIDDLEWARE_CONFIG', {})
+
+    def __call__(self, request):
+        self.process_request(request)
+        try:
+            response = self.get_response(request)
+        except Exception:
+            self.stop(request, Exception)
+            raise
+        self.stop(request)
+        return response
+
+    def is_enabled(self, request):
+        """
+        Whether the rules let this request be logged.
+
+        :param request:
+        :return:
+        """
+        if not logging_enabled():
+            return False
+        path = request.path_info
+        if any(url.search(path) for url in self.exclude_urls):
+            return False
+        if self.urls and not any(url.search(path) for url in self.urls):
+            return False
+        return self.users is None or bool(self.users(request))
+
+    def view_name(self, request):
+        """
+        The name of the view the request resolves to, or of the middleware if it resolves to none.
+
+        :param request:
+        :return:
+        """
+        try:
+            match = resolve(request.path_info, getattr(request, 'urlconf', None))
+        except Resolver404:
+            return self.__class__.__name__
+        return _view_name(match.func)
+
+    def process_request(self, request):
+        if self.is_enabled(request):
+            request._query_logger = QueryLogger(self.view_name(request))
+            request._query_logger.start_query_logging(self.config_opts)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # A middleware further down may have switched request.urlconf, the view actually called wins
+        owner = getattr(request, '_query_logger', None)
+        if owner is not None:
+            owner.name = _view_name(view_func)
+
+    def process_exception(self, request, exception):
+        # Old style middleware may never see process_response if a later middleware fails, so stop here already
+        self.stop(request, type(exception))
+
+    def process_response(self, request, response):
+        self.stop(request)
+        return response
+
+    def stop(self, request, exc_type=None):
+        """
+        Stops the request's session, if it has one still running.
+
+        :param request:
+        :param exc_type:
+        :return:
+        """
+        owner = request.__dict__.pop('_query_logger', None)
+        if owner is not None:
+            stop_logging(owner, exc_type)
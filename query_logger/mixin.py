@@ -1,22 +1,35 @@
 # std lib
-import collections
 import time
 import traceback
-import re
-from logging import getLogger
-
-# django
-from django.db import connections
-try:
-    from django.db.backends.util import CursorDebugWrapper
-except ImportError:
-    from django.db.backends.utils import CursorDebugWrapper
+from logging import INFO, WARNING, getLogger
 
 # project
-from .config import DatabaseQueryLoggerMixinConfig
+from . import baseline, capture, metrics, profile, stats, tracebacks
+from .bulkwrites import find_batches, find_bulk_writes
+from .config import DatabaseQueryLoggerMixinConfig, logging_enabled
+from .emitter import defer, get_emitter
+from .fingerprint import fingerprint
+from .nplusone import find_nplusones
+from .sampling import should_sample
+from .session import QueryLoggingSession, UnsampledQueryLoggingSession, current_session
 
 logger = getLogger(__name__)
 
+# The summary fields connection events are counted and timed in, as (count field, time field, events)
+EVENT_FIELDS = (
+    ('connects', 'connecttime', (capture.CONNECT,)),
+    ('begins', 'begintime', (capture.BEGIN,)),
+    ('commits', 'committime', (capture.COMMIT,)),
+    ('rollbacks', 'rollbacktime', (capture.ROLLBACK,)),
+    ('savepoints', 'savepointtime', (capture.SAVEPOINT, capture.SAVEPOINT_COMMIT, capture.SAVEPOINT_ROLLBACK)),
+    ('cursors', 'cursortime', (capture.CURSOR,)),
+)
+
+# Large results selecting more columns than this, or averaging more bytes per row, are taken to be selecting columns
+# they don't need
+WIDE_RESULT_COLUMNS = 10
+WIDE_ROW_BYTES = 1024
+
 
 class DatabaseQueryLoggerMixin(object):
     """
@@ -27,89 +40,36 @@ class DatabaseQueryLoggerMixin(object):
     anywhere that it is turned on.
     """
 
-    # Leave these here so we can unpatch the query wrapper
-    REAL_EXEC = CursorDebugWrapper.execute
-    REAL_EXEC_MANY = CursorDebugWrapper.executemany
-
-    sql_id_pattern = re.compile(r'=\s*\d+')
-
-    @staticmethod
-    def _enable_query_debugging(con_name):
-        """
-        Alters the debug cursor setting in the Django DB object. Will force any new cursors to use the debug wrapper
-
-        :return:
-        """
-        if hasattr(connections[con_name], 'use_debug_cursor'):
-            connections[con_name].use_debug_cursor = True
-        else:
-            connections[con_name].force_debug_cursor = True
-
-    @staticmethod
-    def _disable_query_debugging(con_name):
-        """
-        Alters the debug cursor setting in the Django DB object. Will return the cursor wrapper back to the default
-        (which may, in fact, actually be the debug cursor already, if settings.DEBUG is True)
-
-        :param con_name:
-        :return:
-        """
-        if hasattr(connections[con_name], 'use_debug_cursor'):
-            connections[con_name].use_debug_cursor = False
-        else:
-            connections[con_name].force_debug_cursor = False
-
     class QueryInfo(object):
         """
         Basic object for storing query facts
         """
         __slots__ = ('sql', 'time', 'tb')
 
-    @classmethod
-    def patch_cursor(cls):
+    @property
+    def query_debug_session(self):
         """
-        When tracebacks are turned on, this monkey patches the debug cursor wrapper so we get the current stack trace on
-        each execution.
-
-        PROCEED WITH CAUTION.
-
-        This causes significant overhead and should only be turned on when troubleshooting an issue that cannot be
-        easily solved in any other way.
-
-        :return:
+        The innermost logging session this object has running in the current context.
         """
+        session = current_session(self)
+        if session is None:
+            raise AttributeError('query_debug_session')
+        return session
 
-        def should_include(path):
-            if path == __file__ or path + 'c' == __file__:
-                return False
-            return True
-
-        def tb_wrap(fn):
-            def wrapper(self, *args, **kwargs):
-                try:
-                    return fn(self, *args, **kwargs)
-                finally:
-                    if hasattr(self.db, 'queries'):
-                        tb = traceback.extract_stack()
-                        tb = [f for f in tb if should_include(f[0])]
-                        self.db.queries[-1]['tb'] = tb
-
-            return wrapper
-
-        CursorDebugWrapper.execute = tb_wrap(cls.REAL_EXEC)
-        CursorDebugWrapper.executemany = tb_wrap(cls.REAL_EXEC_MANY)
+    @property
+    def query_debug_cfg(self):
+        """
+        The config of the innermost logging session this object has running in the current context.
+        """
+        return self.query_debug_session.cfg
 
-    @classmethod
-    def un_patch_cursor(cls):
+    def get_query_logger_name(self):
         """
-        When we have tracebacks on and we stop the debugging, this will un patch the debug cursor so it stops producing
-        stack traces at each frame / execution
+        The name this object's sessions are sampled, logged and aggregated under. The class name by default.
 
         :return:
         """
-
-        CursorDebugWrapper.execute = cls.REAL_EXEC
-        CursorDebugWrapper.executemany = cls.REAL_EXEC_MANY
+        return self.__class__.__name__
 
     @classmethod
     def get_query_infos(cls, queries):
@@ -122,196 +82,436 @@ class DatabaseQueryLoggerMixin(object):
         retval = []
         for q in queries:
             qi = cls.QueryInfo()
-            qi.sql = cls.sql_id_pattern.sub('= ?', q['sql'])
+            qi.sql = fingerprint(q['sql'])
             qi.time = float(q['time'])
             qi.tb = q.get('tb')
             retval.append(qi)
         return retval
 
-    @staticmethod
-    def count_duplicates(infos):
+    def _log(self, session, level, msg, extra):
+        records = session.log_records
+        if records is None:
+            logger.log(level, msg, extra=extra)
+        else:
+            defer(records, logger, level, msg, extra)
+
+    def _log_extra(self, session, **extra):
+        extra['class_name'] = self.get_query_logger_name()
+        extra.update(session.cfg.logging_extras)
+        return extra
+
+    def check_duplicates(self, session, aggregator, log_duplicates, log_tracebacks):
         """
-        Does basic string comparisons to get the number of duplicate queries.
+        Logs out any duplicate queries the aggregator has seen and returns how many duplicate executions there were.
 
-        :param infos:
+        :param session: the session the records belong to
+        :param aggregator:
+        :param log_duplicates:
+        :param log_tracebacks:
         :return:
         """
-        buf = collections.defaultdict(lambda: 0)
-        for qi in infos:
-            buf[qi.sql] += 1
-        return sorted(buf.items(), key=lambda el: el[1], reverse=True)
+        if log_duplicates:
+            for entry in aggregator.duplicates():
+                extra = self._log_extra(session, num=entry.count, sql=entry.sql, connections=dict(entry.aliases),
+                                        logtype='querylog__duplicate')
+                extra.update(entry.histogram.percentiles())
+                if log_tracebacks and entry.tb:
+                    extra['traceback'] = ''.join(traceback.format_list(tracebacks.extract(entry.tb)))
+                if len(entry.aliases) > 1:
+                    self._log(session, WARNING, '[SQL] repeated query (%dx) across databases %s: %s' % (
+                                  entry.count,
+                                  ', '.join(sorted(entry.aliases)),
+                                  entry.sql),
+                              extra)
+                else:
+                    self._log(session, WARNING, '[SQL] repeated query (%dx): %s' % (entry.count, entry.sql), extra)
+        return aggregator.num_duplicates
 
-    @staticmethod
-    def group_queries(infos):
+    def check_nplusone(self, session, aggregator, threshold):
         """
-        Groups queries together by SQL. This is separate from the counted duplicates so we can access the stack trace if
-        tracebacks are turned on.
+        Logs out one record for every N+1 pattern found: a SELECT repeated from the same call site, along with the
+        relation it is most likely walking and what to do about it.
 
-        :param infos:
+        :param session: the session the records belong to
+        :param aggregator:
+        :param threshold:
         :return:
         """
-        buf = collections.defaultdict(lambda: [])
-        for qi in infos:
-            buf[qi.sql].append(qi)
-        return buf
+        for found in find_nplusones(aggregator, threshold):
+            extra = self._log_extra(session, num=found.count, sql=found.sql, callsite=found.call_site,
+                                    model=found.model, relation=found.relation, suggestion=found.suggestion,
+                                    time=found.total_time * 1000, saved=found.saved_time * 1000,
+                                    logtype='querylog__nplusone')
+            if found.suggestion:
+                advice = '%s: use %s to save ~%d ms' % (found.relation, found.suggestion, found.saved_time * 1000)
+            else:
+                advice = 'batch these to save ~%d ms' % (found.saved_time * 1000)
+            self._log(session, WARNING, '[SQL] N+1 query (%dx) at %s, %s: %s' % (
+                          found.count,
+                          found.call_site,
+                          advice,
+                          found.sql),
+                      extra)
+
+    def check_absolute_limit(self, session, aggregator, log_long_running_time):
+        """
+        Logs out the sql and the run time of every query the aggregator saw running for longer than the configured long
+        running time in ms, along with its plan if it was explained.
 
-    def check_duplicates(self, infos, log_duplicates, log_tracebacks):
+        :param session: the session the records belong to
+        :param aggregator:
+        :param log_long_running_time:
+        :return:
         """
-        Counts and groups queries and then logs out any duplicates that are found.
+        if not log_long_running_time or log_long_running_time <= 0:
+            return
 
-        :param infos:
-        :param log_duplicates:
-        :param log_tracebacks:
+        query_limit = log_long_running_time / 1000.0
+
+        for entry in aggregator.slow_queries():
+            for query_time in entry.slow_times:
+                extra = self._log_extra(session, time=query_time * 1000, limit=query_limit * 1000, sql=entry.sql,
+                                        sampled=session.sampled, logtype='querylog__longrunning')
+                flags = ''
+                if entry.plan is not None and entry.plan.text is not None:
+                    extra.update(plan=entry.plan.text, full_scan=entry.plan.full_scan, temp_sort=entry.plan.temp_sort)
+                    if entry.plan.flags:
+                        flags = ' (%s)' % ', '.join(entry.plan.flags)
+                self._log(session, WARNING, '[SQL] query execution of %d ms over absolute '
+                                            'limit of %d ms%s: %s' % (
+                                                query_time * 1000,
+                                                query_limit * 1000,
+                                                flags,
+                                                entry.sql),
+                          extra)
+
+    def check_large_results(self, session, aggregator):
+        """
+        Logs out every fingerprint that fetched a large result, with the biggest result it fetched and a hint at what
+        might shrink it: .only() / .values() for wide rows, .iterator() for many of them.
+
+        :param session: the session the records belong to
+        :param aggregator:
         :return:
         """
-        duplicates = [(qi, num) for qi, num in self.__class__.count_duplicates(infos) if num > 1]
-        duplicates.reverse()
-        n = 0
-        if len(duplicates) > 0:
-            n = (sum(num for qi, num in duplicates) - len(duplicates))
+        for entry in aggregator.large_results():
+            hints = []
+            columns = entry.sql.split(' FROM ', 1)[0].count(',') + 1
+            if columns > WIDE_RESULT_COLUMNS or entry.max_bytes > WIDE_ROW_BYTES * max(entry.max_rows, 1):
+                hints.append('.only() or .values()')
+            if aggregator.large_rows and entry.max_rows >= aggregator.large_rows:
+                hints.append('.iterator()')
+            extra = self._log_extra(session, num=entry.large_count, rows=entry.rows, bytes=entry.bytes,
+                                    maxrows=entry.max_rows, maxbytes=entry.max_bytes, columns=columns,
+                                    suggestion=' / '.join(hints) or None, sql=entry.sql,
+                                    logtype='querylog__largeresult')
+            self._log(session, WARNING, '[SQL] large result (%dx), up to %d rows / ~%d KB per execution%s: %s' % (
+                          entry.large_count,
+                          entry.max_rows,
+                          entry.max_bytes / 1024,
+                          ', try %s' % ' / '.join(hints) if hints else '',
+                          entry.sql),
+                      extra)
+
+    def check_bulk_writes(self, session, aggregator, threshold):
+        """
+        Logs out every single row INSERT or UPDATE run `threshold` times or more as a bulk_create / bulk_update
+        candidate, with the rows it wrote, the time it took and its longest run of back to back executions, then the
+        batch sizes of every statement run through executemany.
 
-        dup_groups = self.__class__.group_queries(infos)
+        :param session: the session the records belong to
+        :param aggregator:
+        :param threshold:
+        :return:
+        """
+        for found in find_bulk_writes(aggregator, threshold):
+            extra = self._log_extra(session, num=found.count, rows=found.rows, time=found.total_time * 1000,
+                                    run=found.max_run, model=found.model, suggestion=found.suggestion, sql=found.sql,
+                                    logtype='querylog__bulkwrite')
+            self._log(session, WARNING, '[SQL] single row %s (%dx, %d rows, %d ms, up to %d in a row), use %s: %s' % (
+                          found.kind.upper(),
+                          found.count,
+                          found.rows,
+                          found.total_time * 1000,
+                          found.max_run,
+                          found.suggestion,
+                          found.sql),
+                      extra)
+        for entry in find_batches(aggregator):
+            extra = self._log_extra(session, num=entry.batches, rows=entry.batch_rows, maxbatch=entry.max_batch,
+                                    time=entry.total_time * 1000, sql=entry.sql, logtype='querylog__executemany')
+            self._log(session, INFO, '[SQL] executemany (%dx, %d rows, %d per batch on average, up to %d, '
+                                     '%d ms): %s' % (
+                                         entry.batches,
+                                         entry.batch_rows,
+                                         entry.batch_rows / entry.batches,
+                                         entry.max_batch,
+                                         entry.total_time * 1000,
+                                         entry.sql),
+                      extra)
+
+    def check_timeline(self, session):
+        """
+        Logs out where the session's time went: SQL, Python time between queries broken down by the call site of the
+        query each gap led up to, and the time before the first query and after the last one. Then writes out the
+        timeline as a Chrome trace if timeline_path is set.
 
-        if log_duplicates:
-            for sql, num in duplicates:
-                if log_tracebacks and dup_groups[sql]:
-                    extra = {'traceback': ''.join(traceback.format_list(dup_groups[sql][0].tb)),
-                             'num': num,
-                             'sql': sql,
-                             'class_name': self.__class__.__name__,
-                             'logtype': 'querylog__duplicate'}
-                    for k in self.query_debug_cfg.logging_extras.keys():
-                        extra[k] = self.query_debug_cfg.logging_extras[k]
-                    logger.warning('[SQL] repeated query (%dx): %s' % (num, sql),
-                                   extra=extra)
-                else:
-                    extra = {'num': num,
-                             'sql': sql,
-                             'class_name': self.__class__.__name__,
-                             'logtype': 'querylog__duplicate'}
-                    for k in self.query_debug_cfg.logging_extras.keys():
-                        extra[k] = self.query_debug_cfg.logging_extras[k]
-                    logger.warning('[SQL] repeated query (%dx): %s' % (num, sql),
-                                   extra=extra)
-        return n
-
-    def check_absolute_limit(self, infos, log_long_running_time):
-        """
-        Checks the total SQL running time of each query and, if the running time in ms is longer than the configured
-        long running time, logs out the sql and the run time.
-
-        :param infos:
-        :param log_long_running_time:
+        :param session:
         :return:
         """
-        n = len(infos)
-        if not log_long_running_time or n == 0:
-            return
-        elif log_long_running_time > 0:
-
-            query_limit = log_long_running_time / 1000.0
-
-            for qi in infos:
-                if qi.time > query_limit:
-                    extra = {
-                        'class_name': self.__class__.__name__,
-                        'time': qi.time * 1000,
-                        'limit': query_limit * 1000,
-                        'sql': qi.sql,
-                        'logtype': 'querylog__longrunning'
-                    }
-                    for k in self.query_debug_cfg.logging_extras.keys():
-                        extra[k] = self.query_debug_cfg.logging_extras[k]
-                    logger.warning('[SQL] query execution of %d ms over absolute '
-                                   'limit of %d ms: %s' % (
-                                       qi.time * 1000,
-                                       query_limit * 1000,
-                                       qi.sql),
-                                   extra=extra
-                                   )
-
-    def output_stats(self, infos, num_duplicates, total_time):
+        timeline = session.timeline
+        lead_time = timeline.lead_time or 0.0
+        sites = timeline.top_sites()
+        extra = self._log_extra(session, sqltime=timeline.sql_time * 1000, pythontime=timeline.python_time * 1000,
+                                leadtime=lead_time * 1000, tailtime=timeline.tail_time * 1000,
+                                totaltime=timeline.total_time * 1000,
+                                callsites=[{'callsite': gaps.call_site, 'time': gaps.time * 1000, 'num': gaps.count}
+                                           for gaps in sites],
+                                logtype='querylog__timeline')
+        lines = ['[SQL] timeline: %d ms SQL, %d ms Python between queries, %d ms before the first query, %d ms after '
+                 'the last' % (timeline.sql_time * 1000, timeline.python_time * 1000, lead_time * 1000,
+                               timeline.tail_time * 1000)]
+        if sites:
+            lines.append('  Python time between queries by call site:')
+            for gaps in sites:
+                lines.append('    %8.1f ms  %4dx  %s' % (gaps.time * 1000, gaps.count, gaps.call_site))
+        if session.cfg.timeline_path:
+            extra['trace'] = timeline.write_chrome_trace(session.cfg.timeline_path, self.get_query_logger_name())
+        self._log(session, INFO, '\n'.join(lines), extra)
+
+    def check_baseline(self, session, aggregator):
+        """
+        Compares the session against the baseline of this object's earlier sessions, logs one record if it regressed,
+        and then folds it into the baseline. Nothing is compared until the baseline has seen baseline_min_sessions
+        sessions.
+
+        :param session:
+        :param aggregator:
+        :return:
+        """
+        cfg = session.cfg
+        name = self.get_query_logger_name()
+        store = baseline.get_baseline_store()
+        data = store.load(name)
+        if data is not None and data['sessions'] >= cfg.baseline_min_sessions:
+            regression = baseline.compare(data, aggregator, cfg.baseline_tolerance, cfg.baseline_min_time / 1000.0)
+            if regression:
+                extra = self._log_extra(
+                    session,
+                    sessions=regression.sessions,
+                    new=regression.new,
+                    count=[{'sql': sql, 'num': n, 'baseline': known} for sql, n, known in regression.count],
+                    time=[{'sql': sql, 'time': t * 1000, 'baseline': known * 1000}
+                          for sql, t, known in regression.time],
+                    logtype='querylog__regression')
+                lines = ['[SQL] query regression in %s against %d sessions: %d new, %d more frequent, %d slower' % (
+                    name,
+                    regression.sessions,
+                    len(regression.new),
+                    len(regression.count),
+                    len(regression.time))]
+                lines.extend('  new: %s' % sql for sql in regression.new)
+                lines.extend('  %dx, usually %.1fx: %s' % (n, known, sql) for sql, n, known in regression.count)
+                lines.extend('  %.1f ms, usually %.1f ms: %s' % (t * 1000, known * 1000, sql)
+                             for sql, t, known in regression.time)
+                self._log(session, WARNING, '\n'.join(lines), extra)
+        store.save(name, baseline.update(data, aggregator, cfg.baseline_alpha))
+
+    def check_budget(self, session, aggregator, totals, budget):
+        """
+        Logs out, or raises, a report of everything that went over the session's query budget.
+
+        :param session: the session the records belong to
+        :param aggregator:
+        :param totals: the session totals, if it was checkpointed
+        :param budget: a QueryBudget
+        :return:
+        """
+        budget.enforce(aggregator, totals,
+                       log=lambda level, msg, extra: self._log(session, level, msg, self._log_extra(session, **extra)))
+
+    def output_stats(self, session, aggregator, num_duplicates, total_time):
         """
         Logs out the summary stats when the debugging is turned off.
 
-        :param infos:
+        :param session: the session the summary is for
+        :param aggregator:
         :param num_duplicates:
         :param total_time:
         :return:
         """
-        sql_time = sum(qi.time for qi in infos)
-        n = len(infos)
-
-        extra = {
-            'class_name': self.__class__.__name__,
-            'num': num_duplicates,
-            'sqltime': sql_time,
-            'totaltime': total_time,
-            'logtype': 'querylog__summary'
-        }
-
-        for k in self.query_debug_cfg.logging_extras.keys():
-            extra[k] = self.query_debug_cfg.logging_extras[k]
-
-        logger.info(
-            '[SQL] %d queries (%d duplicates), %d ms SQL time, %d ms total processing time' % (
-                n,
-                num_duplicates,
-                sql_time * 1000,
-                total_time * 1000),
-            extra=extra
-        )
+        per_connection = {}
+        event_totals = dict((count_field, [0, 0.0]) for count_field, time_field, events in EVENT_FIELDS)
+        for alias, alias_entry in aggregator.alias_stats.items():
+            connection = per_connection[alias] = {'num': alias_entry.count, 'sqltime': alias_entry.total_time}
+            for count_field, time_field, events in EVENT_FIELDS:
+                count = sum(alias_entry.events[event][0] for event in events if event in alias_entry.events)
+                duration = sum(alias_entry.events[event][1] for event in events if event in alias_entry.events)
+                connection[count_field] = count
+                connection[time_field] = duration
+                event_totals[count_field][0] += count
+                event_totals[count_field][1] += duration
+        extra = self._log_extra(session, num=num_duplicates, sqltime=aggregator.sql_time, totaltime=total_time,
+                                connections=per_connection, logtype='querylog__summary')
+        for count_field, time_field, events in EVENT_FIELDS:
+            extra[count_field], extra[time_field] = event_totals[count_field]
+        extra.update(aggregator.histogram.percentiles())
+        if session.cfg.count_rows:
+            extra.update(rows=aggregator.num_rows, bytes=aggregator.num_bytes)
+
+        msg = '[SQL] %d queries (%d duplicates), %d ms SQL time, %d ms total processing time' % (
+            aggregator.num_queries,
+            num_duplicates,
+            aggregator.sql_time * 1000,
+            total_time * 1000)
+        if len(session.cfg.connection_names) > 1:
+            msg += ' (%s)' % ', '.join('%s: %d queries, %d ms' % (alias, stats['num'], stats['sqltime'] * 1000)
+                                       for alias, stats in sorted(per_connection.items()))
+        # Cursors are created for every query, only the events that cost a round trip are worth a mention
+        overhead = ['%d %s in %d ms' % (extra[count_field], count_field, extra[time_field] * 1000)
+                    for count_field, time_field, events in EVENT_FIELDS[:-1] if extra[count_field]]
+        if overhead:
+            msg += ', ' + ', '.join(overhead)
+        memo = session.memo
+        if memo is not None:
+            extra.update(memohits=memo.hits, memosaved=memo.saved_time)
+            msg += ', %d served from the memo saving ~%d ms' % (memo.hits, memo.saved_time * 1000)
+        self._log(session, INFO, msg, extra)
+
+    def check_window(self, session, aggregator, elapsed):
+        """
+        Runs every per fingerprint check on what the aggregator collected, merges it into the rolling stats and writes
+        out its profile and metrics.
 
-    def start_query_logging(self, config_opts=None):
+        :param session: the session the aggregator belongs to
+        :param aggregator: the session's current aggregator, or a window it rotated out
+        :param elapsed: seconds the aggregator was collecting for
+        :return: the number of duplicate executions
+        """
+        cfg = session.cfg
+        # With a baseline to compare against, regressions are reported instead
+        num_duplicates = self.check_duplicates(session, aggregator, cfg.log_duplicate_queries and not cfg.baseline,
+                                               cfg.log_tracebacks)
+        if cfg.detect_nplusone and not cfg.baseline:
+            self.check_nplusone(session, aggregator, cfg.nplusone_threshold)
+        self.check_absolute_limit(session, aggregator, cfg.log_long_running_time)
+        if cfg.count_rows:
+            self.check_large_results(session, aggregator)
+        if cfg.detect_bulk_writes:
+            self.check_bulk_writes(session, aggregator, cfg.bulk_write_threshold)
+
+        if cfg.rolling_stats:
+            stats.get_store().merge(aggregator, self.get_query_logger_name(), records=session.log_records)
+        if cfg.profile_path:
+            profile.get_writer(cfg.profile_path, cfg.profile_format).write(
+                profile.session_profile(aggregator, self.get_query_logger_name(), elapsed))
+        if cfg.metrics:
+            metrics.get_metrics_file().record(aggregator, self.get_query_logger_name())
+        return num_duplicates
+
+    def flush_query_window(self, session):
         """
-        The main entry point. Turns on the debug query wrapper and loads the config options from the config_opts
-        argument. Will also call the patch for the debug cursor when tracebacks are configured to True.
+        Reports on the queries a session has collected since its last checkpoint and lets go of them, keeping only the
+        totals for the final summary. Called by the session itself every checkpoint_queries queries or
+        checkpoint_seconds seconds.
 
-        :param config_opts:
+        :param session:
         :return:
         """
-        config_opts = dict() if not config_opts else config_opts
-        self.query_debug_cfg = DatabaseQueryLoggerMixinConfig(**config_opts)
+        window_time = time.time() - session.window_start
+        aggregator = session.rotate()
+        num_duplicates = self.check_window(session, aggregator, window_time)
+
+        extra = self._log_extra(session, num=num_duplicates, sqltime=aggregator.sql_time, windowtime=window_time,
+                                window=session.totals.num_windows, logtype='querylog__checkpoint')
+        extra.update(aggregator.histogram.percentiles())
+        self._log(session, INFO, '[SQL] checkpoint #%d: %d queries (%d duplicates), %d ms SQL time in the last '
+                                 '%d ms' % (
+            session.totals.num_windows,
+            aggregator.num_queries,
+            num_duplicates,
+            aggregator.sql_time * 1000,
+            window_time * 1000), extra)
+
+        if session.log_records:
+            get_emitter().submit(session.log_records)
+            session.log_records = []
+
+    def checkpoint_query_logging(self):
+        """
+        Flushes the innermost logging session this object has running in the current context right away, on top of
+        any configured checkpoints.
 
-        if self.query_debug_cfg.connection_name in connections:
-            DatabaseQueryLoggerMixin._enable_query_debugging(self.query_debug_cfg.connection_name)
+        :return:
+        """
+        session = current_session(self)
+        if session is not None and session.sampled:
+            self.flush_query_window(session)
 
-            self.start_query_debug_time = time.time()
-            self.conn_queries_len = len(connections[self.query_debug_cfg.connection_name].queries)
+    def start_query_logging(self, config_opts=None):
+        """
+        The main entry point. Loads the config options from the config_opts argument and starts a logging session that
+        captures the queries run on the configured connection(s) by the current thread or asyncio task. Sessions can be
+        nested, each one collects everything run until its own stop_query_logging.
 
-            if self.query_debug_cfg.log_tracebacks:
-                self.patch_cursor()
+        When sampling is configured, sessions that are not sampled only report queries over the long running limit.
 
-    def stop_query_logging(self):
-        """
-        Turns off the query debugging and processes the stats collected.
+        Does nothing at all when settings.LOG_QUERY_ENABLED is False.
+
+        :param config_opts:
         :return:
         """
-        if not hasattr(self, "start_query_debug_time") or self.query_debug_cfg.connection_name not in connections:
+        if not logging_enabled():
             return
 
-        total_time = time.time() - self.start_query_debug_time
-
-        infos = self.get_query_infos(
-            connections[self.query_debug_cfg.connection_name].queries[self.conn_queries_len:])
-
-        num_duplicates = self.check_duplicates(infos, self.query_debug_cfg.log_duplicate_queries,
-                                               self.query_debug_cfg.log_tracebacks)
-        self.check_absolute_limit(infos, self.query_debug_cfg.log_long_running_time)
-        self.output_stats(infos, num_duplicates, total_time)
-
-        DatabaseQueryLoggerMixin._disable_query_debugging(self.query_debug_cfg.connection_name)
+        config_opts = dict() if not config_opts else config_opts
+        cfg = DatabaseQueryLoggerMixinConfig(**config_opts)
 
-        # We need to unpatch the debug cursor wrapper otherwise it will keep making stack traces for any queries in it's
-        # thread / process until it is stopped.
-        if self.query_debug_cfg.log_tracebacks:
-            self.un_patch_cursor()
+        if cfg.connection_names:
+            if should_sample(self.get_query_logger_name(), cfg):
+                QueryLoggingSession(self, cfg).start()
+            else:
+                UnsampledQueryLoggingSession(self, cfg).start()
 
-        if self.query_debug_cfg.testing:
-            delattr(self, 'query_debug_cfg')    # Lets free this up manually, don't want it sticking around in the
-                                                # mixin'ed class in case debugging gets turned back on later in the
-                                                # class' execution path
-            return infos, num_duplicates, total_time
-        else:
-            delattr(self, 'query_debug_cfg')    # See comment directly above
+    def stop_query_logging(self):
+        """
+        Stops the innermost logging session this object started in the current context and processes the stats
+        collected.
+        :return:
+        """
+        session = current_session(self)
+        if session is None:
             return
+
+        try:
+            # Stop capturing before we do anything else, nothing below here should end up in the stats
+            total_time = session.stop_capture()
+            cfg = session.cfg
+
+            if not session.sampled:
+                self.check_absolute_limit(session, session.aggregator, cfg.log_long_running_time)
+                return
+
+            num_duplicates = self.check_window(session, session.aggregator, time.time() - session.window_start)
+            if session.totals is not None:
+                # Checkpointed along the way, the summary covers every window
+                session.totals.add(session.aggregator)
+                num_duplicates = session.totals.num_duplicates
+                self.output_stats(session, session.totals, num_duplicates, total_time)
+            else:
+                self.output_stats(session, session.aggregator, num_duplicates, total_time)
+            if session.timeline is not None:
+                self.check_timeline(session)
+
+            if cfg.baseline and session.totals is None:
+                self.check_baseline(session, session.aggregator)
+
+            if cfg.budget is not None:
+                self.check_budget(session, session.aggregator, session.totals, cfg.budget)
+        finally:
+            session.close()
+            if session.log_records:
+                get_emitter().submit(session.log_records)
+
+        if cfg.testing:
+            return session.infos, num_duplicates, total_time
@@ -0,0 +1,132 @@
+# std lib
+import re
+
+# django
+from django.db import models
+
+# project
+from .tracebacks import format_site
+
+# Enough of a fingerprinted SELECT to tell which table it reads and which column it looks rows up by
+FROM_PATTERN = re.compile(r'^SELECT .*? FROM [`"]?(\w+)[`"]?', re.IGNORECASE)
+LOOKUP_PATTERN = re.compile(r' WHERE [`"]?(\w+)[`"]?\.[`"]?(\w+)[`"]? (?:= \?|IN \(\.\.\.\))', re.IGNORECASE)
+
+_table_models = None
+
+
+def _get_models():
+    try:
+        from django.apps import apps
+        return apps.get_models()
+    except ImportError:  # Django < 1.7
+        return models.get_models()
+
+
+def _related_model(field):
+    rel = getattr(field, 'remote_field', None) or field.rel
+    return getattr(rel, 'model', None) or rel.to
+
+
+def _accessor_name(field):
+    rel = getattr(field, 'remote_field', None) or field.rel
+    if hasattr(rel, 'get_accessor_name'):
+        return rel.get_accessor_name()
+    return field.related.get_accessor_name()  # Django < 1.8
+
+
+def model_for_table(table):
+    """
+    The installed model stored in a table, or None.
+
+    :param table:
+    :return:
+    """
+    global _table_models
+    if _table_models is None:
+        _table_models = dict((model._meta.db_table, model) for model in _get_models())
+    return _table_models.get(table)
+
+
+def infer_relation(sql):
+    """
+    Works out which relation a repeated SELECT is most likely walking, from the table it reads and the column it
+    filters on.
+
+    Filtering on a foreign key column (customer_role.contact_id = ?) means a reverse relation is being read once per
+    parent object, which prefetch_related fixes. Filtering on the primary key means a foreign key is being followed
+    once per child object, which select_related fixes.
+
+    :param sql: a fingerprint
+    :return: (model label, relation, suggestion), any of which may be None
+    """
+    table_match = FROM_PATTERN.match(sql)
+    lookup_match = LOOKUP_PATTERN.search(sql)
+    if not table_match or not lookup_match or lookup_match.group(1) != table_match.group(1):
+        return None, None, None
+    model = model_for_table(table_match.group(1))
+    if model is None:
+        return None, None, None
+    column = lookup_match.group(2)
+
+    for field in model._meta.fields:
+        if field.column != column:
+            continue
+        if isinstance(field, models.ForeignKey):
+            parent = _related_model(field)
+            accessor = _accessor_name(field)
+            return (parent.__name__, '%s.%s' % (parent.__name__, accessor),
+                    "prefetch_related('%s')" % accessor)
+        if field.primary_key:
+            pointers = ['%s.%s' % (other.__name__, f.name) for other in _get_models() for f in other._meta.fields
+                        if isinstance(f, models.ForeignKey) and _related_model(f) is model]
+            if pointers:
+                return (model.__name__, ', '.join(pointers),
+                        "select_related('%s')" % "' / '".join(p.split('.', 1)[1] for p in pointers))
+            return model.__name__, None, None
+    return model.__name__, None, None
+
+
+class NPlusOne(object):
+    """
+    One fingerprint repeatedly issued from the same call site
+    """
+    __slots__ = ('sql', 'count', 'site', 'total_time', 'model', 'relation', 'suggestion')
+
+    def __init__(self, entry, site, count):
+        self.sql = entry.sql
+        self.count = count
+        self.site = site
+        # The time spent at this call site, going by the fingerprint's average
+        self.total_time = entry.total_time * count / entry.count
+        self.model, self.relation, self.suggestion = infer_relation(entry.sql)
+
+    @property
+    def saved_time(self):
+        """
+        Roughly what batching the lookups into a single query would save.
+        """
+        return self.total_time * (self.count - 1) / self.count
+
+    @property
+    def call_site(self):
+        return format_site(self.site)
+
+
+def find_nplusones(aggregator, threshold):
+    """
+    Finds every SELECT fingerprint run at least `threshold` times from a single call site. A statement repeated from
+    one line of code is that line running in a loop, which is what an N+1 looks like; the same statement repeated from
+    unrelated places is usually a legitimate repeat and is left to the duplicate query report.
+
+    :param aggregator:
+    :param threshold:
+    :return: a list of NPlusOne, most expensive first
+    """
+    found = []
+    for entry in aggregator.stats.values():
+        if entry.count < threshold or not entry.sites or not entry.sql.upper().startswith('SELECT'):
+            continue
+        for site, count in entry.sites.items():
+            if count >= threshold and site:
+                found.append(NPlusOne(entry, site, count))
+    return sorted(found, key=lambda n: n.total_time, reverse=True)
@@ -0,0 +1,310 @@
+# std lib
+import errno
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+# django
+from django.conf import settings
+
+# project
+from .histogram import LatencyHistogram
+from .tracebacks import format_site
+
+JSONL = 'jsonl'
+BINARY = 'binary'
+
+# Binary profile files start with this, then hold one record after another: a 4 byte big endian length followed by
+# that many bytes of zlib compressed JSON
+BINARY_MAGIC = b'QLPROF1\n'
+LENGTH = struct.Struct('>I')
+
+
+def session_profile(aggregator, class_name, total_time, now=None):
+    """
+    Everything worth keeping about one session (or checkpoint window) for offline analysis, as plain JSON data: the
+    fingerprint table with timings, latency histograms and call sites, and the totals.
+
+    :param aggregator:
+    :param class_name:
+    :param total_time: seconds
+    :param now:
+    :return:
+    """
+    queries = []
+    for entry in aggregator.stats.values():
+        sites = {}
+        if entry.sites:
+            for site, count in entry.sites.items():
+                if site:
+                    sites[format_site(site, full_path=True)] = count
+        elif entry.tb:
+            sites[format_site(entry.tb, full_path=True)] = entry.count
+        queries.append({
+            'sql': entry.sql,
+            'count': entry.count,
+            'time': entry.total_time,
+            'max': entry.max_time,
+            'rows': entry.rows,
+            'bytes': entry.bytes,
+            'connections': entry.aliases,
+            'histogram': [[index, n] for index, n in enumerate(entry.histogram.counts) if n],
+            'sites': sites,
+        })
+    return {
+        'class_name': class_name,
+        'timestamp': time.time() if now is None else now,
+        'totaltime': total_time,
+        'num': aggregator.num_queries,
+        'duplicates': aggregator.num_duplicates,
+        'sqltime': aggregator.sql_time,
+        'queries': queries,
+    }
+
+
+def encode(profile, fmt):
+    data = json.dumps(profile, separators=(',', ':')).encode('utf-8')
+    if fmt == BINARY:
+        data = zlib.compress(data)
+        return LENGTH.pack(len(data)) + data
+    return data + b'\n'
+
+
+def _ignore_missing(fn, *args):
+    # Another process, or someone cleaning up, got there first
+    try:
+        fn(*args)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+class ProfileWriter(object):
+    """
+    Appends session profiles to a file, rotating it the way logging's RotatingFileHandler does: once the next profile
+    would take it past max_bytes the file is renamed to path.1, path.1 to path.2 and so on, keeping `backups` old
+    files. Only one process may write to a file, see get_writer.
+    """
+
+    def __init__(self, path, fmt=JSONL, max_bytes=10 * 1024 * 1024, backups=5):
+        if fmt not in (JSONL, BINARY):
+            raise ValueError('Unknown profile format %r' % fmt)
+        self.path = path
+        self.fmt = fmt
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._lock = threading.Lock()
+
+    def rotate(self):
+        if not self.backups:
+            _ignore_missing(os.remove, self.path)
+            return
+        for i in range(self.backups - 1, 0, -1):
+            src = '%s.%d' % (self.path, i)
+            if os.path.exists(src):
+                _ignore_missing(os.rename, src, '%s.%d' % (self.path, i + 1))
+        _ignore_missing(os.rename, self.path, self.path + '.1')
+
+    def write(self, profile):
+        data = encode(profile, self.fmt)
+        with self._lock:
+            size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+            if size and self.max_bytes and size + len(data) > self.max_bytes:
+                self.rotate()
+                size = 0
+            with open(self.path, 'ab') as f:
+                if not size and self.fmt == BINARY:
+                    f.write(BINARY_MAGIC)
+                f.write(data)
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def process_path(path):
+    """
+    The file the current process writes profiles to: path with the process id appended, so that workers sharing one
+    LOG_QUERY_PROFILE_PATH never append to, or rotate, the same file.
+
+    :param path:
+    :return:
+    """
+    return '%s.%d' % (path, os.getpid())
+
+
+def get_writer(path, fmt):
+    """
+    This process' writer for a profile path, writing to process_path(path) and rotated according to
+    settings.LOG_QUERY_PROFILE_MAX_BYTES and settings.LOG_QUERY_PROFILE_BACKUPS. A forked worker gets a file of its
+    own.
+
+    :param path:
+    :param fmt:
+    :return:
+    """
+    key = (os.getpid(), path)
+    writer = _writers.get(key)
+    if writer is None:
+        with _writers_lock:
+            writer = _writers.get(key)
+            if writer is None:
+                writer = _writers[key] = ProfileWriter(
+                    process_path(path), fmt,
+                    max_bytes=getattr(settings, 'LOG_QUERY_PROFILE_MAX_BYTES', 10 * 1024 * 1024),
+                    backups=getattr(settings, 'LOG_QUERY_PROFILE_BACKUPS', 5))
+    return writer
+
+
+def iter_profiles(path):
+    """
+    Streams the profiles out of a JSONL or binary profile file. The file is memory mapped and read one profile at a
+    time, so files much larger than memory can be read. Corrupt records are skipped.
+
+    :param path:
+    :return: a generator of profile dicts
+    """
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if mm[:len(BINARY_MAGIC)] == BINARY_MAGIC:
+                pos = len(BINARY_MAGIC)
+                end = len(mm)
+                while pos + LENGTH.size <= end:
+                    length = LENGTH.unpack(mm[pos:pos + LENGTH.size])[0]
+                    pos += LENGTH.size
+                    if pos + length > end:  # Cut short, the writer was killed mid record
+                        break
+                    try:
+                        profile = json.loads(zlib.decompress(mm[pos:pos + length]).decode('utf-8'))
+                    except (zlib.error, ValueError):  # Corrupt, skip to the next record
+                        profile = None
+                    pos += length
+                    if profile is not None:
+                        yield profile
+            else:
+                for line in iter(mm.readline, b''):
+                    line = line.strip()
+                    if line:
+                        try:
+                            yield json.loads(line.decode('utf-8'))
+                        except ValueError:  # Cut short, the writer was killed mid line
+                            continue
+        finally:
+            mm.close()
+
+
+class FingerprintReport(object):
+    """
+    One fingerprint merged across every profile read
+    """
+    __slots__ = ('sql', 'count', 'total_time', 'max_time', 'profiles', 'classes', 'sites', 'histogram')
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.profiles = 0
+        self.classes = {}
+        self.sites = {}
+        self.histogram = LatencyHistogram()
+
+    def add(self, query, class_name):
+        self.count += query['count']
+        self.total_time += query['time']
+        self.max_time = max(self.max_time, query['max'])
+        self.profiles += 1
+        self.classes[class_name] = self.classes.get(class_name, 0) + query['count']
+        for site, n in query['sites'].items():
+            self.sites[site] = self.sites.get(site, 0) + n
+        histogram = self.histogram
+        for index, n in query['histogram']:
+            if index >= len(histogram.counts):
+                histogram.counts.extend([0] * (index + 1 - len(histogram.counts)))
+            histogram.counts[index] += n
+            histogram.count += n
+        histogram.max = self.max_time
+
+
+class ClassReport(object):
+    """
+    The totals of every profile one class logged
+    """
+    __slots__ = ('class_name', 'profiles', 'num', 'duplicates', 'sqltime', 'totaltime')
+
+    def __init__(self, class_name):
+        self.class_name = class_name
+        self.profiles = 0
+        self.num = 0
+        self.duplicates = 0
+        self.sqltime = 0.0
+        self.totaltime = 0.0
+
+    def add(self, profile):
+        self.profiles += 1
+        self.num += profile['num']
+        self.duplicates += profile['duplicates']
+        self.sqltime += profile['sqltime']
+        self.totaltime += profile['totaltime']
+
+
+class ProfileReport(object):
+    """
+    Merges any number of profiles, one at a time, into per fingerprint and per class totals.
+    """
+
+    def __init__(self):
+        self.profiles = 0
+        self.fingerprints = {}
+        self.classes = {}
+
+    def add(self, profile):
+        class_name = profile['class_name']
+        self.profiles += 1
+        class_report = self.classes.get(class_name)
+        if class_report is None:
+            class_report = self.classes[class_name] = ClassReport(class_name)
+        class_report.add(profile)
+        for query in profile['queries']:
+            report = self.fingerprints.get(query['sql'])
+            if report is None:
+                report = self.fingerprints[query['sql']] = FingerprintReport(query['sql'])
+            report.add(query, class_name)
+
+    def add_files(self, paths):
+        for path in paths:
+            for profile in iter_profiles(path):
+                self.add(profile)
+        return self
+
+    def top_fingerprints(self, n=20):
+        return sorted(self.fingerprints.values(), key=lambda r: r.total_time, reverse=True)[:n]
+
+    def worst_classes(self, n=20):
+        return sorted(self.classes.values(), key=lambda r: r.sqltime, reverse=True)[:n]
+
+    def regressions(self, baseline, n=20):
+        """
+        The fingerprints that cost more per profile than they did in the baseline, because each execution got slower,
+        it runs more often, or both. Fingerprints the baseline never saw count from zero.
+
+        :param baseline: a ProfileReport of the earlier profiles
+        :param n:
+        :return: a list of (FingerprintReport, baseline FingerprintReport or None, seconds added per profile), worst
+                 first
+        """
+        found = []
+        for sql, report in self.fingerprints.items():
+            before = baseline.fingerprints.get(sql)
+            before_time = before.total_time / baseline.profiles if before is not None else 0.0
+            added = report.total_time / self.profiles - before_time
+            if added > 0:
+                found.append((report, before, added))
+        return sorted(found, key=lambda r: r[2], reverse=True)[:n]
@@ -0,0 +1,21 @@
+# third party
+import pytest
+
+# project
+from .budget import RAISE, QueryBudget
+
+
+@pytest.fixture
+def query_budget():
+    """
+    Asserts what a block of code runs, failing the test with the report of every statement it ran when it goes over
+    budget. Enable it with `pytest_plugins = ['query_logger.pytest_plugin']` in conftest.py:
+
+        def test_checkout(client, db, query_budget):
+            with query_budget(max_queries=5, max_duplicates=0):
+                client.post('/checkout/')
+    """
+    def budget(max_queries=None, max_duplicates=None, max_sql_time=None, fingerprints=None, **config_opts):
+        config_opts.setdefault('log_tracebacks', True)
+        return QueryBudget(max_queries, max_duplicates, max_sql_time, fingerprints, action=RAISE, **config_opts)
+    return budget
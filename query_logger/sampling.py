@@ -0,0 +1,67 @@
+# std lib
+import random
+import threading
+
+# project
+from .capture import timer
+
+
+class RateLimiter(object):
+    """
+    A token bucket that lets through at most `rate` sessions per second, process wide, with bursts of up to one
+    second's worth. Rates below one a second still hold a whole token, or the bucket would never let anything through.
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.capacity = max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.last = timer()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = timer()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(rate):
+    """
+    The shared limiter for a rate, so every session configured with the same limit draws from the same bucket.
+
+    :param rate:
+    :return:
+    """
+    limiter = _limiters.get(rate)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.setdefault(rate, RateLimiter(rate))
+    return limiter
+
+
+def should_sample(class_name, cfg):
+    """
+    Decides whether a session started by class_name gets the full treatment. The class' rate in
+    cfg.class_sample_rates wins over cfg.sample_rate, and cfg.sample_rate_limit caps whatever makes it through.
+
+    :param class_name:
+    :param cfg:
+    :return:
+    """
+    rate = cfg.class_sample_rates.get(class_name, cfg.sample_rate)
+    if rate is None:
+        rate = 1.0
+    if rate <= 0 or (rate < 1 and random.random() >= rate):
+        return False
+    if cfg.sample_rate_limit:
+        return get_rate_limiter(cfg.sample_rate_limit).acquire()
+    return True
@@ -0,0 +1,222 @@
+# std lib
+import time
+
+# project
+from . import capture, explain, tracebacks
+from .aggregator import QueryAggregator, QueryTotals
+from .bulkwrites import inserted_rows
+from .fingerprint import fingerprint
+from .local import ContextStack
+from .memo import QueryMemo
+from .timeline import Timeline
+
+# Every session running in the current context, innermost last
+_sessions = ContextStack('query_logger_sessions')
+
+
+class QueryLoggingSession(object):
+    """
+    Everything one start_query_logging / stop_query_logging pair collects. Sessions live in the current context (thread
+    or asyncio task) rather than on the mixin, so the same object can run overlapping or nested sessions, and sessions
+    running concurrently elsewhere never see each other's queries.
+    """
+    sampled = True
+
+    def __init__(self, owner, cfg):
+        self.owner = owner
+        self.cfg = cfg
+        self.aggregator = self.new_aggregator()
+        # The individual queries are only kept around for the testing return value
+        self.infos = [] if cfg.testing else None
+        # Log records are batched up here when they are emitted asynchronously
+        self.log_records = [] if cfg.async_logging else None
+        self.start_time = None
+        # Totals of the windows flushed so far, when checkpointing
+        self.totals = None
+        self.checkpointing = bool(cfg.checkpoint_queries or cfg.checkpoint_seconds)
+        self.window_start = None
+        # Repeats of the same SELECT are served from here when memoize_selects is on
+        self.memo = QueryMemo(cfg.memo_max_rows, cfg.memo_max_bytes) if cfg.memoize_selects else None
+        self.timeline = None
+        self._handles = []
+
+    def record_query(self, alias, sql, duration, params=None, batch=None):
+        """
+        Capture listener. Called by the capturing cursor as soon as each query finishes, so the query is fingerprinted
+        and folded into the session's aggregator without ever being kept around on its own.
+
+        When tracebacks are turned on the current stack is captured as well, but only for the first execution of each
+        fingerprint since that is the only one that ever gets logged. The stack is kept as interned code object / line
+        number pairs and is only turned into text if it is logged.
+
+        Slow SELECTs are explained here too when explain_slow_queries is on, after the query's own timing has ended.
+
+        With the timeline on the query is placed on it as well, going by when this listener was called.
+
+        :param alias:
+        :param sql:
+        :param duration: seconds
+        :param params:
+        :param batch: the number of parameter sets, for executemany
+        :return:
+        """
+        end = capture.timer() if self.timeline is not None else None
+        raw_sql, sql = sql, fingerprint(sql)
+        tb = None
+        if self.cfg.log_tracebacks and sql not in self.aggregator:
+            tb = tracebacks.capture_stack(self.cfg.log_traceback_depth)
+        # N+1 detection and the timeline need to know which line of code issued every query, but only that one frame
+        site = tracebacks.capture_stack(1) if self.cfg.detect_nplusone or self.timeline is not None else None
+        rows = inserted_rows(raw_sql) if self.aggregator.track_write_runs else None
+        entry = self.aggregator.add(sql, duration, tb, alias, site, batch, rows)
+        if self.timeline is not None:
+            self.timeline.record(end, duration, sql, alias, site)
+        self.explain_slow(entry, alias, raw_sql, duration, params)
+
+        if self.infos is not None:
+            qi = self.owner.QueryInfo()
+            qi.sql = sql
+            qi.time = duration
+            qi.tb = tb
+            self.infos.append(qi)
+
+        if self.checkpointing and self.checkpoint_due():
+            self.owner.flush_query_window(self)
+
+    def new_aggregator(self):
+        cfg = self.cfg
+        if cfg.count_rows:
+            return QueryAggregator(cfg.log_long_running_time, cfg.large_result_rows, cfg.large_result_bytes,
+                                   track_write_runs=cfg.detect_bulk_writes)
+        return QueryAggregator(cfg.log_long_running_time, track_write_runs=cfg.detect_bulk_writes)
+
+    def record_rows(self, alias, sql, rows, size, statement_rows, statement_size):
+        """
+        Row listener, called by the capturing cursor as rows are fetched when count_rows is on.
+
+        :param alias:
+        :param sql:
+        :param rows:
+        :param size: approximate bytes
+        :param statement_rows: the running total for the execution the rows belong to
+        :param statement_size:
+        :return:
+        """
+        self.aggregator.add_rows(fingerprint(sql), rows, size, statement_rows, statement_size)
+
+    def record_event(self, alias, event, duration):
+        """
+        Event listener, called by the connection when it connects, creates a cursor, or begins, commits or rolls back
+        a transaction or savepoint.
+
+        :param alias:
+        :param event:
+        :param duration: seconds
+        :return:
+        """
+        self.aggregator.add_event(alias, event, duration)
+
+    def explain_slow(self, entry, alias, raw_sql, duration, params):
+        if (self.cfg.explain_slow_queries and entry.plan is None and self.aggregator.slow_limit is not None and
+                duration > self.aggregator.slow_limit):
+            entry.plan = explain.explain(alias, entry.sql, raw_sql, params)
+
+    def checkpoint_due(self):
+        cfg = self.cfg
+        if cfg.checkpoint_queries and self.aggregator.num_queries >= cfg.checkpoint_queries:
+            return True
+        return bool(cfg.checkpoint_seconds) and time.time() - self.window_start >= cfg.checkpoint_seconds
+
+    def rotate(self):
+        """
+        Ends the current window: its totals are folded into the session totals and a fresh aggregator takes over, so
+        the finished window's per fingerprint stats can be reported on and dropped.
+
+        :return: the finished window's aggregator
+        """
+        aggregator = self.aggregator
+        self.aggregator = self.new_aggregator()
+        if self.totals is None:
+            # Budgets limit fingerprints over the whole session, not just the window they are checked at the end of
+            self.totals = QueryTotals(self.cfg.budget.fingerprints if self.cfg.budget is not None else ())
+        self.totals.add(aggregator)
+        self.window_start = time.time()
+        return aggregator
+
+    def start(self):
+        """
+        Starts listening to every configured connection. They all feed the one aggregator, so logging several
+        connections costs the same per query as logging one. Sessions memoizing SELECTs hook the connections even when
+        they have nothing to listen for.
+
+        :return:
+        """
+        # Session time is measured on the monotonic clock, so it is never thrown off by the wall clock being set
+        self.start_time = capture.timer()
+        self.window_start = time.time()
+        if self.cfg.timeline and self.sampled:
+            self.timeline = Timeline(self.cfg.timeline_max_events)
+        _sessions.push(self)
+        if self.listening or self.memo is not None:
+            listener = self.record_query if self.listening else None
+            row_listener = self.record_rows if self.cfg.count_rows and self.sampled else None
+            event_listener = self.record_event if self.sampled else None
+            for con_name in self.cfg.connection_names:
+                self._handles.append(capture.install(con_name, listener, row_listener, self.memo, event_listener))
+
+    @property
+    def listening(self):
+        return True
+
+    def stop_capture(self):
+        """
+        Stops listening for queries and returns the total session time. The session stays current until close() so the
+        owner can still get at it while reporting.
+
+        :return:
+        """
+        while self._handles:
+            capture.uninstall(self._handles.pop())
+        if self.timeline is not None:
+            self.timeline.finish()
+        return capture.timer() - self.start_time
+
+    def close(self):
+        while self._handles:
+            capture.uninstall(self._handles.pop())
+        _sessions.remove(self)
+
+
+class UnsampledQueryLoggingSession(QueryLoggingSession):
+    """
+    Stands in for a session that lost the sampling draw. Queries are only looked at for the long running query tail
+    rule: nothing is fingerprinted, kept or traced unless it ran over the limit, and when the tail rule is off the
+    connections are not even hooked.
+    """
+    sampled = False
+
+    def __init__(self, owner, cfg):
+        super(UnsampledQueryLoggingSession, self).__init__(owner, cfg)
+        self.infos = None
+
+    @property
+    def listening(self):
+        return bool(self.cfg.log_unsampled_long_running and self.aggregator.slow_limit is not None)
+
+    def record_query(self, alias, sql, duration, params=None, batch=None):
+        if duration > self.aggregator.slow_limit:
+            entry = self.aggregator.add(fingerprint(sql), duration, None, alias)
+            self.explain_slow(entry, alias, sql, duration, params)
+
+
+def current_session(owner):
+    """
+    The innermost session started by owner in the current context, or None.
+
+    :param owner:
+    :return:
+    """
+    for session in reversed(_sessions.get()):
+        if session.owner is owner:
+            return session
+    return None
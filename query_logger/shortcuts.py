@@ -0,0 +1,103 @@
+# std lib
+from functools import wraps
+from logging import getLogger
+
+# project
+from .config import logging_enabled
+from .local import ContextStack
+from .mixin import DatabaseQueryLoggerMixin
+
+logger = getLogger(__name__)
+
+# (query_logging, started) for every query_logging block entered in the current context, innermost last
+_entered = ContextStack('query_logger_entered')
+
+
+class QueryLogger(DatabaseQueryLoggerMixin):
+    """
+    Owns the sessions started by the entry points that are not a mixin subclass themselves, and logs them under
+    `name` instead of a class name.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def get_query_logger_name(self):
+        return self.name
+
+
+def stop_logging(owner, exc_type=None):
+    """
+    Stops owner's innermost session. The session is always torn down, but an error while reporting on it is only
+    logged, not raised, when an exception is already on its way out so that one never hides the other.
+
+    :param owner:
+    :param exc_type: the type of the exception being raised, if any
+    :return:
+    """
+    try:
+        return owner.stop_query_logging()
+    except Exception:
+        if exc_type is None:
+            raise
+        logger.exception('[SQL] failed to stop query logging')
+
+
+class query_logging(object):
+    """
+    Logs the queries run inside a block, or a function, the same way start_query_logging / stop_query_logging would:
+
+        with query_logging('nightly_import', log_tracebacks=True):
+            ...
+
+        @query_logging(detect_nplusone=True)
+        def send_invoices():
+            ...
+
+    The session is always stopped, whatever the block raises. `enabled` can be a bool or a callable taking no
+    arguments; when it, or settings.LOG_QUERY_ENABLED, says no the block runs untouched, without a config being built
+    or a connection being hooked.
+
+    Works on Celery tasks as well, as long as it goes under the task decorator:
+
+        @app.task
+        @query_logging()
+        def import_orders():
+            ...
+    """
+
+    def __init__(self, name=None, enabled=True, **config_opts):
+        self.name = name
+        self.enabled = enabled
+        self.config_opts = config_opts
+        self.owner = QueryLogger(name or 'query_logging')
+
+    def is_enabled(self):
+        if not logging_enabled():
+            return False
+        return self.enabled() if callable(self.enabled) else self.enabled
+
+    def __enter__(self):
+        started = self.is_enabled()
+        if started:
+            self.owner.start_query_logging(self.config_opts)
+        _entered.push((self, started))
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        for entry in reversed(_entered.get()):
+            if entry[0] is self:
+                _entered.remove(entry)
+                if entry[1]:
+                    stop_logging(self.owner, exc_type)
+                break
+        return False
+
+    def __call__(self, func):
+        block = type(self)(self.name or '%s.%s' % (func.__module__, func.__name__), self.enabled, **self.config_opts)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with block:
+                return func(*args, **kwargs)
+        return wrapper
@@ -0,0 +1,205 @@
+# std lib
+import threading
+import time
+from logging import INFO, getLogger
+
+# django
+from django.conf import settings
+
+# project
+from .emitter import defer
+from .histogram import LatencyHistogram
+
+logger = getLogger(__name__)
+
+# How many issuing class names to remember per fingerprint
+MAX_CLASSES = 8
+
+
+class RollingEntry(object):
+    """
+    Merged stats for one fingerprint in one window. `error` is the space saving over-estimate: the total time of the
+    entry this one evicted, which may or may not really belong to this fingerprint.
+    """
+    __slots__ = ('sql', 'count', 'total_time', 'max_time', 'error', 'classes', 'histogram')
+
+    def __init__(self, sql, error=0.0):
+        self.sql = sql
+        self.count = 0
+        self.total_time = error
+        self.max_time = 0.0
+        self.error = error
+        self.classes = {}
+        self.histogram = LatencyHistogram()
+
+    def merge(self, count, total_time, max_time, classes, histogram):
+        self.count += count
+        self.total_time += total_time
+        if max_time > self.max_time:
+            self.max_time = max_time
+        self.histogram.merge(histogram)
+        for class_name, n in classes.items():
+            if class_name in self.classes or len(self.classes) < MAX_CLASSES:
+                self.classes[class_name] = self.classes.get(class_name, 0) + n
+
+
+class SpaceSaving(object):
+    """
+    Weighted space saving heavy hitters summary, ranked by total time. Holds at most `capacity` fingerprints; when a
+    new one arrives with the summary full, it takes over the slot of the cheapest entry and inherits its total time as
+    its error, so the expensive statements are always kept while memory stays fixed.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = {}
+
+    def add(self, sql, count, total_time, max_time, classes, histogram):
+        entry = self.entries.get(sql)
+        if entry is None:
+            if len(self.entries) >= self.capacity:
+                victim = min(self.entries.values(), key=lambda e: e.total_time)
+                del self.entries[victim.sql]
+                entry = RollingEntry(sql, victim.total_time)
+            else:
+                entry = RollingEntry(sql)
+            self.entries[sql] = entry
+        entry.merge(count, total_time, max_time, classes, histogram)
+
+
+class RollingStatsStore(object):
+    """
+    In-process aggregate of every session's per fingerprint stats. Time is cut into `num_windows` windows of
+    `window_seconds` each, every one holding its own space saving summary, and windows that fall out of range are
+    dropped, so old traffic decays away and memory never grows past num_windows * capacity entries.
+    """
+
+    def __init__(self, capacity=200, window_seconds=60, num_windows=5, emit_interval=300, emit_top=10):
+        self.capacity = capacity
+        self.window_seconds = window_seconds
+        self.num_windows = num_windows
+        self.emit_interval = emit_interval
+        self.emit_top = emit_top
+        self._windows = {}
+        self._lock = threading.Lock()
+        self._last_emit = time.time()
+
+    def _window_index(self, now):
+        return int(now // self.window_seconds)
+
+    def merge(self, aggregator, class_name, now=None, records=None):
+        """
+        Folds one finished session into the current window.
+
+        :param aggregator: the session's QueryAggregator
+        :param class_name:
+        :param now:
+        :param records: the session's deferred log records when it logs asynchronously
+        :return:
+        """
+        now = time.time() if now is None else now
+        index = self._window_index(now)
+        with self._lock:
+            window = self._windows.get(index)
+            if window is None:
+                window = self._windows[index] = SpaceSaving(self.capacity)
+                for old in [i for i in self._windows if i <= index - self.num_windows]:
+                    del self._windows[old]
+            for entry in aggregator.stats.values():
+                window.add(entry.sql, entry.count, entry.total_time, entry.max_time, {class_name: entry.count},
+                           entry.histogram)
+        self.maybe_emit(now, records)
+
+    def top(self, n=50, seconds=None, now=None):
+        """
+        The n most expensive fingerprints, by total time, from every window overlapping the last `seconds`
+        (everything still held by default).
+
+        :param n:
+        :param seconds:
+        :param now:
+        :return: a list of RollingEntry, most expensive first
+        """
+        now = time.time() if now is None else now
+        index = self._window_index(now)
+        first = index - self.num_windows + 1
+        if seconds is not None:
+            first = max(first, self._window_index(now - seconds))
+        merged = {}
+        with self._lock:
+            for i in range(first, index + 1):
+                window = self._windows.get(i)
+                if window is None:
+                    continue
+                for entry in window.entries.values():
+                    total = merged.get(entry.sql)
+                    if total is None:
+                        total = merged[entry.sql] = RollingEntry(entry.sql)
+                    total.merge(entry.count, entry.total_time, entry.max_time, entry.classes, entry.histogram)
+                    total.error += entry.error
+        return sorted(merged.values(), key=lambda e: e.total_time, reverse=True)[:n]
+
+    def maybe_emit(self, now=None, records=None):
+        """
+        Logs the current top fingerprints if emit_interval seconds have passed since the last time. Called after every
+        merge, so there is no need for a timer thread.
+
+        :param now:
+        :param records: when given, the records are deferred to it for the emitter instead of logged right away
+        :return:
+        """
+        if not self.emit_interval:
+            return
+        now = time.time() if now is None else now
+        with self._lock:
+            if now - self._last_emit < self.emit_interval:
+                return
+            self._last_emit = now
+        for rank, entry in enumerate(self.top(self.emit_top, self.emit_interval, now), 1):
+            extra = {
+                'rank': rank,
+                'num': entry.count,
+                'sqltime': entry.total_time,
+                'maxtime': entry.max_time,
+                'classes': dict(entry.classes),
+                'sql': entry.sql,
+                'logtype': 'querylog__rolling'
+            }
+            extra.update(entry.histogram.percentiles())
+            msg = '[SQL] top query #%d over the last %d s: %d queries, %d ms SQL time: %s' % (
+                rank,
+                self.emit_interval,
+                entry.count,
+                entry.total_time * 1000,
+                entry.sql)
+            if records is None:
+                logger.info(msg, extra=extra)
+            else:
+                defer(records, logger, INFO, msg, extra)
+
+    def clear(self):
+        with self._lock:
+            self._windows.clear()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """
+    The process wide store, configured from the LOG_QUERY_ROLLING_STATS_* settings on first use.
+
+    :return:
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = RollingStatsStore(
+                    capacity=getattr(settings, 'LOG_QUERY_ROLLING_STATS_CAPACITY', 200),
+                    window_seconds=getattr(settings, 'LOG_QUERY_ROLLING_STATS_WINDOW', 60),
+                    num_windows=getattr(settings, 'LOG_QUERY_ROLLING_STATS_WINDOWS', 5),
+                    emit_interval=getattr(settings, 'LOG_QUERY_ROLLING_STATS_EMIT_INTERVAL', 300),
+                    emit_top=getattr(settings, 'LOG_QUERY_ROLLING_STATS_EMIT_TOP', 10))
+    return _store
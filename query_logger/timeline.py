@@ -0,0 +1,155 @@
+# std lib
+import itertools
+import json
+import os
+import re
+import threading
+import time
+
+# project
+from .capture import timer
+from .tracebacks import format_site
+
+# Call sites listed in the timeline record, the ones with the most Python time first
+TOP_SITES = 10
+# Longest name given to a query in a trace, the full SQL is in its args
+TRACE_NAME_LENGTH = 80
+
+# Keeps trace file names apart when sessions start in the same millisecond
+_sequence = itertools.count()
+
+
+class SiteGaps(object):
+    """
+    The Python time spent leading up to the queries issued from one call site
+    """
+    __slots__ = ('site', 'time', 'count')
+
+    def __init__(self, site):
+        self.site = site
+        self.time = 0.0
+        self.count = 0
+
+    @property
+    def call_site(self):
+        return format_site(self.site)
+
+
+class Timeline(object):
+    """
+    When each query of a session ran, as offsets in seconds from the start of the session on a monotonic clock, and
+    where the time between queries went. A gap between two queries is Python time: building model instances from the
+    last result, serializing, anything else. It is put down to the call site of the query that ends it, the line the
+    code was heading for.
+
+    Per call site totals are kept for the whole session, the individual queries only up to max_events.
+    """
+
+    def __init__(self, max_events=10000):
+        self.max_events = max_events
+        self.start_time = time.time()
+        self.start = timer()
+        self.end = None
+        # (start, end, sql, alias, site) per query
+        self.events = []
+        self.dropped = 0
+        self.sql_time = 0.0
+        # Before the first query, and between queries
+        self.lead_time = None
+        self.python_time = 0.0
+        self.sites = {}
+        self._last_end = 0.0
+        self.thread = threading.current_thread().ident
+
+    def record(self, end, duration, sql, alias, site):
+        """
+        Adds a query that just finished.
+
+        :param end: the clock reading when it finished
+        :param duration: seconds
+        :param sql: its fingerprint
+        :param alias:
+        :param site: the call site it was issued from
+        :return:
+        """
+        end -= self.start
+        start = max(end - duration, self._last_end)
+        gap = start - self._last_end
+        if self.lead_time is None:
+            self.lead_time = gap
+        else:
+            self.python_time += gap
+            gaps = self.sites.get(site)
+            if gaps is None:
+                gaps = self.sites[site] = SiteGaps(site)
+            gaps.time += gap
+            gaps.count += 1
+        self.sql_time += end - start
+        self._last_end = end
+        if len(self.events) < self.max_events:
+            self.events.append((start, end, sql, alias, site))
+        else:
+            self.dropped += 1
+
+    def finish(self):
+        self.end = timer() - self.start
+
+    @property
+    def total_time(self):
+        return self.end if self.end is not None else timer() - self.start
+
+    @property
+    def tail_time(self):
+        """
+        After the last query, or the whole session if it ran none
+        """
+        return self.total_time - self._last_end
+
+    def top_sites(self, n=TOP_SITES):
+        return sorted(self.sites.values(), key=lambda s: s.time, reverse=True)[:n]
+
+    def chrome_trace(self, name):
+        """
+        The timeline in the Chrome trace event format, which chrome://tracing, Perfetto and speedscope show as a flame
+        chart: the session, every query, and the Python time before each one.
+
+        :param name: what to call the session
+        :return: plain JSON data
+        """
+        pid = os.getpid()
+        tid = self.thread
+
+        def event(cat, name, start, end, args):
+            return {'ph': 'X', 'cat': cat, 'name': name, 'ts': start * 1000000, 'dur': (end - start) * 1000000,
+                    'pid': pid, 'tid': tid, 'args': args}
+
+        events = [event('session', name, 0.0, self.total_time, {'queries': len(self.events) + self.dropped})]
+        last_end = 0.0
+        for start, end, sql, alias, site in self.events:
+            call_site = format_site(site)
+            if start > last_end:
+                events.append(event('python', call_site, last_end, start, {}))
+            events.append(event('sql', sql[:TRACE_NAME_LENGTH], start, end,
+                                {'sql': sql, 'connection': alias, 'callsite': call_site}))
+            last_end = end
+        return {
+            'traceEvents': events,
+            'displayTimeUnit': 'ms',
+            'otherData': {'session': name, 'start': self.start_time, 'dropped': self.dropped},
+        }
+
+    def write_chrome_trace(self, directory, name):
+        """
+        Writes the Chrome trace to its own file in a directory.
+
+        :param directory:
+        :param name: what to call the session
+        :return: the file's path
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, '%s-%d-%d-%d.json' % (re.sub(r'[^\w.-]', '_', name), self.start_time * 1000,
+                                                             os.getpid(), next(_sequence)))
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(name), f)
+        return path
@@ -0,0 +1,94 @@
+# std lib
+import linecache
+import os
+import sys
+import sysconfig
+
+# django
+import django
+
+# Frames from any of these directories are never interesting when working out why a query ran
+_IGNORED_DIRS = tuple(os.path.join(os.path.realpath(path), '') for path in (
+    os.path.dirname(django.__file__),
+    os.path.dirname(__file__),
+    sysconfig.get_paths()['stdlib'],
+))
+_THIRD_PARTY_DIRS = ('site-packages', 'dist-packages')
+
+# How many distinct stacks to intern before we stop bothering. Past this we just hand back a fresh tuple.
+MAX_INTERNED_STACKS = 10000
+
+_skip_cache = {}
+_interned = {}
+
+
+def _should_skip(filename):
+    path = os.path.realpath(filename)
+    if not path.startswith(_IGNORED_DIRS):
+        return False
+    # The stdlib directory usually contains site-packages, which is where everybody else's code lives
+    return path.startswith(_IGNORED_DIRS[:2]) or not any(d in path for d in _THIRD_PARTY_DIRS)
+
+
+def capture_stack(limit=None):
+    """
+    Captures the calling stack as a tuple of (code object, line number) pairs, outermost call first. Django, stdlib
+    and query logger frames are skipped and at most `limit` of the innermost remaining frames are kept. Nothing is
+    formatted and no source is read, so this is cheap enough to run per query; identical stacks come back as the same
+    interned tuple.
+
+    :param limit:
+    :return:
+    """
+    frame = sys._getframe(1)
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        skip = _skip_cache.get(code.co_filename)
+        if skip is None:
+            skip = _skip_cache[code.co_filename] = _should_skip(code.co_filename)
+        if not skip:
+            stack.append((code, frame.f_lineno))
+            if limit and len(stack) >= limit:
+                break
+        frame = frame.f_back
+    stack.reverse()
+    stack = tuple(stack)
+
+    interned = _interned.get(stack)
+    if interned is not None:
+        return interned
+    if len(_interned) < MAX_INTERNED_STACKS:
+        _interned[stack] = stack
+    return stack
+
+
+def extract(stack):
+    """
+    Resolves a captured stack into (filename, line number, function name, source line) tuples, the same shape
+    traceback.extract_stack() produces. Only done for the stacks that actually get logged.
+
+    :param stack:
+    :return:
+    """
+    retval = []
+    for code, lineno in stack:
+        line = linecache.getline(code.co_filename, lineno)
+        retval.append((code.co_filename, lineno, code.co_name, line.strip() if line else None))
+    return retval
+
+
+def format_site(stack, full_path=False):
+    """
+    Formats the innermost frame of a captured stack as `file:line in function`, the file given by its base name unless
+    full_path is set.
+
+    :param stack:
+    :param full_path:
+    :return:
+    """
+    if not stack:
+        return '<unknown>'
+    code, lineno = stack[-1]
+    filename = code.co_filename if full_path else os.path.basename(code.co_filename)
+    return '%s:%d in %s' % (filename, lineno, code.co_name)
@@ -0,0 +1,19 @@
+# django
+from django.http import HttpResponse
+
+# project
+from . import metrics
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+def query_metrics(request):
+    """
+    Every worker's query metrics, merged, for Prometheus to scrape. Route it somewhere only your monitoring can reach:
+
+        url(r'^metrics/queries$', query_metrics)
+
+    :param request:
+    :return:
+    """
+    return HttpResponse(metrics.render(), content_type=CONTENT_TYPE)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+"""
+Overhead benchmarks for the query logger mixin, run against the testapp models on an in-memory SQLite database.
+
+    python benchmark.py                          # print results as JSON
+    python benchmark.py --output after.json      # ... or save them
+    python benchmark.py --compare before.json    # and show the change against an earlier run
+
+Measures per query overhead (for ORM lookups and for raw cursor queries, where the logger's share is much easier to
+see) with logging off, on, with duplicate logging and with tracebacks, how long
+stop_query_logging takes as the number of queries in a session grows, and peak memory per session (Python 3.4+).
+Everything runs with DEBUG off, as in production, so queries don't go through Django's debug cursor.
+"""
+# std lib
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'testproject.settings')
+
+# django
+import django
+from django.conf import settings
+from django.db import connection
+
+if hasattr(django, 'setup'):
+    django.setup()
+
+try:
+    import tracemalloc
+except ImportError:  # Python < 3.4
+    tracemalloc = None
+
+# project
+from query_logger import DatabaseQueryLoggerMixin
+from testapp.memorylog import MemoryHandler
+from testapp.models import Author, Book, Publisher
+
+timer = getattr(time, 'perf_counter', time.time)
+
+MODES = (
+    ('off', None),
+    ('on', {'log_duplicate_queries': False}),
+    ('duplicates', {'log_duplicate_queries': True}),
+    ('tracebacks', {'log_duplicate_queries': True, 'log_tracebacks': True}),
+)
+
+
+class Benchmark(DatabaseQueryLoggerMixin):
+    pass
+
+
+def setup_database():
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    publisher = Publisher.objects.create(name='Publisher')
+    for i in range(20):
+        author = Author.objects.create(name='Author %d' % i)
+        Book.objects.create(author=author, publisher=publisher, title='Book %d' % i)
+
+
+def run_orm_queries(n):
+    """
+    The N+1 shape the logger exists to find: one lookup per object.
+    """
+    for i in range(n):
+        list(Author.objects.filter(id=i % 20 + 1))
+
+
+def run_raw_queries(n, distinct=50):
+    cursor = connection.cursor()
+    for i in range(n):
+        cursor.execute('SELECT %d, %%s' % (i % distinct), [i])
+
+
+def timed_session(config, fn, n):
+    bench = Benchmark()
+    start = timer()
+    if config is not None:
+        bench.start_query_logging(config)
+    fn(n)
+    if config is not None:
+        bench.stop_query_logging()
+    MemoryHandler.get_log()
+    return timer() - start
+
+
+def per_query_overhead(fn, n, repeat):
+    """
+    Microseconds each mode adds to a query, against the best of `repeat` runs of n queries with logging off. Every
+    mode gets one untimed run first so caches are warm for all of them.
+    """
+    for name, config in MODES:
+        timed_session(config, fn, n)
+    best = {}
+    for _ in range(repeat):
+        for name, config in MODES:
+            elapsed = timed_session(config, fn, n)
+            best[name] = min(best.get(name, elapsed), elapsed)
+    results = {}
+    for name, _ in MODES:
+        results[name] = {
+            'us_per_query': best[name] / n * 1000000,
+            'overhead_us_per_query': (best[name] - best['off']) / n * 1000000,
+        }
+    return results
+
+
+def stop_latency(sizes, repeat):
+    """
+    Milliseconds stop_query_logging takes after sessions of increasing size.
+    """
+    results = {}
+    for size in sizes:
+        best = None
+        for _ in range(repeat):
+            bench = Benchmark()
+            bench.start_query_logging({'log_duplicate_queries': True})
+            run_raw_queries(size)
+            start = timer()
+            bench.stop_query_logging()
+            elapsed = timer() - start
+            MemoryHandler.get_log()
+            best = elapsed if best is None else min(best, elapsed)
+        results[str(size)] = {'stop_ms': best * 1000}
+    return results
+
+
+def peak_memory(sizes):
+    """
+    Peak bytes allocated over the course of a session, beyond what the queries themselves need.
+    """
+    if tracemalloc is None:
+        return None
+    results = {}
+    for size in sizes:
+        peaks = {}
+        for name, config in (('off', None), ('on', {'log_duplicate_queries': True})):
+            tracemalloc.start()
+            timed_session(config, run_raw_queries, size)
+            peaks[name] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        results[str(size)] = {'peak_bytes': peaks['on'], 'overhead_bytes': peaks['on'] - peaks['off']}
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(results, prefix=''):
+    for key, value in sorted(results.items()):
+        if isinstance(value, dict):
+            for item in flatten(value, prefix + key + '.'):
+                yield item
+        elif isinstance(value, (int, float)):
+            yield prefix + key, value
+
+
+def compare(before, after):
+    old = dict(flatten(before['results']))
+    for key, value in flatten(after['results']):
+        if key in old and old[key]:
+            print('%-55s %14.2f -> %14.2f  %+7.1f%%' % (key, old[key], value, (value - old[key]) * 100.0 / old[key]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--queries', type=int, default=2000, help='queries per overhead run')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per measurement, the best one counts')
+    parser.add_argument('--sizes', default='10,100,1000,10000,100000',
+                        help='comma separated session sizes for the stop latency and memory runs')
+    parser.add_argument('--output', help='write the JSON results to this file')
+    parser.add_argument('--compare', help='an earlier JSON results file to compare against')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    # The test settings turn DEBUG on, which would time Django's debug cursor along with the logger
+    settings.DEBUG = False
+    setup_database()
+
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'queries': args.queries,
+            'repeat': args.repeat,
+            'debug': settings.DEBUG,
+        },
+        'results': {
+            'per_query': {
+                'orm': per_query_overhead(run_orm_queries, args.queries, args.repeat),
+                'raw': per_query_overhead(run_raw_queries, args.queries * 10, args.repeat),
+            },
+            'stop_latency': stop_latency(sizes, max(1, args.repeat // 2)),
+            'peak_memory': peak_memory(sizes),
+        },
+    }
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,22 +1,68 @@
 # stdlib
-import inspect
+import json
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+from logging import WARNING, Handler, getLogger
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 # django
 from django.conf import settings
-from django.test import TestCase
+from django.core.management import call_command
+from django.db import connections, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test.client import RequestFactory
 from django.test.utils import override_settings
-try:
-    from django.db.backends import util
-except ImportError:  # Django changed util to utils at some point
-    from django.db.backends import utils as util
 
 # third party
-from query_logger import DatabaseQueryLoggerMixin
+from query_logger import baseline as query_baseline
+from query_logger import (DatabaseQueryLoggerMixin, QueryBudget, QueryBudgetExceeded, QueryBudgetTestMixin,
+                          capture_queries, mixin, query_logging, tracebacks)
+from query_logger.aggregator import QueryAggregator
+from query_logger.bulkwrites import bulk_write, inserted_rows
+from query_logger.emitter import QueuedEmitter, defer, get_emitter, queue
+from query_logger.explain import PlanCache, get_plan_cache
+from query_logger.fingerprint import FingerprintCache, normalize
+from query_logger.histogram import LatencyHistogram
+from query_logger.metrics import MetricsFile, collect, get_metrics_file, render
+from query_logger.nplusone import infer_relation
+from query_logger.profile import ProfileWriter, iter_profiles, process_path
+from query_logger.local import ContextStack, ContextVar
+from query_logger.memo import memo_key
+from query_logger.middleware import QueryLoggingMiddleware
+from query_logger.sampling import RateLimiter
+from query_logger.stats import RollingStatsStore, get_store
+from query_logger.views import query_metrics
 
 # project
+from .memorylog import MemoryHandler
 from .models import Author, Book, Publisher
 
 
+def make_aggregator(*timings):
+    aggregator = QueryAggregator()
+    for sql, duration in timings:
+        aggregator.add(sql, duration)
+    return aggregator
+
+
+class TempDirTestCase(TestCase, DatabaseQueryLoggerMixin):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        MemoryHandler.get_log()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+
 class DatabaseQueryDebugMixinTest(TestCase, DatabaseQueryLoggerMixin):
     def setUp(self):
         self.author = Author.objects.create(name="John Doe")
@@ -25,23 +71,79 @@ class DatabaseQueryDebugMixinTest(TestCase, DatabaseQueryLoggerMixin):
         self.book1 = Book.objects.create(author=self.author, publisher=self.publisher, title="Book1")
         self.book2 = Book.objects.create(author=self.author, publisher=self.publisher, title="Book1")
 
-    def test_monkey_patched_debug_wrapper(self):
+    def test_tracebacks_captured(self):
         debug_config = {
             'log_tracebacks': True,
             'connection_name': 'default'
         }
         self.start_query_logging(debug_config)
-        source = inspect.getsource(util.CursorDebugWrapper.execute)
-        self.assertTrue("traceback.extract_stack()" in str(source))
-        source = inspect.getsource(util.CursorDebugWrapper.executemany)
-        self.assertTrue("traceback.extract_stack()" in str(source))
+        a = list(Author.objects.all())
+        info_tuple = self.stop_query_logging()
 
+        self.assertEqual(len(info_tuple[0]), 1)
+        tb_files = [f[0] for f in tracebacks.extract(info_tuple[0][0].tb)]
+        self.assertTrue(any(f.rstrip('c') == __file__.rstrip('c') for f in tb_files))
+        self.assertFalse(any(f.rstrip('c') == mixin.__file__.rstrip('c') for f in tb_files))
+
+    def test_capture_uninstalled(self):
+        self.start_query_logging()
+        self.assertTrue('cursor' in connections['default'].__dict__)
         self.stop_query_logging()
+        self.assertFalse('cursor' in connections['default'].__dict__)
+
+        self.assertFalse(hasattr(self, 'query_debug_cfg'))
+
+    def test_nested_sessions(self):
+        self.start_query_logging()
+        a = list(Author.objects.all())
+        self.start_query_logging({'log_duplicate_queries': False})
+        b = list(Book.objects.all())
+        c = list(Book.objects.all())
+        self.assertFalse(self.query_debug_cfg.log_duplicate_queries)
+        inner = self.stop_query_logging()
+        self.assertTrue(self.query_debug_cfg.log_duplicate_queries)
+        d = list(Publisher.objects.all())
+        outer = self.stop_query_logging()
+
+        self.assertEqual((len(inner[0]), inner[1]), (2, 1))
+        self.assertEqual((len(outer[0]), outer[1]), (4, 1))
+        self.assertFalse('cursor' in connections['default'].__dict__)
+        self.assertEqual(self.stop_query_logging(), None)
+
+    def test_sessions_isolated_between_threads(self):
+        other_thread_results = []
+
+        def run_other_session():
+            self.start_query_logging()
+            started.set()
+            finished.wait(5)
+            other_thread_results.append(self.stop_query_logging())
+
+        started, finished = threading.Event(), threading.Event()
+        thread = threading.Thread(target=run_other_session)
+        thread.start()
+        started.wait(5)
+
+        # Both sessions are on the same object too, that still should not matter
+        self.start_query_logging()
+        a = list(Author.objects.all())
+        b = list(Author.objects.all())
+        info_tuple = self.stop_query_logging()
+        finished.set()
+        thread.join()
 
-        source = inspect.getsource(util.CursorDebugWrapper.execute)
-        self.assertFalse("traceback.extract_stack()" in str(source))
-        source = inspect.getsource(util.CursorDebugWrapper.executemany)
-        self.assertFalse("traceback.extract_stack()" in str(source))
+        self.assertEqual(len(info_tuple[0]), 2)
+        self.assertEqual(len(other_thread_results[0][0]), 0)
+
+    @override_settings(DEBUG=False)
+    def test_connection_query_log_untouched(self):
+        queries_before = len(connections['default'].queries)
+        self.start_query_logging()
+        a = list(Author.objects.all())
+        b = list(Book.objects.all())
+        info_tuple = self.stop_query_logging()
+        self.assertEqual(len(info_tuple[0]), 2)
+        self.assertEqual(len(connections['default'].queries), queries_before)
 
     @override_settings(DEBUG=True)
     def test_duplicate_queries_detected(self):
@@ -82,3 +184,1195 @@ class DatabaseQueryDebugMixinTest(TestCase, DatabaseQueryLoggerMixin):
         self.assertEqual(len(info_tuple[0]), 2)  # The first position of the tuple is a list of queries that were run
         self.assertEqual(info_tuple[1], 0)  # the second position of the tuple is how many duplicate queries were run
         self.assertTrue(info_tuple[2] > 0.00001)  # The third position of the tuple is the total run time
+
+    def test_duplicates_detected_across_list_lengths(self):
+        self.start_query_logging()
+        a = list(Book.objects.filter(id__in=[self.book1.id]))
+        b = list(Book.objects.filter(id__in=[self.book1.id, self.book2.id]))
+        c = list(Book.objects.filter(title='Book1'))
+        d = list(Book.objects.filter(title='Book2'))
+        info_tuple = self.stop_query_logging()
+        self.assertEqual(len(info_tuple[0]), 4)
+        self.assertEqual(info_tuple[1], 2)
+
+    def test_iterator_captured_once(self):
+        self.start_query_logging()
+        a = list(Book.objects.all().iterator())
+        info_tuple = self.stop_query_logging()
+        self.assertEqual(len(a), 2)
+        self.assertEqual(len(info_tuple[0]), 1)
+        self.assertEqual(info_tuple[1], 0)
+
+
+class FingerprintTest(SimpleTestCase):
+    def test_literals_collapsed(self):
+        self.assertEqual(
+            normalize('SELECT "t2"."id" FROM "t2" WHERE "t2"."id" = 5 AND "t2"."name" = \'it\'\'s 3\' '
+                      'AND "t2"."ratio" > -1.5e3 LIMIT 21 OFFSET 40'),
+            'SELECT "t2"."id" FROM "t2" WHERE "t2"."id" = ? AND "t2"."name" = ? AND "t2"."ratio" > ? LIMIT ? OFFSET ?')
+        self.assertEqual(normalize("SELECT * FROM t WHERE u = 'a0eebc99-9c0b-4ef8-bb6d-6bb9bd380a11' "
+                                   "AND d BETWEEN %s AND %s"),
+                         'SELECT * FROM t WHERE u = ? AND d BETWEEN ? AND ?')
+
+    def test_variable_length_lists_collapsed(self):
+        self.assertEqual(normalize('SELECT * FROM t WHERE id IN (%s, %s, %s)'),
+                         normalize('SELECT * FROM t WHERE id IN (1,2)'))
+        self.assertEqual(normalize('INSERT INTO t (a, b) VALUES (%s, %s), (%s, %s)'),
+                         'INSERT INTO t (a, b) VALUES (...)')
+
+    def test_savepoint_names_collapsed(self):
+        self.assertEqual(normalize('SAVEPOINT "s139712_x8"'), 'SAVEPOINT ?')
+        self.assertEqual(normalize('RELEASE SAVEPOINT "s139712_x8"'), 'RELEASE SAVEPOINT ?')
+        self.assertEqual(normalize('ROLLBACK TO SAVEPOINT `s139712_x9`'), 'ROLLBACK TO SAVEPOINT ?')
+        self.assertEqual(normalize('release sp_1'), 'release ?')
+        self.assertEqual(normalize('SELECT "s1_x2" FROM t'), 'SELECT "s1_x2" FROM t')
+
+    def test_comments_and_whitespace_ignored(self):
+        self.assertEqual(normalize('SELECT  a\n FROM t /* id=7 */ WHERE b = 1 -- trailing'),
+                         'SELECT a FROM t WHERE b = ?')
+
+    def test_cache_bounded_lru(self):
+        cache = FingerprintCache(maxsize=2)
+        cache('SELECT 1')
+        cache('SELECT 2')
+        cache('SELECT 1')
+        cache('SELECT 3')  # evicts SELECT 2, the least recently used
+        self.assertEqual(len(cache), 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+        cache('SELECT 1')
+        self.assertEqual(cache.hits, 2)
+        cache('SELECT 2')
+        self.assertEqual(cache.misses, 4)
+
+
+class QueryAggregatorTest(SimpleTestCase):
+    def test_single_pass_totals(self):
+        aggregator = QueryAggregator(long_running_time=100)
+        aggregator.add('SELECT a', 0.01, tb=['first'])
+        aggregator.add('SELECT b', 0.2)
+        aggregator.add('SELECT a', 0.03, tb=['second'])
+        aggregator.add('SELECT a', 0.15)
+
+        self.assertEqual(aggregator.num_queries, 4)
+        self.assertEqual(aggregator.num_duplicates, 2)
+        self.assertAlmostEqual(aggregator.sql_time, 0.39)
+
+        entry = aggregator.stats['SELECT a']
+        self.assertEqual(entry.count, 3)
+        self.assertAlmostEqual(entry.total_time, 0.19)
+        self.assertEqual(entry.max_time, 0.15)
+        self.assertEqual(entry.tb, ['first'])
+        self.assertEqual(entry.slow_times, [0.15])
+
+        self.assertEqual([e.sql for e in aggregator.duplicates()], ['SELECT a'])
+        self.assertEqual(sorted(e.sql for e in aggregator.slow_queries()), ['SELECT a', 'SELECT b'])
+
+    def test_slow_tracking_disabled(self):
+        aggregator = QueryAggregator(long_running_time=0)
+        aggregator.add('SELECT a', 5)
+        self.assertEqual(aggregator.slow_queries(), [])
+
+
+class QueryLogOutputTest(TestCase, DatabaseQueryLoggerMixin):
+    def test_duplicate_and_summary_logged(self):
+        MemoryHandler.get_log()
+        Author.objects.create(name="Jane Doe")
+        self.start_query_logging({'log_long_running_time': 0})
+        a = list(Author.objects.filter(name='a'))
+        b = list(Author.objects.filter(name='b'))
+        self.stop_query_logging()
+        log = MemoryHandler.get_log()
+        self.assertTrue('[SQL] repeated query (2x): SELECT' in log)
+        self.assertTrue('[SQL] 2 queries (1 duplicates)' in log)
+
+    def test_async_logging(self):
+        MemoryHandler.get_log()
+        self.start_query_logging({'async_logging': True})
+        a = list(Author.objects.filter(name='a'))
+        b = list(Author.objects.filter(name='b'))
+        self.stop_query_logging()
+        get_emitter().flush()
+        log = MemoryHandler.get_log()
+        self.assertTrue('[SQL] repeated query (2x): SELECT' in log)
+        self.assertTrue('[SQL] 2 queries (1 duplicates)' in log)
+
+    def test_async_records_describe_the_request(self):
+        records = []
+        handler = Handler()
+        handler.emit = records.append
+        getLogger('query_logger').addHandler(handler)
+        get_store().clear()
+        get_store()._last_emit = 0  # Due for a periodic emission
+        try:
+            self.start_query_logging({'async_logging': True, 'rolling_stats': True})
+            started = time.time()
+            a = list(Author.objects.filter(name='a'))
+            b = list(Author.objects.filter(name='b'))
+            self.stop_query_logging()
+            get_emitter().flush()
+        finally:
+            getLogger('query_logger').removeHandler(handler)
+        logtypes = set(record.logtype for record in records)
+        self.assertTrue('querylog__duplicate' in logtypes and 'querylog__rolling' in logtypes)
+        for record in records:
+            self.assertEqual(record.thread, threading.current_thread().ident)
+            self.assertTrue(started <= record.created <= time.time())
+
+    def test_rolling_stats_merged(self):
+        get_store().clear()
+        self.start_query_logging({'rolling_stats': True})
+        a = list(Author.objects.all())
+        self.stop_query_logging()
+        top = get_store().top()
+        self.assertEqual(len(top), 1)
+        self.assertEqual(top[0].classes, {'QueryLogOutputTest': 1})
+        get_store().clear()
+
+
+    def test_checkpoints(self):
+        MemoryHandler.get_log()
+        self.start_query_logging({'checkpoint_queries': 2})
+        for name in 'abcde':
+            a = list(Author.objects.filter(name=name))
+        self.assertEqual(self.query_debug_session.aggregator.num_queries, 1)
+        infos, num_duplicates, total_time = self.stop_query_logging()
+        log = MemoryHandler.get_log()
+        self.assertEqual(log.count('[SQL] repeated query (2x): SELECT'), 2)
+        self.assertTrue('[SQL] checkpoint #1: 2 queries (1 duplicates)' in log)
+        self.assertTrue('[SQL] checkpoint #2: 2 queries (1 duplicates)' in log)
+        self.assertTrue('[SQL] 5 queries (2 duplicates)' in log)
+        self.assertEqual(num_duplicates, 2)
+
+    def test_failed_checkpoint_kept_out_of_the_query(self):
+        MemoryHandler.get_log()
+
+        def fail(session):
+            raise IOError('disk full')
+
+        self.flush_query_window = fail
+        self.start_query_logging({'checkpoint_queries': 1})
+        try:
+            cursor = connections['default'].cursor()
+            cursor.execute('SELECT 1')
+            self.assertEqual(cursor.fetchone(), (1,))
+        finally:
+            del self.flush_query_window
+            self.stop_query_logging()
+        log = MemoryHandler.get_log()
+        self.assertTrue('[SQL] query listener failed' in log)
+        self.assertTrue('disk full' in log)
+
+    def test_nested_checkpoints_logged_for_their_own_session(self):
+        records = []
+        handler = Handler()
+        handler.emit = records.append
+        getLogger('query_logger.mixin').addHandler(handler)
+        try:
+            self.start_query_logging({'checkpoint_queries': 2, 'logging_extra_dict': {'scope': 'outer'}})
+            self.start_query_logging({'logging_extra_dict': {'scope': 'inner'}})
+            for name in 'ab':
+                a = list(Author.objects.filter(name=name))
+            self.stop_query_logging()
+            self.stop_query_logging()
+        finally:
+            getLogger('query_logger.mixin').removeHandler(handler)
+        # The outer session's checkpoint goes off while the inner one is running
+        scopes = sorted((record.logtype, record.scope) for record in records
+                        if record.logtype in ('querylog__checkpoint', 'querylog__duplicate'))
+        self.assertEqual(scopes, [('querylog__checkpoint', 'outer'), ('querylog__duplicate', 'inner'),
+                                  ('querylog__duplicate', 'outer')])
+
+    def test_manual_checkpoint(self):
+        MemoryHandler.get_log()
+        self.start_query_logging()
+        a = list(Author.objects.all())
+        self.checkpoint_query_logging()
+        b = list(Author.objects.all())
+        self.stop_query_logging()
+        log = MemoryHandler.get_log()
+        self.assertTrue('[SQL] checkpoint #1: 1 queries (0 duplicates)' in log)
+        self.assertTrue('[SQL] 2 queries (0 duplicates)' in log)
+
+
+class TracebackCaptureTest(SimpleTestCase):
+    def capture(self, limit=None):
+        return tracebacks.capture_stack(limit)
+
+    def test_identical_call_sites_interned(self):
+        stacks = [self.capture() for _ in range(2)]
+        self.assertTrue(stacks[0] is stacks[1])
+        self.assertFalse(self.capture() is stacks[0])  # Different line, different call site
+
+    def test_depth_limit_keeps_innermost_frames(self):
+        stack = self.capture(limit=1)
+        self.assertEqual(len(stack), 1)
+        self.assertEqual(stack[0][0].co_name, 'capture')
+
+    def test_library_frames_skipped_and_resolved_lazily(self):
+        frames = tracebacks.extract(self.capture())
+        # Only our own code is left between manage.py and here, the test runner and Django are all skipped
+        self.assertEqual(set(os.path.basename(f[0]).rstrip('c') for f in frames), set(['manage.py', 'tests.py']))
+        self.assertEqual(frames[-1][2:], ('capture', 'return tracebacks.capture_stack(limit)'))
+
+
+class ContextStackTest(SimpleTestCase):
+    def test_thread_local(self):
+        stack = ContextStack('test_thread_local')
+        stack.push('outer')
+        seen = []
+        thread = threading.Thread(target=lambda: seen.append(stack.get()))
+        thread.start()
+        thread.join()
+        self.assertEqual(seen, [()])
+        stack.remove('outer')
+        self.assertEqual(stack.get(), ())
+
+    def test_context_local(self):
+        if ContextVar is None:
+            return
+        # asyncio runs every task in a copy of the context it was created in
+        from contextvars import copy_context
+        stack = ContextStack('test_context_local')
+        stack.push('parent')
+        task_a, task_b = copy_context(), copy_context()
+        task_a.run(stack.push, 'a')
+        task_b.run(stack.push, 'b')
+        self.assertEqual(task_a.run(stack.get), ('parent', 'a'))
+        self.assertEqual(task_b.run(stack.get), ('parent', 'b'))
+        self.assertEqual(stack.get(), ('parent',))
+
+
+class MultipleConnectionTest(TestCase, DatabaseQueryLoggerMixin):
+    multi_db = True
+    databases = {'default', 'other'}
+
+    def test_all_connections_logged_together(self):
+        MemoryHandler.get_log()
+        self.start_query_logging({'connection_name': '__all__'})
+        a = list(Author.objects.filter(name='a'))
+        b = list(Author.objects.using('other').filter(name='b'))
+        c = list(Book.objects.using('other').all())
+        info_tuple = self.stop_query_logging()
+        log = MemoryHandler.get_log()
+
+        self.assertEqual(len(info_tuple[0]), 3)
+        self.assertEqual(info_tuple[1], 1)
+        self.assertTrue('repeated query (2x) across databases default, other' in log)
+        self.assertTrue('(default: 1 queries' in log)
+        self.assertTrue('other: 2 queries' in log)
+
+    def test_connection_list(self):
+        self.start_query_logging({'connection_name': ['other', 'missing']})
+        a = list(Author.objects.all())
+        b = list(Author.objects.using('other').all())
+        info_tuple = self.stop_query_logging()
+        self.assertEqual(len(info_tuple[0]), 1)
+        self.assertFalse('cursor' in connections['other'].__dict__)
+
+
+class SamplingTest(TestCase, DatabaseQueryLoggerMixin):
+    def test_unsampled_session_reports_slow_queries_only(self):
+        MemoryHandler.get_log()
+        self.start_query_logging({'sample_rate': 0, 'log_long_running_time': 0.000001})
+        a = list(Author.objects.all())
+        b = list(Author.objects.all())
+        self.assertEqual(self.stop_query_logging(), None)
+        log = MemoryHandler.get_log()
+        self.assertEqual(log.count('over absolute limit'), 2)
+        self.assertFalse('repeated query' in log)
+        self.assertFalse('total processing time' in log)
+
+    def test_unsampled_session_without_tail_rule_not_hooked(self):
+        self.start_query_logging({'sample_rate': 0, 'log_unsampled_long_running': False})
+        self.assertFalse('cursor' in connections['default'].__dict__)
+        self.assertEqual(self.stop_query_logging(), None)
+
+    def test_class_sample_rates(self):
+        self.start_query_logging({'sample_rate': 1, 'class_sample_rates': {'SamplingTest': 0}})
+        self.assertFalse(self.query_debug_session.sampled)
+        self.stop_query_logging()
+
+        self.start_query_logging({'sample_rate': 0, 'class_sample_rates': {'SamplingTest': 1}})
+        a = list(Author.objects.all())
+        info_tuple = self.stop_query_logging()
+        self.assertEqual(len(info_tuple[0]), 1)
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(2)
+        self.assertEqual([limiter.acquire() for _ in range(3)], [True, True, False])
+        limiter.last -= 1  # A second later the bucket is full again
+        self.assertEqual([limiter.acquire() for _ in range(3)], [True, True, False])
+
+    def test_fractional_rate_limiter(self):
+        limiter = RateLimiter(0.5)
+        self.assertEqual([limiter.acquire() for _ in range(2)], [True, False])
+        limiter.last -= 1  # Half a token a second later
+        self.assertFalse(limiter.acquire())
+        limiter.last -= 1
+        self.assertEqual([limiter.acquire() for _ in range(2)], [True, False])
+
+
+class RollingStatsStoreTest(SimpleTestCase):
+    def test_sessions_merged_and_ranked(self):
+        store = RollingStatsStore(capacity=10, window_seconds=60, num_windows=5, emit_interval=0)
+        store.merge(make_aggregator(('SELECT a', 0.1), ('SELECT a', 0.1), ('SELECT b', 0.05)), 'ViewA', now=1000)
+        store.merge(make_aggregator(('SELECT b', 0.3)), 'ViewB', now=1010)
+
+        top = store.top(now=1020)
+        self.assertEqual([e.sql for e in top], ['SELECT b', 'SELECT a'])
+        self.assertEqual(top[0].count, 2)
+        self.assertAlmostEqual(top[0].total_time, 0.35)
+        self.assertEqual(top[0].max_time, 0.3)
+        self.assertEqual(top[0].classes, {'ViewA': 1, 'ViewB': 1})
+        self.assertEqual([e.sql for e in store.top(1, now=1020)], ['SELECT b'])
+
+    def test_memory_bounded_by_capacity(self):
+        store = RollingStatsStore(capacity=2, emit_interval=0)
+        store.merge(make_aggregator(('SELECT a', 1.0), ('SELECT b', 0.1)), 'View', now=0)
+        store.merge(make_aggregator(('SELECT c', 0.5)), 'View', now=0)
+        top = store.top(now=0)
+        self.assertEqual([e.sql for e in top], ['SELECT a', 'SELECT c'])
+        self.assertAlmostEqual(top[1].error, 0.1)
+
+    def test_old_windows_decay(self):
+        store = RollingStatsStore(window_seconds=60, num_windows=5, emit_interval=0)
+        store.merge(make_aggregator(('SELECT old', 1.0)), 'View', now=0)
+        store.merge(make_aggregator(('SELECT new', 0.1)), 'View', now=240)
+        self.assertEqual([e.sql for e in store.top(now=240)], ['SELECT old', 'SELECT new'])
+        self.assertEqual([e.sql for e in store.top(seconds=60, now=240)], ['SELECT new'])
+        store.merge(make_aggregator(('SELECT new', 0.1)), 'View', now=300)
+        self.assertEqual([e.sql for e in store.top(now=300)], ['SELECT new'])
+
+    def test_periodic_emission(self):
+        MemoryHandler.get_log()
+        store = RollingStatsStore(emit_interval=60, emit_top=1)
+        store.merge(make_aggregator(('SELECT a', 0.1), ('SELECT b', 0.3)), 'View', now=store._last_emit + 1)
+        self.assertEqual(MemoryHandler.get_log(), '')
+        store.merge(make_aggregator(('SELECT a', 0.1)), 'View', now=store._last_emit + 61)
+        log = MemoryHandler.get_log()
+        self.assertTrue('top query #1' in log and 'SELECT b' in log)
+        self.assertFalse('#2' in log)
+
+
+class QueuedEmitterTest(SimpleTestCase):
+    def test_overflow_dropped_and_reported(self):
+        emitter = QueuedEmitter(maxsize=1)
+        # Pretend the worker is already running so nothing drains the queue
+        emitter._pid, emitter._queue = os.getpid(), queue.Queue(1)
+        records = []
+        defer(records, getLogger('query_logger.mixin'), WARNING, 'first batch', {})
+        self.assertTrue(emitter.submit(records))
+        self.assertFalse(emitter.submit(records))
+        self.assertEqual(emitter.dropped, 1)
+
+        MemoryHandler.get_log()
+        emitter._emit(emitter._queue.get_nowait())
+        log = MemoryHandler.get_log()
+        self.assertTrue('dropped 1 query log batches' in log)
+        self.assertTrue('first batch' in log)
+
+
+class LatencyHistogramTest(SimpleTestCase):
+    def assertWithinBucket(self, value, expected):
+        self.assertTrue(expected <= value <= expected * 1.07, '%r not within a bucket of %r' % (value, expected))
+
+    def test_percentiles(self):
+        histogram = LatencyHistogram()
+        for ms in range(1, 101):
+            histogram.record(ms / 1000.0)
+        self.assertEqual(histogram.count, 100)
+        self.assertWithinBucket(histogram.percentile(50), 0.050)
+        self.assertWithinBucket(histogram.percentile(95), 0.095)
+        self.assertWithinBucket(histogram.percentile(99), 0.099)
+        self.assertEqual(histogram.percentile(100), 0.1)
+        self.assertEqual(histogram.percentiles()['max_ms'], 100)
+
+    def test_merge(self):
+        fast, slow = LatencyHistogram(), LatencyHistogram()
+        for _ in range(98):
+            fast.record(0.001)
+        slow.record(2.0)
+        slow.record(3.0)
+        fast.merge(slow)
+        self.assertEqual(fast.count, 100)
+        self.assertWithinBucket(fast.percentile(50), 0.001)
+        self.assertWithinBucket(fast.percentile(99), 2.0)
+        self.assertEqual(fast.max, 3.0)
+
+    def test_empty_and_tiny(self):
+        histogram = LatencyHistogram()
+        self.assertEqual(histogram.percentile(99), 0.0)
+        histogram.record(0.0)
+        self.assertEqual(histogram.percentile(50), 0.0)
+
+
+class NPlusOneTest(TestCase, DatabaseQueryLoggerMixin):
+    def setUp(self):
+        publisher = Publisher.objects.create(name="Book Club")
+        for i in range(3):
+            author = Author.objects.create(name="Author %d" % i)
+            Book.objects.create(author=author, publisher=publisher, title="Book %d" % i)
+        MemoryHandler.get_log()
+
+    def test_forward_relation(self):
+        self.start_query_logging({'detect_nplusone': True})
+        names = [book.author.name for book in Book.objects.all()]
+        self.stop_query_logging()
+        log = MemoryHandler.get_log()
+        self.assertTrue('[SQL] N+1 query (3x) at tests.py:' in log)
+        self.assertTrue("Book.author: use select_related('author')" in log)
+
+    def test_reverse_relation(self):
+        self.start_query_logging({'detect_nplusone': True})
+        titles = [[b.title for b in author.books.all()] for author in Author.objects.all()]
+        self.stop_query_logging()
+        self.assertTrue("Author.books: use prefetch_related('books')" in MemoryHandler.get_log())
+
+    def test_repeats_from_different_call_sites_ignored(self):
+        self.start_query_logging({'detect_nplusone': True})
+        a = list(Author.objects.filter(name='a'))
+        b = list(Author.objects.filter(name='b'))
+        c = list(Author.objects.filter(name='c'))
+        self.stop_query_logging()
+        log = MemoryHandler.get_log()
+        self.assertTrue('repeated query (3x)' in log)
+        self.assertFalse('N+1' in log)
+
+    def test_infer_relation_unknown_table(self):
+        self.assertEqual(infer_relation('SELECT a FROM "missing" WHERE "missing"."id" = ?'), (None, None, None))
+
+
+class QueryLoggingEntryPointTest(TestCase):
+    def setUp(self):
+        MemoryHandler.get_log()
+
+    def test_context_manager_torn_down_on_error(self):
+        try:
+            with query_logging():
+                a = list(Author.objects.filter(name='a'))
+                b = list(Author.objects.filter(name='b'))
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertFalse('cursor' in connections['default'].__dict__)
+        self.assertTrue('[SQL] 2 queries (1 duplicates)' in MemoryHandler.get_log())
+
+    def test_decorator_named_after_function(self):
+        @query_logging(rolling_stats=True)
+        def lookup():
+            return list(Author.objects.all())
+
+        get_store().clear()
+        lookup()
+        self.assertEqual(get_store().top()[0].classes, {'testapp.tests.lookup': 1})
+        get_store().clear()
+
+    def test_disabled_short_circuits(self):
+        with query_logging(enabled=lambda: False):
+            self.assertFalse('cursor' in connections['default'].__dict__)
+            a = list(Author.objects.all())
+        with override_settings(LOG_QUERY_ENABLED=False):
+            with query_logging():
+                self.assertFalse('cursor' in connections['default'].__dict__)
+        self.assertEqual(MemoryHandler.get_log(), '')
+
+
+class FakeUser(object):
+    is_authenticated = True
+    is_staff = False
+
+
+class QueryLoggingMiddlewareTest(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        MemoryHandler.get_log()
+
+    def view(self, request):
+        return list(Author.objects.all())
+
+    def logged(self, path, user=None):
+        request = self.factory.get(path)
+        request.user = user
+        QueryLoggingMiddleware(self.view)(request)
+        return '[SQL] 1 queries' in MemoryHandler.get_log()
+
+    def test_url_rules(self):
+        with override_settings(LOG_QUERY_MIDDLEWARE_URLS=[r'^/api/'], LOG_QUERY_MIDDLEWARE_EXCLUDE_URLS=[r'/health']):
+            self.assertTrue(self.logged('/api/orders/'))
+            self.assertFalse(self.logged('/admin/'))
+            self.assertFalse(self.logged('/api/health'))
+
+    def test_user_rules(self):
+        with override_settings(LOG_QUERY_MIDDLEWARE_USERS='authenticated'):
+            self.assertTrue(self.logged('/', FakeUser()))
+            self.assertFalse(self.logged('/'))
+        with override_settings(LOG_QUERY_MIDDLEWARE_USERS='staff'):
+            self.assertFalse(self.logged('/', FakeUser()))
+
+    def test_view_sample_rates(self):
+        with override_settings(LOG_QUERY_SAMPLE_RATE=1,
+                               LOG_QUERY_CLASS_SAMPLE_RATES={'testapp.views.author_list': 0}):
+            self.assertFalse(self.logged('/authors/'))
+            self.assertTrue(self.logged('/api/orders/'))
+        with override_settings(LOG_QUERY_SAMPLE_RATE=0,
+                               LOG_QUERY_CLASS_SAMPLE_RATES={'testapp.views.author_list': 1}):
+            self.assertTrue(self.logged('/authors/'))
+
+    def test_old_style_hooks_torn_down_on_exception(self):
+        middleware = QueryLoggingMiddleware()
+        request = self.factory.get('/')
+        middleware.process_request(request)
+        middleware.process_view(request, self.view, (), {})
+        self.assertTrue('cursor' in connections['default'].__dict__)
+        middleware.process_exception(request, ValueError())
+        self.assertFalse('cursor' in connections['default'].__dict__)
+        middleware.process_response(request, None)
+
+
+class ExplainTest(TestCase, DatabaseQueryLoggerMixin):
+    def setUp(self):
+        get_plan_cache().clear()
+        MemoryHandler.get_log()
+
+    def test_slow_query_explained_once(self):
+        if sys.version_info < (3, 6):
+            return
+        self.start_query_logging({'explain_slow_queries': True, 'log_long_running_time': 0.000001})
+        a = list(Author.objects.filter(name__startswith='a').order_by('name'))
+        b = list(Author.objects.filter(name__startswith='b').order_by('name'))
+        self.stop_query_logging()
+        log = MemoryHandler.get_log()
+        self.assertEqual(log.count('over absolute limit of 0 ms (full scan, temp sort): SELECT'), 2)
+        self.assertEqual(len(get_plan_cache()), 1)
+        self.assertFalse('cursor' in connections['default'].__dict__)
+
+    def test_writes_not_explained(self):
+        self.start_query_logging({'explain_slow_queries': True, 'log_long_running_time': 0.000001})
+        Author.objects.create(name='a')
+        a = list(Author.objects.filter(pk=1))
+        self.stop_query_logging()
+        log = MemoryHandler.get_log()
+        self.assertTrue('over absolute limit of 0 ms: INSERT' in log)
+        self.assertTrue('over absolute limit of 0 ms: SELECT' in log)
+
+    def test_plan_cache_lru_and_ttl(self):
+        cache = PlanCache(maxsize=2, ttl=10)
+        cache.set('a', 1, now=0)
+        cache.set('b', 2, now=0)
+        self.assertEqual(cache.get('a', now=5), 1)
+        cache.set('c', 3, now=5)
+        self.assertEqual(cache.get('b', now=5), None)
+        self.assertEqual(cache.get('c', now=20), None)
+        self.assertEqual(cache.get('a', now=20), None)
+
+
+class ProfileExportTest(TempDirTestCase):
+    def log_session(self, path, fmt, names):
+        self.start_query_logging({'profile_path': path, 'profile_format': fmt, 'detect_nplusone': True})
+        for name in names:
+            a = list(Author.objects.filter(name=name))
+        self.stop_query_logging()
+
+    def test_profiles_round_trip(self):
+        for fmt in ('jsonl', 'binary'):
+            path = os.path.join(self.dir, 'profile.' + fmt)
+            self.log_session(path, fmt, 'ab')
+            self.log_session(path, fmt, 'c')
+            self.assertEqual(os.listdir(self.dir), ['profile.%s.%d' % (fmt, os.getpid())])
+            profiles = list(iter_profiles(process_path(path)))
+            os.remove(process_path(path))
+            self.assertEqual([p['num'] for p in profiles], [2, 1])
+            self.assertEqual(profiles[0]['class_name'], 'ProfileExportTest')
+            query = profiles[0]['queries'][0]
+            self.assertEqual(query['count'], 2)
+            self.assertTrue(any('tests.py:' in site for site in query['sites']))
+
+    def test_rotation(self):
+        path = os.path.join(self.dir, 'profile.jsonl')
+        writer = ProfileWriter(path, max_bytes=100, backups=2)
+        for i in range(4):
+            writer.write({'i': i, 'padding': 'x' * 60})
+        self.assertEqual([p['i'] for p in iter_profiles(path)], [3])
+        self.assertEqual([p['i'] for p in iter_profiles(path + '.1')], [2])
+        self.assertEqual([p['i'] for p in iter_profiles(path + '.2')], [1])
+        self.assertFalse(os.path.exists(path + '.3'))
+
+    def test_rotation_tolerates_missing_files(self):
+        path = os.path.join(self.dir, 'profile.jsonl')
+        writer = ProfileWriter(path, max_bytes=100, backups=2)
+        writer.write({'padding': 'x' * 60})
+        os.rename(path, path + '.1')  # Rotated away under the writer's feet
+        writer.rotate()
+        writer.write({'padding': 'x' * 60})
+        self.assertEqual(len(list(iter_profiles(path))), 1)
+
+    def test_corrupt_binary_records_skipped(self):
+        path = os.path.join(self.dir, 'profile.binary')
+        writer = ProfileWriter(path, fmt='binary')
+        writer.write({'i': 0})
+        with open(path, 'ab') as f:
+            f.write(struct.pack('>I', 4) + b'junk')
+        writer.write({'i': 1})
+        self.assertEqual([p['i'] for p in iter_profiles(path)], [0, 1])
+
+    def test_report_command(self):
+        before = os.path.join(self.dir, 'before.bin')
+        after = os.path.join(self.dir, 'after.bin')
+        self.log_session(before, 'binary', 'a')
+        self.log_session(after, 'binary', 'abcd')
+        out = StringIO()
+        call_command('query_profile_report', process_path(after), baseline=[process_path(before)], stdout=out)
+        out = out.getvalue()
+        self.assertTrue('1 profiles' in out)
+        self.assertTrue('4x' in out)
+        self.assertTrue('ProfileExportTest' in out)
+        self.assertTrue('1.0x -> 4.0x' in out)
+
+
+class BulkWriteTest(TestCase, DatabaseQueryLoggerMixin):
+    def setUp(self):
+        MemoryHandler.get_log()
+
+    def test_insert_loop(self):
+        self.start_query_logging({'detect_bulk_writes': True})
+        for i in range(12):
+            Author.objects.create(name='Author %d' % i)
+        publisher = Publisher.objects.create(name='Publisher')
+        Author.objects.create(name='Author 12')
+        self.stop_query_logging()
+        log = MemoryHandler.get_log()
+        self.assertEqual(log.count('[SQL] single row'), 1)
+        self.assertTrue('[SQL] single row INSERT (13x, 13 rows, ' in log)
+        self.assertTrue('up to 12 in a row), use Author.objects.bulk_create(objs): INSERT INTO' in log)
+
+    def test_update_loop(self):
+        authors = [Author.objects.create(name='Author %d' % i) for i in range(3)]
+        self.start_query_logging({'detect_bulk_writes': True, 'bulk_write_threshold': 3})
+        for author in authors:
+            author.name = author.name.upper()
+            author.save()
+        Author.objects.filter(name__startswith='A').update(name='x')
+        self.stop_query_logging()
+        log = MemoryHandler.get_log()
+        self.assertEqual(log.count('[SQL] single row'), 1)
+        self.assertTrue("[SQL] single row UPDATE (3x, 3 rows, " in log)
+        self.assertTrue("up to 3 in a row), use Author.objects.bulk_update(objs, ['name']): UPDATE" in log)
+
+    def test_executemany_batches(self):
+        self.start_query_logging({'detect_bulk_writes': True, 'bulk_write_threshold': 1})
+        cursor = connections['default'].cursor()
+        cursor.executemany('INSERT INTO testapp_author (name) VALUES (%s)', [('a',), ('b',)])
+        cursor.executemany('INSERT INTO testapp_author (name) VALUES (%s)', (('c%d' % i,) for i in range(3)))
+        self.stop_query_logging()
+        self.assertEqual(Author.objects.count(), 5)
+        log = MemoryHandler.get_log()
+        self.assertFalse('[SQL] single row' in log)
+        self.assertTrue('[SQL] executemany (2x, 5 rows, 2 per batch on average, up to 3, ' in log)
+
+    def test_bulk_create_batches_ignored(self):
+        self.start_query_logging({'detect_bulk_writes': True, 'bulk_write_threshold': 3})
+        for i in range(4):
+            Author.objects.bulk_create([Author(name='Author %d' % i), Author(name='Author %d' % (i + 10))])
+        self.stop_query_logging()
+        self.assertEqual(Author.objects.count(), 8)
+        self.assertFalse('[SQL] single row' in MemoryHandler.get_log())
+
+    def test_threshold_applies_to_runs(self):
+        self.start_query_logging({'detect_bulk_writes': True, 'bulk_write_threshold': 4})
+        for i in range(3):
+            Author.objects.create(name='Author %d' % i)
+            Publisher.objects.create(name='Publisher %d' % i)
+        self.stop_query_logging()
+        self.assertFalse('[SQL] single row' in MemoryHandler.get_log())
+
+    def test_inserted_rows(self):
+        self.assertEqual(inserted_rows('INSERT INTO "t" ("a", "b") VALUES (%s, %s)'), 1)
+        self.assertEqual(inserted_rows('INSERT INTO "t" ("a", "b") VALUES (%s, lower(%s)), (%s, %s) RETURNING "id"'), 2)
+        self.assertEqual(inserted_rows("insert into t (a) values ('(x'), ('y)')"), 2)
+        self.assertEqual(inserted_rows('INSERT INTO t (a) SELECT %s UNION ALL SELECT %s'), None)
+        self.assertEqual(inserted_rows('UPDATE t SET a = %s WHERE id = %s'), None)
+
+    def test_not_detected_by_default(self):
+        self.start_query_logging()
+        for i in range(12):
+            Author.objects.create(name='Author %d' % i)
+        self.stop_query_logging()
+        self.assertFalse('[SQL] single row' in MemoryHandler.get_log())
+
+    def test_single_row_writes(self):
+        aggregator = QueryAggregator()
+        for sql in ('UPDATE t SET a = ? WHERE t.id = ?', 'UPDATE t SET a = ? WHERE id IN (...)',
+                    'UPDATE t SET a = ?', 'INSERT INTO t (a) SELECT a FROM u', 'INSERT INTO "t" ("a") VALUES (...)'):
+            aggregator.add(sql, 0.001)
+        found = dict((sql, bulk_write(entry)) for sql, entry in aggregator.stats.items())
+        self.assertEqual(found['UPDATE t SET a = ? WHERE t.id = ?'].suggestion, 'one UPDATE ... CASE')
+        self.assertEqual(found['INSERT INTO "t" ("a") VALUES (...)'].suggestion, 'one multi row INSERT')
+        self.assertEqual(sorted(sql for sql, candidate in found.items() if candidate is None),
+                         ['INSERT INTO t (a) SELECT a FROM u', 'UPDATE t SET a = ?',
+                          'UPDATE t SET a = ? WHERE id IN (...)'])
+
+
+class MemoTest(TestCase, DatabaseQueryLoggerMixin):
+    def setUp(self):
+        for i in range(3):
+            Author.objects.create(name='Author %d' % i)
+        MemoryHandler.get_log()
+
+    def test_repeats_served(self):
+        self.start_query_logging({'memoize_selects': True})
+        results = [list(Author.objects.filter(name='Author 1').values_list('name', flat=True)) for i in range(3)]
+        other = list(Author.objects.filter(name='Author 2').values_list('name', flat=True))
+        infos, num_duplicates, total_time = self.stop_query_logging()
+        self.assertEqual(results, [['Author 1']] * 3)
+        self.assertEqual(other, ['Author 2'])
+        self.assertEqual(len(infos), 2)
+        log = MemoryHandler.get_log()
+        # Same fingerprint, different params: a duplicate, but not one the memo can serve
+        self.assertTrue('[SQL] 2 queries (1 duplicates), ' in log)
+        self.assertTrue(' 2 served from the memo saving ~' in log)
+
+    def test_not_memoized_by_default(self):
+        self.start_query_logging()
+        for i in range(3):
+            a = list(Author.objects.filter(name='Author 1'))
+        infos, num_duplicates, total_time = self.stop_query_logging()
+        self.assertEqual(len(infos), 3)
+        self.assertFalse('memo' in MemoryHandler.get_log())
+
+    def test_invalidated_by_writes(self):
+        self.start_query_logging({'memoize_selects': True})
+        self.assertEqual(Author.objects.filter(name__startswith='Author').count(), 3)
+        Author.objects.create(name='Author 3')
+        self.assertEqual(Author.objects.filter(name__startswith='Author').count(), 4)
+        self.assertEqual(Author.objects.filter(name__startswith='Author').count(), 4)
+        memo = self.query_debug_session.memo
+        self.stop_query_logging()
+        self.assertEqual((memo.hits, memo.invalidations), (1, 1))
+
+    def test_invalidated_by_savepoints(self):
+        if not hasattr(transaction, 'atomic'):  # Django < 1.6
+            return
+        self.start_query_logging({'memoize_selects': True})
+        a = list(Author.objects.all())
+        with transaction.atomic():
+            a = list(Author.objects.all())
+        memo = self.query_debug_session.memo
+        self.stop_query_logging()
+        self.assertEqual(memo.hits, 0)
+
+    def test_bounded(self):
+        self.start_query_logging({'memoize_selects': True, 'memo_max_rows': 2})
+        results = [list(Author.objects.order_by('id').values_list('name', flat=True)) for i in range(2)]
+        a = list(Author.objects.filter(name='Author 1'))
+        a = list(Author.objects.filter(name='Author 2'))
+        a = list(Author.objects.filter(name='Author 0'))
+        a = list(Author.objects.filter(name='Author 1'))
+        memo = self.query_debug_session.memo
+        infos, num_duplicates, total_time = self.stop_query_logging()
+        self.assertEqual(results, [['Author 0', 'Author 1', 'Author 2']] * 2)
+        self.assertEqual(len(infos), 6)
+        self.assertEqual((memo.hits, len(memo), memo.rows), (0, 2, 2))
+
+    def test_raw_cursor_replay(self):
+        self.start_query_logging({'memoize_selects': True})
+        cursor = connections['default'].cursor()
+        cursor.execute('SELECT id, name FROM testapp_author ORDER BY id')
+        rows = cursor.fetchall()
+        description = cursor.description
+        cursor.execute('SELECT id, name FROM testapp_author ORDER BY id')
+        self.assertEqual([col[0] for col in cursor.description], [col[0] for col in description])
+        replayed = [cursor.fetchone()] + list(cursor.fetchmany(1)) + list(cursor)
+        self.assertEqual(cursor.fetchone(), None)
+        memo = self.query_debug_session.memo
+        self.stop_query_logging()
+        self.assertEqual(replayed, list(rows))
+        self.assertEqual(memo.hits, 1)
+
+    def test_memo_keys(self):
+        self.assertEqual(memo_key('SELECT a FROM t WHERE b = %s', [1]), ('SELECT a FROM t WHERE b = %s', ((int, 1),)))
+        self.assertNotEqual(memo_key('SELECT %s', [1]), memo_key('SELECT %s', [True]))
+        self.assertEqual(memo_key('SELECT %s', [[1, 2]]), None)
+        self.assertEqual(memo_key('SELECT a FROM t FOR UPDATE', None), None)
+        self.assertEqual(memo_key("SELECT nextval('s')", None), None)
+        self.assertEqual(memo_key('UPDATE t SET a = 1', None), None)
+
+
+class MemoTransactionTest(TransactionTestCase, DatabaseQueryLoggerMixin):
+    def test_invalidated_by_commit(self):
+        self.start_query_logging({'memoize_selects': True})
+        a = list(Author.objects.all())
+        connections['default']._commit()
+        a = list(Author.objects.all())
+        memo = self.query_debug_session.memo
+        self.stop_query_logging()
+        self.assertEqual((memo.hits, memo.invalidations), (0, 1))
+
+    def test_invalidated_by_turning_autocommit_off(self):
+        db = connections['default']
+        if not hasattr(db, '_set_autocommit'):
+            return  # Django < 1.6
+        self.start_query_logging({'memoize_selects': True})
+        a = list(Author.objects.all())
+        db.set_autocommit(False)
+        try:
+            a = list(Author.objects.all())
+            memo = self.query_debug_session.memo
+            self.assertEqual((memo.hits, memo.invalidations), (0, 1))
+        finally:
+            db.rollback()
+            db.set_autocommit(True)
+        self.stop_query_logging()
+
+
+class TimelineTest(TempDirTestCase):
+    def test_python_time_by_call_site(self):
+        self.start_query_logging({'timeline': True})
+        a = list(Author.objects.all())
+        time.sleep(0.02)
+        a = list(Author.objects.filter(name='a'))
+        timeline = self.query_debug_session.timeline
+        self.stop_query_logging()
+        self.assertEqual(len(timeline.events), 2)
+        (start1, end1, sql1, alias1, site1), (start2, end2, sql2, alias2, site2) = timeline.events
+        self.assertTrue(0 <= start1 <= end1 <= start2 <= end2 <= timeline.total_time)
+        self.assertTrue(timeline.python_time >= 0.02)
+        self.assertEqual(timeline.top_sites()[0].count, 1)
+        call_site = timeline.top_sites()[0].call_site
+        self.assertTrue(call_site.startswith('tests.py:') and call_site.endswith(' in test_python_time_by_call_site'))
+        log = MemoryHandler.get_log()
+        self.assertTrue(' ms Python between queries, ' in log)
+        self.assertTrue('Python time between queries by call site:' in log)
+        self.assertTrue(call_site in log)
+
+    def test_chrome_trace(self):
+        self.start_query_logging({'timeline': True, 'timeline_path': self.dir})
+        a = list(Author.objects.all())
+        a = list(Author.objects.filter(name='a'))
+        self.stop_query_logging()
+        files = os.listdir(self.dir)
+        self.assertEqual(len(files), 1)
+        self.assertTrue(files[0].startswith('TimelineTest-'))
+        with open(os.path.join(self.dir, files[0])) as f:
+            trace = json.load(f)
+        events = trace['traceEvents']
+        self.assertEqual([e['cat'] for e in events if e['cat'] != 'python'], ['session', 'sql', 'sql'])
+        self.assertEqual(events[0]['name'], 'TimelineTest')
+        self.assertTrue(all(e['ph'] == 'X' and e['ts'] >= 0 and e['dur'] >= 0 for e in events))
+        self.assertTrue(events[-1]['args']['sql'].startswith('SELECT'))
+
+    def test_bounded(self):
+        self.start_query_logging({'timeline': True, 'timeline_max_events': 1})
+        for i in range(3):
+            a = list(Author.objects.all())
+        timeline = self.query_debug_session.timeline
+        self.stop_query_logging()
+        self.assertEqual((len(timeline.events), timeline.dropped), (1, 2))
+        self.assertEqual(sum(gaps.count for gaps in timeline.sites.values()), 2)
+
+    def test_off_by_default(self):
+        self.start_query_logging()
+        a = list(Author.objects.all())
+        self.assertEqual(self.query_debug_session.timeline, None)
+        self.stop_query_logging()
+        self.assertFalse('timeline' in MemoryHandler.get_log())
+
+
+class ConnectionEventTest(TestCase, DatabaseQueryLoggerMixin):
+    def setUp(self):
+        MemoryHandler.get_log()
+
+    def test_savepoints(self):
+        if not hasattr(transaction, 'atomic'):  # Django < 1.6
+            return
+        self.start_query_logging()
+        with transaction.atomic():
+            Author.objects.create(name='a')
+            with transaction.atomic():
+                Author.objects.create(name='b')
+        events = self.query_debug_session.aggregator.alias_stats['default'].events
+        self.stop_query_logging()
+        self.assertEqual(events['savepoint'][0], 2)
+        self.assertEqual(events['savepoint_commit'][0], 2)
+        self.assertTrue(events['cursor'][0] >= 2)
+        self.assertTrue(', 4 savepoints in ' in MemoryHandler.get_log())
+
+    def test_checkpoints_keep_events(self):
+        if not hasattr(transaction, 'atomic'):  # Django < 1.6
+            return
+        self.start_query_logging({'checkpoint_queries': 1})
+        for name in 'ab':
+            with transaction.atomic():
+                Author.objects.create(name=name)
+        self.stop_query_logging()
+        self.assertTrue(', 4 savepoints in ' in MemoryHandler.get_log())
+
+
+class ConnectionEventTransactionTest(TransactionTestCase, DatabaseQueryLoggerMixin):
+    def setUp(self):
+        MemoryHandler.get_log()
+
+    def test_commits_and_rollbacks(self):
+        db = connections['default']
+        self.start_query_logging()
+        a = list(Author.objects.all())
+        db.commit()
+        db.rollback()
+        db.rollback()
+        self.stop_query_logging()
+        log = MemoryHandler.get_log()
+        self.assertTrue(', 1 commits in ' in log)
+        self.assertTrue(', 2 rollbacks in ' in log)
+        self.assertFalse(' connects in ' in log)
+
+    def test_autocommit_off_counted_as_begin(self):
+        db = connections['default']
+        if not hasattr(db, '_set_autocommit'):
+            return  # Django < 1.6
+        self.start_query_logging()
+        db.set_autocommit(False)
+        try:
+            a = list(Author.objects.all())
+        finally:
+            db.rollback()
+            db.set_autocommit(True)
+        self.stop_query_logging()
+        self.assertTrue(', 1 begins in ' in MemoryHandler.get_log())
+
+    def test_connects(self):
+        db = connections['default']
+        saved = db.connection
+        self.start_query_logging()
+        db.connection = None
+        try:
+            # Connects a new in-memory database, the test one is put back below
+            db.cursor().execute('SELECT 1')
+        finally:
+            new, db.connection = db.connection, saved
+            new.close()
+        self.stop_query_logging()
+        self.assertTrue(', 1 connects in ' in MemoryHandler.get_log())
+
+
+class MetricsTest(TempDirTestCase):
+    def test_sessions_recorded(self):
+        with override_settings(LOG_QUERY_METRICS_DIR=self.dir):
+            for names in ('ab', 'c'):
+                self.start_query_logging({'metrics': True})
+                for name in names:
+                    a = list(Author.objects.filter(name=name))
+                self.stop_query_logging()
+            self.assertEqual(os.listdir(self.dir), ['querylog_%d.db' % os.getpid()])
+        totals = collect(self.dir)
+        self.assertEqual(totals[('class', 'MetricsTest')][:2], [2, 3])
+        (kind, sql), values = [item for item in totals.items() if item[0][0] == 'fingerprint'][0]
+        self.assertTrue(sql.startswith('SELECT'))
+        self.assertEqual(values[0], 3)
+        self.assertEqual(sum(values[2:]), 3)
+
+    def test_processes_merged(self):
+        first = MetricsFile(os.path.join(self.dir, 'querylog_1.db'))
+        second = MetricsFile(os.path.join(self.dir, 'querylog_2.db'))
+        first.record(make_aggregator(('SELECT 1', 0.0002), ('SELECT 2', 0.003)), 'ViewA')
+        second.record(make_aggregator(('SELECT 1', 0.02), ('SELECT 1', 0.02)), 'ViewB')
+        totals = collect(self.dir)
+        self.assertEqual(totals[('fingerprint', 'SELECT 1')][:2], [3, 0.0402])
+        self.assertEqual(totals[('fingerprint', 'SELECT 1')][2:8], [1, 0, 0, 0, 0, 2])
+        self.assertEqual(totals[('class', 'ViewA')][:2], [1, 2])
+        # Reopening a file picks up where it left off
+        first.close()
+        MetricsFile(first.path).record(make_aggregator(('SELECT 2', 0.003)), 'ViewA')
+        self.assertEqual(collect(self.dir)[('fingerprint', 'SELECT 2')][0], 2)
+
+    def test_file_grows(self):
+        metrics_file = MetricsFile(os.path.join(self.dir, 'querylog_1.db'))
+        sqls = ['SELECT %d %s' % (i, 'x' * 4000) for i in range(300)]
+        metrics_file.record(make_aggregator(*[(sql, 0.001) for sql in sqls]), 'Big')
+        self.assertTrue(os.path.getsize(metrics_file.path) > 1024 * 1024)
+        totals = collect(self.dir)
+        self.assertEqual(len(totals), 301)
+        self.assertEqual(totals[('fingerprint', sqls[-1])][0], 1)
+
+    def test_forked_workers(self):
+        if not hasattr(os, 'fork'):
+            return
+        with override_settings(LOG_QUERY_METRICS_DIR=self.dir):
+            get_metrics_file().record(make_aggregator(('SELECT 1', 0.001)), 'Parent')
+            pid = os.fork()
+            if not pid:
+                try:
+                    get_metrics_file().record(make_aggregator(('SELECT 1', 0.001)), 'Child')
+                finally:
+                    os._exit(0)
+            os.waitpid(pid, 0)
+        self.assertEqual(sorted(os.listdir(self.dir)), sorted(['querylog_%d.db' % os.getpid(), 'querylog_%d.db' % pid]))
+        self.assertEqual(collect(self.dir)[('fingerprint', 'SELECT 1')][0], 2)
+
+    def test_openmetrics(self):
+        MetricsFile(os.path.join(self.dir, 'querylog_1.db')).record(
+            make_aggregator(('SELECT "a" FROM t WHERE x = %s', 0.002)), 'View')
+        text = render(self.dir)
+        self.assertTrue('# TYPE querylog_queries counter\n' in text)
+        self.assertTrue('sql="SELECT \\"a\\" FROM t WHERE x = %s"} 1\n' in text)
+        self.assertTrue('le="0.001"} 0\n' in text)
+        self.assertTrue('le="0.0025"} 1\n' in text)
+        self.assertTrue('le="+Inf"} 1\n' in text)
+        self.assertTrue('querylog_sessions_total{class_name="View"} 1\n' in text)
+        self.assertTrue(text.endswith('# EOF\n'))
+
+        with override_settings(LOG_QUERY_METRICS_DIR=self.dir):
+            response = query_metrics(RequestFactory().get('/metrics'))
+            self.assertEqual(response.content.decode('utf-8'), text)
+            self.assertTrue(response['Content-Type'].startswith('application/openmetrics-text'))
+            out = StringIO()
+            call_command('query_metrics', stdout=out)
+            self.assertEqual(out.getvalue(), text)
+
+
+class ResultSizeTest(TestCase, DatabaseQueryLoggerMixin):
+    def setUp(self):
+        for i in range(3):
+            Author.objects.create(name='Author %d' % i)
+        MemoryHandler.get_log()
+
+    def test_rows_counted_and_large_results_logged(self):
+        self.start_query_logging({'count_rows': True, 'large_result_rows': 3})
+        a = list(Author.objects.all())
+        b = list(Author.objects.filter(name__startswith='Author')[:2])
+        aggregator = self.query_debug_session.aggregator
+        self.stop_query_logging()
+        self.assertEqual(aggregator.num_rows, 5)
+        self.assertEqual(aggregator.num_bytes, 5 * (8 + 8))
+        log = MemoryHandler.get_log()
+        self.assertEqual(log.count('[SQL] large result'), 1)
+        self.assertTrue('[SQL] large result (1x), up to 3 rows / ~0 KB per execution, try .iterator(): SELECT' in log)
+
+    def test_raw_cursor_fetches(self):
+        self.start_query_logging({'count_rows': True, 'large_result_bytes': 10})
+        cursor = connections['default'].cursor()
+        cursor.execute('SELECT name FROM testapp_author')
+        self.assertEqual(cursor.fetchone(), ('Author 0',))
+        self.assertEqual(len(list(cursor)), 2)
+        aggregator = self.query_debug_session.aggregator
+        self.stop_query_logging()
+        entry = list(aggregator.stats.values())[0]
+        self.assertEqual((entry.rows, entry.max_rows, entry.max_bytes, entry.large_count), (3, 3, 24, 1))
+
+    def test_rows_not_counted_by_default(self):
+        self.start_query_logging({'large_result_rows': 1})
+        a = list(Author.objects.all())
+        aggregator = self.query_debug_session.aggregator
+        self.stop_query_logging()
+        self.assertEqual(aggregator.num_rows, 0)
+        self.assertFalse('large result' in MemoryHandler.get_log())
+
+
+class QueryBudgetTest(QueryBudgetTestMixin, TestCase, DatabaseQueryLoggerMixin):
+    def setUp(self):
+        Author.objects.create(name='a')
+        MemoryHandler.get_log()
+
+    def test_capture_queries(self):
+        with capture_queries() as captured:
+            a = list(Author.objects.filter(name='a'))
+            b = list(Author.objects.filter(name='b'))
+        self.assertEqual((captured.num_queries, captured.num_duplicates), (2, 1))
+        self.assertEqual(MemoryHandler.get_log(), '')
+
+    def test_within_budget(self):
+        with self.assertQueryBudget(max_queries=2, max_duplicates=1, fingerprints={
+                'SELECT "testapp_author"."id", "testapp_author"."name" FROM "testapp_author" '
+                'WHERE "testapp_author"."name" = %s': 2}):
+            a = list(Author.objects.filter(name='a'))
+            b = list(Author.objects.filter(name='b'))
+
+    def test_over_budget_report(self):
+        try:
+            with self.assertQueryBudget(max_queries=1, max_duplicates=0):
+                a = list(Author.objects.filter(name='a'))
+                b = list(Author.objects.filter(name='b'))
+                c = list(Book.objects.all())
+        except QueryBudgetExceeded as e:
+            report = str(e).splitlines()
+        else:
+            self.fail('QueryBudgetExceeded not raised')
+        self.assertEqual(report[:4], ['Query budget exceeded:', '  queries: 3 (limit 1)', '  duplicates: 1 (limit 0)',
+                                      'Queries run:'])
+        self.assertTrue(report[4].startswith('  !    2x'))
+        self.assertTrue(report[5].strip().startswith('at tests.py:'))
+        self.assertTrue(report[6].startswith('       1x'))
+        self.assertFalse('cursor' in connections['default'].__dict__)
+
+    def test_session_budget_logged(self):
+        self.start_query_logging({'budget': QueryBudget(max_queries=1, name='listing', action='log')})
+        a = list(Author.objects.all())
+        b = list(Book.objects.all())
+        self.stop_query_logging()
+        self.assertTrue('[SQL] Query budget for listing exceeded:\n  queries: 2 (limit 1)' in MemoryHandler.get_log())
+
+    def test_fingerprint_budget_across_checkpoints(self):
+        sql = ('SELECT "testapp_author"."id", "testapp_author"."name" FROM "testapp_author" '
+               'WHERE "testapp_author"."name" = %s')
+        self.start_query_logging({'checkpoint_queries': 2,
+                                  'budget': QueryBudget(fingerprints={sql: 2}, name='listing', action='log')})
+        for name in 'abc':
+            a = list(Author.objects.filter(name=name))
+        self.stop_query_logging()
+        log = MemoryHandler.get_log()
+        self.assertTrue('[SQL] Query budget for listing exceeded:\n  SELECT ' in log)
+        self.assertTrue('"testapp_author"."name" = ?: 3 (limit 2)\n' in log)
+
+    def test_session_budget_raised(self):
+        self.start_query_logging({'budget': QueryBudget(max_queries=0, action='raise')})
+        a = list(Author.objects.all())
+        self.assertRaises(QueryBudgetExceeded, self.stop_query_logging)
+        self.assertFalse('cursor' in connections['default'].__dict__)
+
+
+class BaselineTest(TempDirTestCase):
+    def setUp(self):
+        super(BaselineTest, self).setUp()
+        query_baseline._store = query_baseline.FileBaselineStore(self.dir)
+
+    def tearDown(self):
+        query_baseline._store = None
+        super(BaselineTest, self).tearDown()
+
+    def log_session(self, names, books=False):
+        self.start_query_logging({'baseline': True, 'baseline_min_sessions': 2})
+        for name in names:
+            a = list(Author.objects.filter(name=name))
+        if books:
+            b = list(Book.objects.all())
+        self.stop_query_logging()
+        return MemoryHandler.get_log()
+
+    def test_regression_reported_once_baseline_is_warm(self):
+        self.assertFalse('regression' in self.log_session('ab'))
+        self.assertFalse('regression' in self.log_session('ab'))
+        log = self.log_session('abcdef', books=True)
+        self.assertFalse('repeated query' in log)
+        self.assertEqual(log.count('[SQL] query regression in BaselineTest against 2 sessions: 1 new, 1 more frequent'),
+                         1)
+        self.assertTrue('  new: SELECT "testapp_book"' in log)
+        self.assertTrue('  6x, usually 2.0x: SELECT "testapp_author"' in log)
+
+        data = query_baseline.get_baseline_store().load('BaselineTest')
+        self.assertEqual(data['sessions'], 3)
+        self.assertEqual(len(data['queries']), 2)
+
+    def test_update_smooths_and_forgets(self):
+        aggregator = QueryAggregator()
+        aggregator.add('a', 0.001)
+        aggregator.add('a', 0.001)
+        data = query_baseline.update(None, aggregator, 0.5)
+        self.assertEqual(data['queries']['a']['count'], 2)
+        empty = QueryAggregator()
+        for i in range(8):
+            data = query_baseline.update(data, empty, 0.5)
+        self.assertEqual(data['queries'], {})
+        self.assertEqual(data['sessions'], 9)
+
+    def test_cache_store(self):
+        store = query_baseline.CacheBaselineStore()
+        store.save('SomeView', {'sessions': 1, 'queries': {}})
+        self.assertEqual(store.load('SomeView'), {'sessions': 1, 'queries': {}})
@@ -0,0 +1,9 @@
+# django
+from django.http import HttpResponse
+
+# project
+from .models import Author
+
+
+def author_list(request):
+    return HttpResponse(', '.join(author.name for author in Author.objects.all()))
@@ -1 +1,10 @@
+try:
+    from django.urls import re_path as url
+except ImportError:  # Django < 2.0
+    from django.conf.urls import url
 
+from testapp import views
+
+urlpatterns = [
+    url(r'^authors/$', views.author_list),
+]